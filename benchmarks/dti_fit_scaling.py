@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Benchmark : chunked multi-process DIPY tensor fitting (dtiplayground.dmri.common.tensor.fit_tensors)
+#             scaling from 1 to N workers against a single TensorModel.fit over the whole grid
+#
+# usage : python benchmarks/dti_fit_scaling.py [--size 96 96 60] [--gradients 64] [--workers 1 2 4 8]
+#
+
+import argparse
+import os
+import time
+import numpy as np
+
+import dipy.reconst.dti as dti
+from dipy.core.gradients import gradient_table
+from dtiplayground.dmri.common.tensor import fit_tensors, baseline_mask
+
+def synthetic_dwi(size,num_gradients,num_baselines=6,bval=1000.0,seed=0):
+    rng=np.random.default_rng(seed)
+    bvecs=rng.normal(size=(num_gradients,3))
+    bvecs/=np.linalg.norm(bvecs,axis=1)[:,np.newaxis]
+    bvecs[:num_baselines]=0
+    bvals=np.full(num_gradients,bval)
+    bvals[:num_baselines]=0
+    gtab=gradient_table(bvals,bvecs)
+    x,y,z=size
+    xx,yy,zz=np.meshgrid(np.linspace(-1,1,x),np.linspace(-1,1,y),np.linspace(-1,1,z),indexing='ij')
+    brain=(xx**2+yy**2+zz**2)<0.6
+    evals=np.array([1.7e-3,0.3e-3,0.3e-3])
+    D=np.diag(evals)
+    adc=np.einsum('gi,ij,gj->g',bvecs,D,bvecs)
+    signal=1000.0*np.exp(-bvals*adc)
+    data=rng.normal(0,10.0,size+(num_gradients,))
+    data[brain]+=signal
+    return np.abs(data),gtab
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--size',nargs=3,type=int,default=[96,96,60])
+    parser.add_argument('--gradients',type=int,default=64)
+    parser.add_argument('--workers',nargs='+',type=int,default=[1,2,4,os.cpu_count() or 1])
+    parser.add_argument('--chunk-size',type=int,default=20000)
+    args=parser.parse_args()
+
+    data,gtab=synthetic_dwi(tuple(args.size),args.gradients)
+    bt=time.time()
+    mask=baseline_mask(data,gtab)
+    print("automatic mask : {:.2f}s, {:.1f}% of the grid".format(time.time()-bt,100.0*np.mean(mask)))
+
+    bt=time.time()
+    reference=dti.TensorModel(gtab,fit_method='WLS').fit(data,mask)
+    t_ref=time.time()-bt
+    print("TensorModel.fit (whole grid, masked) : {:.2f}s".format(t_ref))
+
+    for nw in sorted(set(args.workers)):
+        bt=time.time()
+        fitted=fit_tensors(gtab,data,mask,fit_method='WLS',num_workers=nw,chunk_size=args.chunk_size)
+        et=time.time()-bt
+        fa_diff=np.nanmax(np.abs(np.nan_to_num(fitted.fa)-np.nan_to_num(reference.fa)))
+        print("fit_tensors {:2d} worker(s) : {:.2f}s, speedup x{:.2f}, max |FA diff| {:.2e}".format(nw,et,t_ref/max(et,1e-9),fa_diff))
+
+if __name__=='__main__':
+    main()
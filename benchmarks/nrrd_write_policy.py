@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Benchmark : NRRD write throughput per write policy (dtiplayground.dmri.common.dwi.WRITE_POLICIES)
+#             on a synthetic 4D DWI, with the file size and a read-back check
+#
+# usage : python benchmarks/nrrd_write_policy.py [--size 128 128 70] [--gradients 64] [--policies raw gzip-fast gzip gzip-parallel]
+#
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import nrrd
+
+import dtiplayground.dmri.common.dwi as dwi
+
+def synthetic_dwi(size,num_gradients,num_baselines=6,seed=0):
+    rng=np.random.default_rng(seed)
+    x,y,z=size
+    xx,yy,zz=np.meshgrid(np.linspace(-1,1,x),np.linspace(-1,1,y),np.linspace(-1,1,z),indexing='ij')
+    brain=(xx**2+yy**2+zz**2)<0.6
+    data=np.abs(rng.normal(0,10.0,size+(num_gradients,)))
+    data[brain]+=rng.uniform(200,1000,size=(int(np.sum(brain)),num_gradients))
+    image=dwi.DWI()
+    image.information={}
+    image.setImage(data)
+    image.information.update({
+        'type': 'short',
+        'space': 'left-posterior-superior',
+        'space_directions': np.eye(3).tolist(),
+        'space_origin': [0.0,0.0,0.0],
+        'measurement_frame': np.eye(3).tolist(),
+        'endian': 'little',
+        'b_value': 1000.0,
+        'original_centerings': None,
+        'thicknesses': None,
+    })
+    bvecs=rng.normal(size=(num_gradients,3))
+    bvecs/=np.linalg.norm(bvecs,axis=1)[:,np.newaxis]
+    bvecs[:num_baselines]=0
+    image.gradients=[{'index': i, 'original_index': i, 'gradient': g.tolist(), 'b_value': 0.0 if i<num_baselines else 1000.0} for i,g in enumerate(bvecs)]
+    return image
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--size',nargs=3,type=int,default=[128,128,70])
+    parser.add_argument('--gradients',type=int,default=64)
+    parser.add_argument('--policies',nargs='+',default=list(dwi.WRITE_POLICIES.keys()))
+    parser.add_argument('--repeat',type=int,default=1)
+    args=parser.parse_args()
+
+    image=synthetic_dwi(tuple(args.size),args.gradients)
+    nbytes=int(np.prod(image.images.shape))*np.dtype('int16').itemsize
+    print("image {} , {:.1f} MB (short)".format(list(image.images.shape),nbytes/2**20))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for policy in args.policies:
+            filename=str(Path(tmpdir).joinpath('output_{}.nrrd'.format(policy)))
+            times=[]
+            for _ in range(args.repeat):
+                bt=time.time()
+                image.writeImage(filename,dest_type='nrrd',policy=policy)
+                times.append(time.time()-bt)
+            et=min(times)
+            bt=time.time()
+            data,_=nrrd.read(filename)
+            rt=time.time()-bt
+            size=Path(filename).stat().st_size
+            print("{:14s} write {:6.2f}s ({:7.1f} MB/s) , read {:6.2f}s , file {:7.1f} MB (ratio {:.2f}) , shape {}".format(
+                policy,et,nbytes/2**20/max(et,1e-9),rt,size/2**20,nbytes/max(size,1),list(data.shape)))
+
+if __name__=='__main__':
+    main()
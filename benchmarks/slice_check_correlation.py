@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# Benchmark : SLICE_Check inter-slice correlation table, python loop vs batched numpy reductions
+#
+# usage : python benchmarks/slice_check_correlation.py [--size 128 128 70] [--gradients 100 200] [--repeat 1]
+#
+
+import argparse
+import time
+import numpy as np
+
+import dtiplayground.dmri.preprocessing.modules.SLICE_Check.SLICE_Check as slice_check
+
+def synthetic_volume(size,num_gradients,seed=0):
+    rng=np.random.default_rng(seed)
+    x,y,z=size
+    xx,yy,zz=np.meshgrid(np.linspace(-1,1,x),np.linspace(-1,1,y),np.linspace(-1,1,z),indexing='ij')
+    brain=(xx**2+yy**2+zz**2<0.8).astype(float)
+    vol=np.empty((x,y,z,num_gradients))
+    for g in range(num_gradients):
+        vol[:,:,:,g]=brain*(1000.0+200.0*rng.random())+rng.normal(0,20.0,size)
+    vol[:,:,z//2,num_gradients//3]*=0.2 ## artifact
+    return np.abs(vol).round()
+
+def timeit(func,repeat):
+    best=None
+    for _ in range(repeat):
+        bt=time.time()
+        res=func()
+        et=time.time()-bt
+        best=et if best is None else min(best,et)
+    return best,res
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--size',nargs=3,type=int,default=[128,128,70])
+    parser.add_argument('--gradients',nargs='+',type=int,default=[100,200])
+    parser.add_argument('--repeat',type=int,default=1)
+    args=parser.parse_args()
+
+    for g in args.gradients:
+        vol=synthetic_volume(args.size,g)
+        begin_slice=int(np.floor(vol.shape[2]*0.1))
+        last_slice=int(np.floor(vol.shape[2]*0.9))
+        t_loop,ref=timeit(lambda : slice_check.correlation_table_loop(vol,begin_slice,last_slice),args.repeat)
+        t_vec,res=timeit(lambda : slice_check.correlation_table(vol,begin_slice,last_slice),args.repeat)
+        identical=ref.shape==res.shape and ref.tolist()==res.tolist()
+        print("size {} x {} gradients : loop {:.3f}s, batched {:.3f}s, speedup x{:.1f}, identical table : {}"
+              .format(args.size,g,t_loop,t_vec,t_loop/max(t_vec,1e-9),identical))
+
+if __name__=='__main__':
+    main()
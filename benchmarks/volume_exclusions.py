@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Benchmark : gradient exclusions on the active-volume index of DWI against copying the 4D array on every edit
+#             replays the edits of a default QC pipeline (SLICE_Check, INTERLACE_Check, BASELINE_Average,
+#             MANUAL_Exclude and the postProcess of each module) on a synthetic image
+#
+# usage : python benchmarks/volume_exclusions.py [--size 128 128 70] [--gradients 64]
+#
+
+import argparse
+import copy
+import time
+import numpy as np
+
+import dtiplayground.dmri.common.dwi as dwi
+
+def synthetic_dwi(size,num_gradients,num_baselines=6,seed=0):
+    rng=np.random.default_rng(seed)
+    image=dwi.DWI()
+    image.information={}
+    image.setImage(rng.uniform(0,1000,size=tuple(size)+(num_gradients,)))
+    image.gradients=[{'original_index': i,
+                      'b_value': 0.0 if i<num_baselines else 1000.0,
+                      'gradient': [0.0,0.0,0.0] if i<num_baselines else [1.0,0.0,0.0],
+                      'unit_gradient': [0.0,0.0,0.0] if i<num_baselines else [1.0,0.0,0.0]} for i in range(num_gradients)]
+    return image
+
+def replay(image,eager):
+    def edited():
+        if eager: image.compact() ## copy on every edit, as np.delete / np.insert did
+    module_exclusions=[[7,19],[33],[],[45,51]] ## SLICE_Check, INTERLACE_Check, BASELINE_Average (own edits below), MANUAL_Exclude
+    for idx,excluded in enumerate(module_exclusions):
+        if idx==2:
+            grads,vols=image.getBaselines()
+            averaged=np.mean(vols,axis=3)
+            image.deleteGradientsByOriginalIndex([g['original_index'] for g in grads])
+            edited()
+            image.insertGradient({'original_index': -1,'b_value': 0.0,'gradient': [0.0,0.0,0.0],'unit_gradient': [0.0,0.0,0.0]},averaged,pos=0)
+            edited()
+        image.deleteGradientsByOriginalIndex(excluded) ## postProcess
+        edited()
+        image.getVolume(0) ## next module reads volumes
+    return image.images
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--size',nargs=3,type=int,default=[128,128,70])
+    parser.add_argument('--gradients',type=int,default=64)
+    args=parser.parse_args()
+
+    source=synthetic_dwi(args.size,args.gradients)
+    print("image {} , {:.1f} MB".format(list(source.images.shape),source.images.nbytes/2**20))
+    results={}
+    for mode in ['eager','deferred']:
+        image=copy.copy(source)
+        dwi.reset_volume_edit_statistics()
+        bt=time.time()
+        results[mode]=replay(image,eager=(mode=='eager'))
+        et=time.time()-bt
+        stats=dwi.get_volume_edit_statistics()
+        print("{:9s} : {:.2f}s , {} edits , {} copies ({:.1f} MB copied)".format(mode,et,stats['deferred_edits'],stats['compactions'],stats['bytes_compacted']/2**20))
+    print("identical result : {}".format(np.array_equal(results['eager'],results['deferred'])))
+
+if __name__=='__main__':
+    main()
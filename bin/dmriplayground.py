@@ -71,7 +71,9 @@ def command_server(args):
         "port" : next_free_port(int(args.port)),
         "static_page_dir" : Path(args.directory).resolve().__str__(),
         "browser" : args.browser,
-        "debug" : args.debug
+        "debug" : args.debug,
+        "max_jobs" : int(args.max_jobs),
+        "job_threads" : int(args.job_threads) if args.job_threads else None
     }
 
     if config['browser']: 
@@ -124,6 +126,8 @@ def get_args():
     parser_server.add_argument('-d','--directory', help="Static Page Path", default=str(config_dir.joinpath('static/spa')))
     parser_server.add_argument('--browser', help="Launch browser at start up", default=False, action="store_true")
     parser_server.add_argument('--debug', help="Debug mode", default=False, action="store_true")
+    parser_server.add_argument('--max-jobs', help="Number of dmriprep/atlas builder runs at a time, the others are queued", default=1, type=int)
+    parser_server.add_argument('--job-threads', help="Number of threads of a run (default : number of cores / max jobs)", default=None, type=int)
     parser_server.set_defaults(func=command_server)
 
     ## log related
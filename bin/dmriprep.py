@@ -90,10 +90,39 @@ def command_run(args):
         "output_format" : args.output_format,
         "output_file_base" : args.output_file_base,
         "no_output_image" : args.no_output_image,
+        "step_cache_dir" : args.step_cache_dir,
+        "in_memory_handoff" : not args.sync_write,
+        "parallel_inputs" : not args.sequential_inputs,
+        "write_policy_intermediate" : args.write_policy_intermediate,
+        "write_policy_final" : args.write_policy_final,
         "global_variables" : _parse_global_variables(args.global_variables)
     }
     app = DMRIPrepApp(options['config_dir'])
     app.run(options)
+
+def command_batch(args):
+    ## reparametrization
+    options={
+        "config_dir" : args.config_dir,
+        "study_dirs" : args.study_dirs,
+        "modality" : args.modality,
+        "protocol_path" : args.protocols,
+        "output_dir" : args.output_dir,
+        "default_protocols":args.default_protocols,
+        "num_threads":args.num_threads,
+        "num_jobs":args.num_jobs,
+        "max_cores":args.max_cores,
+        "baseline_threshold" : args.b0_threshold,
+        "output_format" : args.output_format,
+        "no_output_image" : args.no_output_image,
+        "step_cache_dir" : args.step_cache_dir,
+        "in_memory_handoff" : not args.sync_write,
+        "write_policy_intermediate" : args.write_policy_intermediate,
+        "write_policy_final" : args.write_policy_final,
+        "global_variables" : _parse_global_variables(args.global_variables)
+    }
+    app = DMRIPrepApp(options['config_dir'])
+    app.runBatch(options)
 ### Arguments 
 
 def get_args():
@@ -157,6 +186,11 @@ def get_args():
     parser_run.add_argument('--output-file-base', help="Output filename base", type=str, required=False)
     parser_run.add_argument('-t','--num-threads',help="Number of threads to use",default=1,type=int,required=False)
     parser_run.add_argument('--no-output-image',help="No output Qced file will be generated",default=False,action='store_true')
+    parser_run.add_argument('--sync-write',help="Write every output image before the next module starts (debugging), images are written in background by default",default=False,action='store_true')
+    parser_run.add_argument('--sequential-inputs',help="Process the input images one after the other, the modules before a multi-input module run concurrently for each input by default",default=False,action='store_true')
+    parser_run.add_argument('--write-policy-intermediate',help="Encoding of the module outputs (raw | gzip-fast | gzip | gzip-parallel), protocol setting is used if not specified",default=None,type=str,required=False)
+    parser_run.add_argument('--write-policy-final',help="Encoding of the final output (raw | gzip-fast | gzip | gzip-parallel), protocol setting is used if not specified",default=None,type=str,required=False)
+    parser_run.add_argument('--step-cache-dir',help="Shared step cache directory, identical steps (same input, module version and protocol) are reused",default=None,type=str,required=False)
     parser_run.add_argument('-b','--b0-threshold',metavar='BASELINE_THRESHOLD',help='b0 threshold value, default=10',default=10,type=float)
     parser_run.add_argument('-f','--output-format',metavar='OUTPUT FORMAT',default=None,help='OUTPUT format, if not specified, same format will be used for output  (NRRD | NIFTI)',type=str)
     run_exclusive_group=parser_run.add_mutually_exclusive_group()
@@ -164,6 +198,27 @@ def get_args():
     run_exclusive_group.add_argument('-d','--default-protocols',metavar="MODULE",help='Use default protocols (optional : sequence of modules, Example : -d DIFFUSION_Check SLICE_Check)',default=None,nargs='*')
     parser_run.set_defaults(func=command_run)
 
+    ## batch command
+    parser_batch=subparsers.add_parser('batch',help='Run pipeline over every DWI of BIDS studies (study/subject/session/modality), resumable',epilog=module_help_str)
+    parser_batch.add_argument('-s','--study-dirs',help='BIDS study root directories',type=str,nargs='+',required=True)
+    parser_batch.add_argument('-o','--output-dir',help="Output directory (output of each run in <subject>/<session>/<run>, batch_manifest.yml and batch_summary.yml)",type=str,required=True)
+    parser_batch.add_argument('-m','--modality',help="Modality directory to process, default=dwi",default='dwi',type=str)
+    parser_batch.add_argument('-g','--global-variables',help='Global Variables',type=str,nargs='*',required=False)
+    parser_batch.add_argument('-t','--num-threads',help="Number of threads per job",default=1,type=int,required=False)
+    parser_batch.add_argument('-j','--num-jobs',help="Number of concurrent jobs, default=cores/threads (jobs x threads never exceeds the cores)",default=None,type=int,required=False)
+    parser_batch.add_argument('--max-cores',help="Number of cores to use, default=all",default=None,type=int,required=False)
+    parser_batch.add_argument('--no-output-image',help="No output Qced file will be generated",default=False,action='store_true')
+    parser_batch.add_argument('--sync-write',help="Write every output image before the next module starts (debugging), images are written in background by default",default=False,action='store_true')
+    parser_batch.add_argument('--write-policy-intermediate',help="Encoding of the module outputs (raw | gzip-fast | gzip | gzip-parallel), protocol setting is used if not specified",default=None,type=str,required=False)
+    parser_batch.add_argument('--write-policy-final',help="Encoding of the final output (raw | gzip-fast | gzip | gzip-parallel), protocol setting is used if not specified",default=None,type=str,required=False)
+    parser_batch.add_argument('--step-cache-dir',help="Shared step cache directory, identical steps (same input, module version and protocol) are reused",default=None,type=str,required=False)
+    parser_batch.add_argument('-b','--b0-threshold',metavar='BASELINE_THRESHOLD',help='b0 threshold value, default=10',default=10,type=float)
+    parser_batch.add_argument('-f','--output-format',metavar='OUTPUT FORMAT',default=None,help='OUTPUT format, if not specified, same format will be used for output  (NRRD | NIFTI)',type=str)
+    batch_exclusive_group=parser_batch.add_mutually_exclusive_group()
+    batch_exclusive_group.add_argument('-p','--protocols',metavar="PROTOCOLS_FILE" ,help='Protocol file path', type=str)
+    batch_exclusive_group.add_argument('-d','--default-protocols',metavar="MODULE",help='Use default protocols (optional : sequence of modules, Example : -d DIFFUSION_Check SLICE_Check)',default=None,nargs='*')
+    parser_batch.set_defaults(func=command_batch)
+
     ## log related
     parser.add_argument('--config-dir',help='Configuration directory',default=str(config_dir))
     parser.add_argument('--log',help='log file',default=str(config_dir.joinpath('log.txt')))
@@ -19,6 +19,8 @@ import multiprocessing as mp
 mp.set_start_method("fork")
 from dtiplayground.config import INFO 
 import dtiplayground.dmri.common.dwi as dwi
+from dtiplayground.api.tilecache import TileCache, tile_etag, neighbor_tiles
+from dtiplayground.api.imagecache import ImageCache
 import cv2
 import io
 import numpy as np 
@@ -27,7 +29,9 @@ class ApplicationAPI:
     def __init__(self,server,**kwargs):
         self.server = server
         self.app=self.server.app
-        self.filecache={}
+        self.filecache={} # filekey -> image id of the last loaded image (used when a request has no valid img_id)
+        self.tilecache=TileCache()
+        self.imagecache=ImageCache(on_evict=self.tilecache.invalidate)
         self.initEndpoints()
 
 ##### Endpoints
@@ -205,33 +209,28 @@ class ApplicationAPI:
 
         ####### Image browsing (DWI)
         @self.app.route('/api/v1/dwi/<img_id>/<grad_idx>/<axis_idx>/<slice_idx>',methods=['GET'])
-        def _getFrameFromDWI(img_id,grad_idx,axis_idx,slice_idx): ## img_id is not used, just to prevent browser cacheing
+        def _getFrameFromDWI(img_id,grad_idx,axis_idx,slice_idx): ## img_id : image id returned by /api/v1/files/load (otherwise the last loaded dwi)
             res=None
             sc=500 
             data=None
+            etag=None
             grad_idx=int(grad_idx)
             axis_idx=int(axis_idx)
             slice_idx=int(slice_idx)
             param_min = request.args.get('min',default=0,type=int)
             param_max = request.args.get('max',default=10e6,type=int)
+            param_quality = request.args.get('quality',default=50,type=int)
+            param_size = request.args.get('size',default=None,type=int) ## largest side of the tile in pixels (None : full resolution)
             try:
-                # if axis_idx == 0:
-                #     res = self.filecache['dwi'].images[int(slice_idx),:,:,int(grad_idx)]
-                # elif axis_idx == 1:
-                #     res = self.filecache['dwi'].images[:,int(slice_idx),:,int(grad_idx)]
-                # elif axis_idx == 2:
-                #     res = self.filecache['dwi'].images[:,:,int(slice_idx),int(grad_idx)]
-                # else: raise Exception('No such axis')
-
-                # out = (res >= param_min) * res
-                # out[out >= param_max] = param_max
-                out = self.filecache['dwi'].getImageSlice4D(axis_idx,slice_idx,grad_idx,normalized=True, display_range=[param_min, param_max])
-                ok,res=cv2.imencode('.jpeg',out, [int(cv2.IMWRITE_JPEG_QUALITY), 50]) ### compress 
-                if ok:                       
-                    data=io.BytesIO(res).read() 
+                image_id, image = self.getImage(img_id,'dwi')
+                key = (image_id, grad_idx, axis_idx, slice_idx, param_min, param_max, param_quality, param_size)
+                etag = tile_etag(key)
+                if etag in request.if_none_match: ## browser already has the tile
+                    sc=304
                 else:
-                    raise Exception("Failed to encode")
-                sc=200
+                    data,hit = self.tilecache.getOrRender(key, lambda: self.renderTile(image, grad_idx, axis_idx, slice_idx, [param_min, param_max], param_quality, param_size))
+                    sc=200
+                    self.prefetchTiles(image, key)
             except Exception as e:
                 msg=traceback.format_exc()
                 err_msg="{}:{}".format(str(e),msg)
@@ -241,6 +240,26 @@ class ApplicationAPI:
                 resp=Response(data,status=sc)
                 resp.headers['Content-Type']='application/octet-stream'
                 resp.headers['Image-Format']='jpeg'
+                if etag is not None and sc in [200,304]:
+                    resp.headers['ETag']='"{}"'.format(etag)
+                    resp.headers['Cache-Control']='private, no-cache' ## revalidated with the ETag, 304 if unchanged
+                return resp
+
+        @self.app.route('/api/v1/dwi/cache',methods=['GET'])
+        def _getTileCacheStatistics():
+            sc=200
+            res=None
+            request_id=utils.get_request_id()
+            try:
+                res= {'tiles': self.tilecache.getStatistics(), 'images': self.imagecache.getStatistics()}
+                res= utils.add_request_id(res)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{}\n{}".format(str(e),exc),500,request_id)
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
                 return resp
 
         ####### Multiprocessing
@@ -281,39 +300,63 @@ class ApplicationAPI:
 
     def loadFileAsCache(self, filename, filekey):
         meta={}
+        image_id=None
         if filekey.lower() == 'dwi':
-            #load DWI and put it in cache 
-            self.filecache[filekey] = dwi.DWI(str(filename))
+            #load DWI and put it in cache (shared with the other requests on the same file version)
+            image_id, image = self.imagecache.load(filename)
+            self.filecache[filekey] = image_id
             meta = {
-                'info': self.filecache[filekey].information,
-                'gradients': self.filecache[filekey].getGradients()
+                'info': dict(image.information),
+                'gradients': image.getGradients()
             }
             del meta['info']['thicknesses']
 
         out = {
             'filename': str(filename),
             'type': filekey,
+            'image_id': image_id,
             'meta': meta,
         }
         return out
 
+    def getImage(self, img_id, filekey): ## (image id, image) of a request, falls back to the last loaded image of filekey
+        if self.imagecache.contains(img_id):
+            return img_id, self.imagecache.get(img_id)
+        if filekey not in self.filecache:
+            raise Exception("No image loaded")
+        image_id = self.filecache[filekey]
+        return image_id, self.imagecache.get(image_id)
+
     #### image browsing
 
+    def renderTile(self, image, grad_idx, axis_idx, slice_idx, display_range, quality, size=None): ## jpeg bytes of a slice
+        out = image.getDisplaySlice(axis_idx,slice_idx,grad_idx,display_range=display_range,size=size)
+        ok,res=cv2.imencode('.jpeg',out, [int(cv2.IMWRITE_JPEG_QUALITY), quality]) ### compress 
+        if not ok:
+            raise Exception("Failed to encode")
+        self.imagecache.evict() ## display volumes and lazily read data grow the images, the budget is checked again
+        return res.tobytes()
+
+    def prefetchTiles(self, image, key): ## neighboring slices and gradients of a tile, rendered in the background
+        token, grad_idx, axis_idx, slice_idx, mn, mx, quality, size = key
+        requests = []
+        for g,a,s in neighbor_tiles(image.getShape(), grad_idx, axis_idx, slice_idx, self.tilecache.prefetch_radius):
+            render = (lambda g=g,a=a,s=s: self.renderTile(image, g, a, s, [mn, mx], quality, size))
+            requests.append(((token, g, a, s, mn, mx, quality, size), render))
+        self.tilecache.prefetch(requests)
+
     #### Process
 
-    def getProcesses(self):
-        res = mp.active_children()
-        res = list(map(lambda x: {'pid': x.pid, 'name' : x.name }, res))
+    def getProcesses(self): ## queued and running jobs of the job queue
+        res = self.server.jobqueue.list()
+        res = list(map(lambda x: dict(x, name=x['proc_name']), res))
 
         return res
 
-    def killProcess(self, _id): # id can bd pid or execution id
-        allprocs = mp.active_children()
-        tokill = filter(lambda x: str(x.pid) == _id or x.name == _id,allprocs)
-        for p in tokill:
-            p.kill()
+    def killProcess(self, _id): # id can bd pid or execution id, a queued job is removed from the queue
+        killed = self.server.jobqueue.kill(_id)
 
-        res = list(map(lambda x: {'pid': x.pid, 'name' : x.name }, tokill))
+        res = list(map(lambda x: dict(x, name=x['proc_name']), killed))
         return res
 
     #### Filesystem DMRIPlayground
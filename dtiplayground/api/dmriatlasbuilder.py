@@ -125,42 +125,8 @@ class DMRIAtlasbuilderAPI:
 
         output_dir=Path(configured_dir)
         
-        def dmriatlas_proc(output_dir):
-            with open(output_dir.joinpath('log.txt'),'w') as sys.stdout:
-                import  dtiplayground.dmri.common as common   
-                from dtiplayground.dmri.atlasbuilder import AtlasBuilder 
-                logger = common.logger
-                logger.setFilePointer(sys.stdout)
-                config_path=output_dir.joinpath('common/config.yml')
-                hbuild_path=output_dir.joinpath('common/h-build.yml')
-                greedy_path=output_dir.joinpath('common/greedy.yml')
-
-                bldr=AtlasBuilder(logger = logger)
-                bldr.configure( output_dir=output_dir,
-                                config_path=config_path,
-                                hbuild_path=hbuild_path,
-                                greedy_path=greedy_path)
-           
-                bldr.build()
-
-        res = { 'execution_id' : utils.get_uuid(),
-                'output_dir' : output_dir.__str__()
-        }
-        proc = Process(target= dmriatlas_proc,name=res['execution_id'], args=[output_dir])
-        proc.start()
-        res['pid']=proc.pid
-        res['proc_name']=proc.name
-        res['status']='running'
-        json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-        proc.join()
-        if proc.exitcode != 0 : 
-            res['status']='failed'
-            json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-            raise Exception("Error during running")
-        else:
-            res['status']='success'
-            json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-        return res
+        ## queued, the job runs in its own process and status.json follows it (queued, running, success/failed/killed)
+        return self.server.jobqueue.submit(dmriatlas_job, [str(output_dir)], output_dir)
 
 
     def getUITemplate(self):
@@ -168,3 +134,24 @@ class DMRIAtlasbuilderAPI:
         template_fn = Path(d.__file__).parent.joinpath('template.json')
         template = json.load(open(template_fn,'r'))
         return template 
+
+
+def dmriatlas_job(output_dir, num_threads): ## job process (jobqueue), thread variables are set in its environment
+    output_dir=Path(output_dir)
+    with open(output_dir.joinpath('log.txt'),'w') as sys.stdout:
+        import  dtiplayground.dmri.common as common   
+        from dtiplayground.dmri.atlasbuilder import AtlasBuilder 
+        logger = common.logger
+        logger.setFilePointer(sys.stdout)
+        config_path=output_dir.joinpath('common/config.yml')
+        hbuild_path=output_dir.joinpath('common/h-build.yml')
+        greedy_path=output_dir.joinpath('common/greedy.yml')
+
+        bldr=AtlasBuilder(logger = logger)
+        bldr.configure( output_dir=output_dir,
+                        config_path=config_path,
+                        hbuild_path=hbuild_path,
+                        greedy_path=greedy_path,
+                        num_cores=num_threads)
+   
+        bldr.build()
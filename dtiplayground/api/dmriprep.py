@@ -226,61 +226,9 @@ class DMRIPrepAPI:
         params.setdefault('execution_id', utils.get_uuid())
         params.setdefault('global_variables', {})
 
-    
-        def dmriprep_proc(param):
 
-            
-            with open(output_dir.joinpath('log.txt'),'w') as sys.stdout:
-                
-                ### begin
-                os.environ['OMP_NUM_THREADS']=str(protocol['io']['num_threads']) ## this should go before loading any dipy function. 
-                os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(protocol['io']['num_threads']) ## for ANTS threading
-                import  dtiplayground.dmri.common as common
-                import dtiplayground.dmri.preprocessing
-                import dtiplayground.dmri.preprocessing.modules as m
-                import dtiplayground.dmri.preprocessing.protocols as p
-                from dtiplayground.dmri.preprocessing.app import DMRIPrepApp
-                
-                inputs = [protocol['io']['input_image_1']]
-                protocol['io'].setdefault('input_image_2',None)
-                if protocol['io']['input_image_2'] is not None:
-                    inputs.append(protocol['io']['input_image_2'])
-                options={
-                    "input_image_paths" : inputs,
-                    "protocol_path" : str(protocol_fn),
-                    "output_dir" : protocol['io']['output_directory'],
-                    "num_threads":  protocol['io']['num_threads'],
-                    "default_protocols": None,
-                    "execution_id": param['execution_id'],
-                    "baseline_threshold" : protocol['io']['baseline_threshold'],
-                    "output_format" : protocol['io']['output_format'],
-                    "output_file_base" : protocol['io']['output_filename_base'],
-                    "no_output_image" :  protocol['io']['no_output_image'],
-                    "global_variables" : {}
-                }
-                app=DMRIPrepApp(config_root=str(self.server.config_dir))
-                app.run(options)
-
-        res = { 
-            'execution_id' : params['execution_id'],
-            'output_dir' : output_dir.__str__()
-        }
-        proc = Process(target= dmriprep_proc, name=params['execution_id'],args=[params])
-        proc.start()
-
-        res['pid']=proc.pid
-        res['proc_name']=proc.name
-        res['status']='running'
-        json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-        proc.join()
-        if proc.exitcode != 0 : 
-            res['status']='failed'
-            json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-            raise Exception("Error during running")
-        else:
-            res['status']='success'
-            json.dump(res,open(output_dir.joinpath('status.json'),'w'),indent=4)
-        return res
+        ## queued, the job runs in its own process and status.json follows it (queued, running, success/failed/killed)
+        return self.server.jobqueue.submit(dmriprep_job, [params, str(self.server.config_dir)], output_dir, execution_id=params['execution_id'])
 
     def getProtocolTemplateConfig(self):
         # config_dir = self.getConfigDirectory();
@@ -391,3 +339,36 @@ class DMRIPrepAPI:
     def getSystemModulePath(self):
         import dtiplayground.dmri.preprocessing.modules as modules
         return Path(modules.__file__).parent.__str__()
+
+
+def dmriprep_job(params, config_root, num_threads): ## job process (jobqueue), thread variables are set in its environment
+    output_dir = Path(params['output_dir'])
+    protocol_fn = Path(params['protocol_path'])
+    protocol = yaml.safe_load(open(protocol_fn,'r'))
+    with open(output_dir.joinpath('log.txt'),'w') as sys.stdout:
+        
+        ### begin
+        num_threads=min(int(protocol['io']['num_threads']), num_threads) ## within the thread budget of the job
+        os.environ['OMP_NUM_THREADS']=str(num_threads) ## for the external tools
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_threads) ## for ANTS threading
+        from dtiplayground.dmri.preprocessing.app import DMRIPrepApp
+        
+        inputs = [protocol['io']['input_image_1']]
+        protocol['io'].setdefault('input_image_2',None)
+        if protocol['io']['input_image_2'] is not None:
+            inputs.append(protocol['io']['input_image_2'])
+        options={
+            "input_image_paths" : inputs,
+            "protocol_path" : str(protocol_fn),
+            "output_dir" : protocol['io']['output_directory'],
+            "num_threads":  num_threads,
+            "default_protocols": None,
+            "execution_id": params['execution_id'],
+            "baseline_threshold" : protocol['io']['baseline_threshold'],
+            "output_format" : protocol['io']['output_format'],
+            "output_file_base" : protocol['io']['output_filename_base'],
+            "no_output_image" :  protocol['io']['no_output_image'],
+            "global_variables" : {}
+        }
+        app=DMRIPrepApp(config_root=config_root)
+        app.run(options)
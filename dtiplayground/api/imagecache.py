@@ -0,0 +1,136 @@
+##################################################################################
+### Module : imagecache.py
+### Description : Loaded images of the API server, shared by the requests
+###               keyed by resolved path and modification time, LRU eviction by resident bytes
+###
+###
+### Copyrights reserved by NIRAL
+##################################################################################
+
+import threading
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+
+import dtiplayground.dmri.common.dwi as dwi
+
+DEFAULT_MAX_BYTES=4*1024*1024*1024 ## resident image data, memory-mapped files are not counted
+DEFAULT_MAX_EVICTED=256 ## evicted image ids still resolvable (reloaded on request), oldest forgotten first
+
+def image_key(filename): ## (resolved path, mtime), a modified file is a new image
+    path=Path(filename).resolve()
+    return (str(path),path.stat().st_mtime_ns)
+
+def image_id_of(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+
+def load_dwi(filename):
+    image=dwi.DWI(str(filename),lazy=True)
+    image.computeDisplayRanges()
+    return image
+
+class ImageCache(object):
+    def __init__(self,max_bytes=DEFAULT_MAX_BYTES,loader=load_dwi,on_evict=None,max_evicted=DEFAULT_MAX_EVICTED):
+        self.lock=threading.Lock()
+        self.images=OrderedDict() # image id -> image, least recently used first
+        self.keys={} # image id -> (path, mtime)
+        self.loading={} # image id -> lock held while the image is being loaded
+        self.evicted=OrderedDict() # image id -> (path, mtime) of the evicted images, reloaded when requested again (at most max_evicted)
+        self.max_evicted=int(max_evicted)
+        self.max_bytes=int(max_bytes)
+        self.loader=loader
+        self.on_evict=on_evict # on_evict(image_id), e.g. to drop derived caches
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def load(self,filename): ## (image id, image), loads the file unless the same version is cached
+        key=image_key(filename)
+        image_id=image_id_of(key)
+        with self.lock:
+            if image_id in self.images:
+                self.images.move_to_end(image_id)
+                self.hits+=1
+                return image_id,self.images[image_id]
+            loading=self.loading.setdefault(image_id,threading.Lock())
+        with loading: ## concurrent loads of the same file wait for the first one
+            with self.lock:
+                if image_id in self.images:
+                    self.images.move_to_end(image_id)
+                    self.hits+=1
+                    return image_id,self.images[image_id]
+            try:
+                image=self.loader(key[0])
+            except Exception:
+                with self.lock:
+                    self.loading.pop(image_id,None)
+                raise
+            with self.lock: ## inserted before the loading lock is dropped, a new request finds the image
+                self.misses+=1
+                self.images[image_id]=image
+                self.keys[image_id]=key
+                self.evicted.pop(image_id,None)
+                self.loading.pop(image_id,None)
+        self.evict()
+        return image_id,image
+
+    def get(self,image_id): ## an evicted image is loaded again if its file has not changed
+        with self.lock:
+            image=self.images.get(image_id)
+            if image is not None:
+                self.images.move_to_end(image_id)
+                return image
+            key=self.evicted.get(image_id)
+        if key is None:
+            raise Exception("Image {} is not loaded".format(image_id))
+        new_id,image=self.load(key[0])
+        if new_id!=image_id:
+            raise Exception("Image {} has been modified since it was loaded".format(key[0]))
+        return image
+
+    def contains(self,image_id): ## loaded or evicted
+        with self.lock:
+            return image_id in self.images or image_id in self.evicted
+
+    def remove(self,image_id):
+        with self.lock:
+            removed=self.images.pop(image_id,None) is not None
+            self.keys.pop(image_id,None)
+        if removed and self.on_evict is not None:
+            self.on_evict(image_id)
+        return removed
+
+    def residentBytes(self): ## measured now, lazy images grow as they are materialized
+        with self.lock:
+            return {k:img.getResidentBytes() for k,img in self.images.items()}
+
+    def evict(self): ## least recently used first, the most recent image is always kept, called after loads and renders (lazy images grow as they are read)
+        evicted=[]
+        with self.lock:
+            sizes={k:img.getResidentBytes() for k,img in self.images.items()}
+            total=sum(sizes.values())
+            while total>self.max_bytes and len(self.images)>1:
+                image_id,_=self.images.popitem(last=False)
+                self.evicted[image_id]=self.keys.pop(image_id)
+                while len(self.evicted)>self.max_evicted:
+                    self.evicted.popitem(last=False)
+                total-=sizes[image_id]
+                self.evictions+=1
+                evicted.append(image_id)
+        if self.on_evict is not None:
+            for image_id in evicted: self.on_evict(image_id)
+        return evicted
+
+    def getStatistics(self):
+        sizes=self.residentBytes()
+        with self.lock:
+            total=self.hits+self.misses
+            return {
+                'images': [{'image_id': k, 'path': self.keys[k][0], 'resident_bytes': int(sizes.get(k,0))} for k in self.images.keys()],
+                'resident_bytes': int(sum(sizes.values())),
+                'max_bytes': int(self.max_bytes),
+                'hits': int(self.hits),
+                'misses': int(self.misses),
+                'hit_rate': float(self.hits)/total if total>0 else 0.0,
+                'evictions': int(self.evictions)
+            }
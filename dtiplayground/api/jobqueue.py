@@ -0,0 +1,168 @@
+##################################################################################
+### Module : jobqueue.py
+### Description : Local job queue of the API server (dmriprep, atlas builder runs)
+###               at most max_jobs processes at a time, each limited to a thread budget
+###               status transitions are written to status.json of the output directory
+###
+### Copyrights reserved by NIRAL
+##################################################################################
+
+import os
+import sys
+import json
+import signal
+import importlib
+import threading
+import subprocess
+from collections import OrderedDict
+from pathlib import Path
+
+import dtiplayground.dmri.common as common
+
+THREAD_VARIABLES=['OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS','ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] ## in the environment of the job process, read by the thread pools when they load
+POLL_INTERVAL=1.0 ## seconds between the checks of the running processes
+MAX_FINISHED=100 ## finished jobs kept for the listing
+
+def default_job_threads(max_jobs):
+    return max(1,(os.cpu_count() or 1)//max(1,int(max_jobs)))
+
+def write_status(output_dir,status): ## atomic, a reader never sees a partial file
+    path=Path(output_dir).joinpath('status.json')
+    tmp=path.with_suffix('.json.tmp')
+    with open(tmp,'w') as f:
+        json.dump(status,f,indent=4)
+    os.replace(tmp,path)
+
+def job_command(target,args,num_threads): ## a job runs in a fresh interpreter : python -m dtiplayground.api.jobqueue <module> <function> <json args> <threads>
+    return [sys.executable,'-m','dtiplayground.api.jobqueue',
+            target.__module__,target.__qualname__,json.dumps(list(args)),str(int(num_threads))]
+
+def job_environment(num_threads):
+    env=dict(os.environ)
+    package_root=str(Path(__file__).resolve().parent.parent.parent) ## the server may run from a source tree (bin/)
+    env['PYTHONPATH']=os.pathsep.join([package_root]+([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    for v in THREAD_VARIABLES:
+        env[v]=str(num_threads)
+    return env
+
+def run_job(module_name,function_name,args,num_threads): ## entry of the job process, target(*args, num_threads=n)
+    target=getattr(importlib.import_module(module_name),function_name)
+    target(*args,num_threads=num_threads)
+
+def kill_group(proc): ## the job process and everything it started (external tools, worker pools)
+    try:
+        os.killpg(proc.pid,signal.SIGKILL) ## process group id is the job pid (new session)
+    except (ProcessLookupError,PermissionError):
+        pass
+
+class JobQueue(object):
+    def __init__(self,max_jobs=1,job_threads=None):
+        self.max_jobs=max(1,int(max_jobs))
+        self.job_threads=max(1,int(job_threads)) if job_threads else default_job_threads(self.max_jobs)
+        self.cond=threading.Condition()
+        self.jobs=OrderedDict() # execution id -> job, in submission order
+        self.procs={} # execution id -> running process (subprocess.Popen, leader of its own process group)
+        self.targets={} # execution id -> (target, args) of the queued jobs
+        self.scheduler=None
+
+    def submit(self,target,args,output_dir,execution_id=None): ## target(*args, num_threads=n) runs in a new process, target : module level function, args : json serializable, returns the status of the job
+        execution_id=execution_id or common.get_uuid()
+        job={
+            'execution_id': execution_id,
+            'output_dir': str(output_dir),
+            'pid': None,
+            'proc_name': execution_id,
+            'status': 'queued',
+            'num_threads': self.job_threads,
+            'queued_at': common.get_timestamp(),
+            'started_at': None,
+            'finished_at': None,
+            'exitcode': None
+        }
+        with self.cond:
+            if execution_id in self.jobs and self.jobs[execution_id]['status'] in ['queued','running']:
+                raise Exception("Job {} is already {}".format(execution_id,self.jobs[execution_id]['status']))
+            self.jobs[execution_id]=job
+            self.jobs.move_to_end(execution_id)
+            self.targets[execution_id]=(target,list(args))
+            write_status(output_dir,job)
+            if self.scheduler is None:
+                self.scheduler=threading.Thread(target=self._schedule,name='job-scheduler',daemon=True)
+                self.scheduler.start()
+            self.cond.notify_all()
+            return dict(job)
+
+    def _schedule(self):
+        while True:
+            with self.cond:
+                self._reap()
+                self._start()
+                self.cond.wait(POLL_INTERVAL)
+
+    def _start(self): ## queued jobs in submission order while slots are free (lock held)
+        for execution_id,job in self.jobs.items():
+            if len(self.procs)>=self.max_jobs: break
+            if job['status']!='queued': continue
+            target,args=self.targets.pop(execution_id)
+            try:
+                proc=subprocess.Popen(job_command(target,args,job['num_threads']),
+                                      env=job_environment(job['num_threads']),
+                                      start_new_session=True) ## own process group, the tools started by the job are killed with it
+            except Exception:
+                self._finish(execution_id,'failed',None)
+                continue
+            self.procs[execution_id]=proc
+            job.update({'pid': proc.pid,'status': 'running','started_at': common.get_timestamp()})
+            write_status(job['output_dir'],job)
+
+    def _reap(self): ## finished processes (lock held)
+        for execution_id,proc in list(self.procs.items()):
+            if proc.poll() is None: continue
+            del self.procs[execution_id]
+            if self.jobs[execution_id]['status']=='killed':
+                status='killed'
+            else:
+                status='success' if proc.returncode==0 else 'failed'
+            if status!='success':
+                kill_group(proc) ## tools left behind by the job
+            self._finish(execution_id,status,proc.returncode)
+        finished=[k for k,j in self.jobs.items() if j['status'] not in ['queued','running']]
+        for execution_id in finished[:max(0,len(finished)-MAX_FINISHED)]:
+            del self.jobs[execution_id]
+
+    def _finish(self,execution_id,status,exitcode): ## (lock held)
+        job=self.jobs[execution_id]
+        job.update({'status': status,'exitcode': exitcode,'finished_at': common.get_timestamp()})
+        try:
+            write_status(job['output_dir'],job)
+        except Exception:
+            pass ## the output directory may have been removed, the job is still listed
+
+    def list(self,active_only=True): ## [job], queued and running jobs unless active_only is False
+        with self.cond:
+            return [dict(j) for j in self.jobs.values() if not active_only or j['status'] in ['queued','running']]
+
+    def get(self,execution_id):
+        with self.cond:
+            job=self.jobs.get(execution_id)
+            return dict(job) if job is not None else None
+
+    def kill(self,_id): ## _id : pid or execution id, a queued job is cancelled, returns the killed jobs
+        res=[]
+        with self.cond:
+            for execution_id,job in self.jobs.items():
+                if str(job['pid'])!=str(_id) and execution_id!=_id: continue
+                if job['status']=='queued':
+                    self.targets.pop(execution_id,None)
+                    self._finish(execution_id,'killed',None)
+                elif job['status']=='running':
+                    job['status']='killed' ## the scheduler writes the final status once the process is gone
+                    kill_group(self.procs[execution_id])
+                else:
+                    continue
+                res.append(dict(job))
+            self.cond.notify_all()
+        return res
+
+if __name__=='__main__':
+    run_job(sys.argv[1],sys.argv[2],json.loads(sys.argv[3]),int(sys.argv[4]))
@@ -20,6 +20,7 @@ color= dtiplayground.dmri.common.Color
 from dtiplayground.api.application import ApplicationAPI 
 from dtiplayground.api.dmriatlasbuilder import DMRIAtlasbuilderAPI
 from dtiplayground.api.dmriprep import DMRIPrepAPI
+from dtiplayground.api.jobqueue import JobQueue
 
 class DTIPlaygroundServer(object):
     def __init__(self,*args,**kwargs):
@@ -29,6 +30,8 @@ class DTIPlaygroundServer(object):
         kwargs.setdefault('static_url_path','/')
         kwargs.setdefault('static_folder', Path.home().joinpath('.niral-dti/static/spa'))
         kwargs.setdefault('debug', False)
+        kwargs.setdefault('max_jobs', 1) ## concurrent dmriprep/atlas builder runs
+        kwargs.setdefault('job_threads', None) ## threads per run, cores/max_jobs if None
         self.host = kwargs['host']
         self.port = kwargs['port']
         self.static_folder =kwargs['static_folder']
@@ -36,6 +39,7 @@ class DTIPlaygroundServer(object):
         self.config_dir = kwargs['config_dir']
         self.temp_directory = Path(self.config_dir).joinpath('temporary').__str__()
         self.debug=kwargs['debug']
+        self.jobqueue = JobQueue(max_jobs=kwargs['max_jobs'], job_threads=kwargs['job_threads'])
         self.app = None
 
 
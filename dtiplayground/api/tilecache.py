@@ -0,0 +1,143 @@
+##################################################################################
+### Module : tilecache.py
+### Description : Encoded slice (tile) cache for the image browsing endpoints
+###               LRU by encoded bytes, background prefetch of the neighboring tiles
+###
+###
+### Copyrights reserved by NIRAL
+##################################################################################
+
+import threading
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_BYTES=256*1024*1024 ## encoded tiles (a 256x256 jpeg is ~10KB)
+DEFAULT_PREFETCH_RADIUS=2 ## slices on each side of the requested one, +-1 gradient
+DEFAULT_MAX_PENDING=64 ## prefetches waiting in the queue, newer requests are dropped beyond this
+
+def tile_etag(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+class TileCache(object):
+    def __init__(self,max_bytes=DEFAULT_MAX_BYTES,prefetch_radius=DEFAULT_PREFETCH_RADIUS,max_pending=DEFAULT_MAX_PENDING):
+        self.lock=threading.Lock()
+        self.tiles=OrderedDict() # key -> encoded bytes, least recently used first
+        self.max_bytes=int(max_bytes)
+        self.bytes=0
+        self.prefetch_radius=int(prefetch_radius)
+        self.max_pending=int(max_pending)
+        self.pending=set() # keys submitted for prefetch
+        self.executor=None
+        self.hits=0
+        self.misses=0
+        self.prefetched=0
+        self.evictions=0
+        self.encode_count=0
+        self.encode_time=0.0
+        self.encode_time_max=0.0
+
+    def get(self,key):
+        with self.lock:
+            data=self.tiles.get(key)
+            if data is None:
+                self.misses+=1
+            else:
+                self.tiles.move_to_end(key)
+                self.hits+=1
+            return data
+
+    def put(self,key,data):
+        with self.lock:
+            if key in self.tiles: return
+            if len(data)>self.max_bytes: return
+            self.tiles[key]=data
+            self.bytes+=len(data)
+            while self.bytes>self.max_bytes:
+                _,old=self.tiles.popitem(last=False)
+                self.bytes-=len(old)
+                self.evictions+=1
+
+    def _render(self,render): ## render() -> encoded bytes, timed
+        bt=time.time()
+        data=render()
+        et=time.time()-bt
+        with self.lock:
+            self.encode_count+=1
+            self.encode_time+=et
+            self.encode_time_max=max(self.encode_time_max,et)
+        return data
+
+    def getOrRender(self,key,render): ## (bytes, hit)
+        data=self.get(key)
+        if data is not None:
+            return data,True
+        data=self._render(render)
+        self.put(key,data)
+        return data,False
+
+    def prefetch(self,requests): ## requests : [(key, render)], rendered in the background in the given order
+        with self.lock:
+            if self.executor is None:
+                self.executor=ThreadPoolExecutor(max_workers=1,thread_name_prefix='tile-prefetch')
+            todo=[]
+            for key,render in requests:
+                if key in self.tiles or key in self.pending: continue
+                if len(self.pending)>=self.max_pending: break
+                self.pending.add(key)
+                todo.append((key,render))
+        for key,render in todo:
+            self.executor.submit(self._prefetchOne,key,render)
+
+    def _prefetchOne(self,key,render):
+        try:
+            with self.lock:
+                if key in self.tiles: return
+            self.put(key,self._render(render))
+            with self.lock:
+                self.prefetched+=1
+        except Exception:
+            pass ## a failed prefetch is rendered again (and reported) when it is requested
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def invalidate(self,image_key): ## drops the tiles of an image (key[0])
+        with self.lock:
+            for key in [k for k in self.tiles.keys() if k[0]==image_key]:
+                self.bytes-=len(self.tiles.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.bytes=0
+
+    def getStatistics(self):
+        with self.lock:
+            total=self.hits+self.misses
+            return {
+                'tiles': len(self.tiles),
+                'bytes': int(self.bytes),
+                'max_bytes': int(self.max_bytes),
+                'hits': int(self.hits),
+                'misses': int(self.misses),
+                'hit_rate': float(self.hits)/total if total>0 else 0.0,
+                'prefetched': int(self.prefetched),
+                'pending_prefetches': len(self.pending),
+                'evictions': int(self.evictions),
+                'encode_count': int(self.encode_count),
+                'encode_time_mean': self.encode_time/self.encode_count if self.encode_count>0 else None,
+                'encode_time_max': float(self.encode_time_max)
+            }
+
+def neighbor_tiles(shape,grad_idx,axis_idx,slice_idx,radius): ## (grad, axis, slice) around a tile, nearest first
+    num_slices=shape[axis_idx]
+    num_grads=shape[3] if len(shape)>3 else 1
+    res=[]
+    for d in range(1,radius+1):
+        for s in [slice_idx+d,slice_idx-d]:
+            if 0<=s<num_slices: res.append((grad_idx,axis_idx,s))
+    for g in [grad_idx+1,grad_idx-1]:
+        if 0<=g<num_grads: res.append((g,axis_idx,slice_idx))
+    return res
@@ -37,7 +37,7 @@ class AtlasBuilder(object):
         global logger
         logger = self.logger.write
 
-    def configure(self,output_dir,config_path,hbuild_path,greedy_path,node=None):
+    def configure(self,output_dir,config_path,hbuild_path,greedy_path,node=None,num_cores=None): ## num_cores : cores available to the build (all cores if None)
 
         ### assertions
         assert(Path(config_path).exists())
@@ -73,6 +73,10 @@ class AtlasBuilder(object):
         tool_instances=list(map(lambda x: getattr(ext_tools,x[0])(x[1],logger=self.logger),tool_paths.items()))
         self.tools=dict(zip(tool_list,tool_instances))
         config['m_DTIRegExtraPath']=self.get_ants_path()
+        if num_cores is not None: ## nodes x threads per call <= cores, the rule case_workers follows for the cases
+            config['m_NbCores']=max(1,int(num_cores))
+            config['m_NbThreadsString']=min(max(1,int(config['m_NbThreadsString'])),config['m_NbCores'])
+            config['m_nbParallelism']=min(max(1,int(config['m_nbParallelism'])),config['m_NbCores']//config['m_NbThreadsString'])
         configPath=commonPath.joinpath('config.yml')
         yaml.dump(config,open(configPath,'w'))
 
@@ -155,41 +159,43 @@ class AtlasBuilder(object):
         ### atlas build begins (to be multiprocessed)
 
         logger("\n=============== Main Script ================")
-        ## threading
-        completedAtlases=[] #entry should be the node name 
-        runningAtlases=[] # should have length less or equal than numTheads, entry is the node name
-        failedAtlases=[]
-
-        def buildAtlas(conf,rt,ct,ft): # rt : list of running threads, ct : list of completed threads, ft: failed threads
+        ## nodes are scheduled as a DAG : a node starts as soon as its components are built, at most numProcess nodes at a time
+        nodeNames=[cfg["m_NodeName"] for cfg in buildSequence]
+        nodeConfigs=dict(zip(nodeNames,buildSequence))
+        dependencies={n:build_dependencies(hbuild,n) for n in nodeNames}
+        timings={n:{'status':'pending','started':None,'finished':None,'wall_time':None} for n in nodeNames}
+        timingPath=Path(projectPath).joinpath('common','build_timing.yml')
+        lock=threading.Lock()
+
+        def buildAtlas(name):
+            cfg=nodeConfigs[name]
+            with lock:
+                generate_results_csv(cfg)
+                timings[name].update({'status':'running','started':common.get_timestamp()})
+                write_build_timing(timingPath,timings)
+            bt=time.time()
+            status='failed'
             try:
-              prjName=conf["m_NodeName"]
-              rt.append(prjName)
-              self.preprocess(conf)
-              self.build_atlas(conf,greedy)  
-              rt.remove(prjName)
-              ct.append(prjName)
+                self.preprocess(cfg)
+                self.build_atlas(cfg,greedy)
+                status='done'
             except Exception as e:
-              logger("Exception at {}".format(str(e)))
-              msg=traceback.format_exc()
-              logger("{}".format(msg))
-              rt.remove(prjName)
-              ft.append(prjName)
-              
-
-        numNodes=len(buildSequence)
-        threads=[]
-        while len(completedAtlases) < numNodes:
-            if len(runningAtlases) < numProcess and len(buildSequence)>0:
-                if dependency_satisfied(hbuild,buildSequence[0]["m_NodeName"],completedAtlases):
-                    cfg=buildSequence.pop(0)
-                    generate_results_csv(cfg)
-                    th=threading.Thread(target=buildAtlas,args=(cfg,runningAtlases,completedAtlases,failedAtlases))
-                    threads.append(th)
-                    th.start()
-            if len(failedAtlases)>0:
-              logger("There is a failed thread.Exiting...",dtiplayground.dmri.common.Color.ERROR)
-              raise Exception("Error occurred in one of the threads")
-            time.sleep(1.0)
+                logger("Exception at {} : {}".format(name,str(e)),dtiplayground.dmri.common.Color.ERROR)
+                logger("{}".format(traceback.format_exc()))
+                raise
+            finally:
+                with lock:
+                    timings[name].update({'status':status,'finished':common.get_timestamp(),'wall_time':float(time.time()-bt)})
+                    write_build_timing(timingPath,timings)
+
+        try:
+            common.run_dag(nodeNames,dependencies,buildAtlas,num_workers=numProcess)
+        except Exception as e:
+            for n in nodeNames: ## nodes not started after the failure
+                if timings[n]['status']=='pending': timings[n]['status']='cancelled'
+            write_build_timing(timingPath,timings)
+            logger("There is a failed node ({}). Exiting...".format(str(e)),dtiplayground.dmri.common.Color.ERROR)
+            raise Exception("Error occurred in one of the threads")
 
         ## Postprocess
         self.postprocess()
@@ -259,11 +265,12 @@ class AtlasBuilder(object):
           # if not os.path.isdir(OutputPath.joinpath("Loop" + str(n)).__str__()):
           OutputPath.joinpath("Loop"+str(n)).mkdir(exist_ok=True)
           # Cases Loop
-          case= 0
+          firstCase= 0
           if config["m_RegType"]==1: 
-            case = (n==0) # (n==0) -> bool: =1(true) =0(false) : the first case is the reference for the first loop so it will not be normalized or registered (it is cropped and FAed before the loop)
+            firstCase = int(n==0) # (n==0) -> bool: =1(true) =0(false) : the first case is the reference for the first loop so it will not be normalized or registered (it is cropped and FAed before the loop)
 
-          while case < len(allcases):
+          def registerCase(case): ## cases are independent within a loop (same reference)
+            ext_tools=case_tools(self.tools,config)
             if n==0: # Filtering and Cropping DTI and Generating FA are only part of the first loop
                # Filter DTI
               # ResampleDTIlogEuclidean does by default a correction of tensor values by setting the negative values to zero
@@ -334,7 +341,8 @@ class AtlasBuilder(object):
             if overwrite or (not Path(LoopScalarMeasurement).exists()):
                 sp_out=ext_tools['DTIProcess'].measure_scalars(LinearTransDTI,LoopScalarMeasurement,scalar_type=config['m_ScalarMeasurement'])
             else: logger("=> The file \'" + LoopScalarMeasurement + "\' already exists so the command will not be executed")
-            case += 1 # indenting cases loop
+
+          map_cases(registerCase,range(firstCase,len(allcases)),allcasesIDs,num_workers=case_workers(config))
 
           # FA/MA Average of registered images with ImageMath
           # if config["m_nbLoops"]!=0:
@@ -472,8 +480,9 @@ class AtlasBuilder(object):
 
 # 3 Diffeomorphic Atlas (FinalPath)
         # Apply deformation fields 
-        case = 0
-        while case < len(allcases):
+        numCaseWorkers=case_workers(config)
+        def applyDeformation(case):
+          ext_tools=case_tools(self.tools,config)
           FinalDTI= FinalPath.joinpath(allcasesIDs[case] + "_DiffeomorphicDTI.nrrd").__str__()
           if m_NeedToBeCropped==1:
             originalDTI= AffinePath.joinpath(allcasesIDs[case] + "_croppedDTI.nrrd").__str__()
@@ -510,7 +519,8 @@ class AtlasBuilder(object):
             sp_out=ext_tools['UNU'].convert_to_float(FinalDTI,out_file)
 
           else : logger("=> The file \'" + FinalDTI + "\' already exists so the command will not be executed")
-          case += 1
+
+        map_cases(applyDeformation,range(len(allcases)),allcasesIDs,num_workers=numCaseWorkers)
 
         # DTIaverage computing
         DTIAverage = FinalPath.joinpath("DiffeomorphicAtlasDTI.nrrd").__str__()
@@ -541,10 +551,10 @@ class AtlasBuilder(object):
 
         else: logger("=> The file '" + DTIAverage + "' already exists so the command will not be executed")
 
-# 4-1 First_Resampling (FinalResampPath) - to be multi-threaded
+# 4-1 First_Resampling (FinalResampPath)
         # Computing global deformation fields
-        case = 0
-        while case < len(allcases):
+        def firstResampling(case):
+          ext_tools=case_tools(self.tools,config)
           if m_NeedToBeCropped==1:
             origDTI= AffinePath.joinpath(allcasesIDs[case] + "_croppedDTI.nrrd").__str__()
           else:
@@ -580,7 +590,8 @@ class AtlasBuilder(object):
             sp_out=ext_tools['UNU'].convert_to_float(FinalDef,out_file)
 
           else: logger("=> The file '" + FinalDef + "' already exists so the command will not be executed")
-          case += 1
+
+        map_cases(firstResampling,range(len(allcases)),allcasesIDs,num_workers=numCaseWorkers)
 
 # 4-2 Second_Resampling 
 
@@ -635,10 +646,9 @@ class AtlasBuilder(object):
 
           else: logger("=> The file '" + DTIAverage2 + "' already exists so the command will not be executed")
 
-          # Recomputing global deformation fields - to be multi-threaded
-          SecondResampRecomputed = [0] * len(allcases) # array of 1s and 0s to know what has been recomputed to know what to copy to final folders
-          case = 0
-          while case < len(allcases):
+          # Recomputing global deformation fields
+          def secondResampling(case): # returns 1 if recomputed, to know what to copy to final folders
+            ext_tools=case_tools(self.tools,config)
             if m_NeedToBeCropped==1:
               origDTI2= AffinePath.joinpath(allcasesIDs[case] + "_croppedDTI.nrrd").__str__()
             else:
@@ -647,6 +657,7 @@ class AtlasBuilder(object):
             InverseGlobalDefField2 = FinalResampPath.joinpath("Second_Resampling").joinpath(IterDir).joinpath(allcasesIDs[case] + "_InverseGlobalDisplacementField.nrrd").__str__()
             FinalDef2 = FinalResampPath.joinpath("Second_Resampling").joinpath(IterDir).joinpath(allcasesIDs[case] + "_FinalDeformedDTI.nrrd").__str__()
 
+            recomputed = 0
             BRAINSExecDir = os.path.dirname(m_SoftPath[4])
             dtiprocessExecDir = os.path.dirname(m_SoftPath[3])
             ResampExecDir = os.path.dirname(m_SoftPath[1])
@@ -657,7 +668,7 @@ class AtlasBuilder(object):
             ANTSTempFileBase = FinalResampPath.joinpath("First_Resampling").joinpath(allcasesIDs[case] + "_" + m_ScalarMeasurement + "_").__str__()
 
             if m_Overwrite==1 or not CheckFileExists(FinalDef2, case, allcasesIDs[case])  :
-              SecondResampRecomputed[case] = 1
+              recomputed = 1
               DTIRegCaseScalarMeasurement = FinalResampPath.joinpath("Second_Resampling").joinpath(IterDir).joinpath(allcasesIDs[case] + "_FinalDeformed"+m_ScalarMeasurement+".nrrd").__str__()
 
               sp_out=ext_tools['DTIReg'].compute_global_deformation_fields(
@@ -682,7 +693,9 @@ class AtlasBuilder(object):
                                                 options=['--scalar_float'])
 
             else: logger("=> The file '" + FinalDef2 + "' already exists so the command will not be executed")
-            case += 1
+            return recomputed
+
+          SecondResampRecomputed = map_cases(secondResampling,range(len(allcases)),allcasesIDs,num_workers=numCaseWorkers) # array of 1s and 0s
 
           ### Cleanup - delete PrevIterDir
           if cnt > 1:
@@ -1240,16 +1253,54 @@ def generate_directories(project_path,sequence): ## from build sequence, generat
     logger("Initial directories are generated")
 
 
-def dependency_satisfied(hb,node_name,completed_atlases):
-    if hb["build"][node_name]["type"]=="end_node": 
-        return True
+def build_dependencies(hb,node_name): ## nodes to be built before node_name
+    if hb["build"][node_name]["type"]=="end_node":
+        return []
+    return list(hb["build"][node_name]["components"])
+
+def write_build_timing(path,timings): ## per node state and wall time, rewritten on every change
+    tmp=Path(str(path)+'.tmp')
+    with open(tmp,'w') as f:
+        yaml.safe_dump(timings,f,sort_keys=False)
+    os.replace(str(tmp),str(path))
+
+THREAD_VARIABLES=['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS','OMP_NUM_THREADS']
+
+def case_workers(config): ## concurrent cases of a node, so that nodes x cases x threads per call <= cores
+    nbThreads=max(1,int(config['m_NbThreadsString']))
+    nbNodes=max(1,int(config['m_nbParallelism']))
+    nbCores=int(config.get('m_NbCores') or os.cpu_count() or 1)
+    return max(1,nbCores//(nbThreads*nbNodes))
+
+def case_tools(tools,config): ## tool instances of a case (a wrapper keeps the arguments of its call), each call limited to m_NbThreadsString threads
+    nbThreads=max(1,int(config['m_NbThreadsString']))
+    res={}
+    for name,tool in tools.items():
+        tool=copy.copy(tool)
+        tool.setEnvironment({v:nbThreads for v in THREAD_VARIABLES})
+        res[name]=tool
+    return res
+
+def map_cases(func,cases,case_ids,num_workers=1): ## [func(case)] over case indexes, a failed case does not stop the others, failures are raised together at the end
+    cases=list(cases)
+    results={}
+    failures={}
+    def _run(case):
+        try:
+            results[case]=func(case)
+        except Exception as e:
+            logger("[{}] Failed : {}\n{}".format(case_ids[case],str(e),traceback.format_exc()),common.Color.ERROR)
+            failures[case]=e
+    num_workers=max(1,min(int(num_workers),len(cases)))
+    if num_workers==1:
+        for case in cases: _run(case)
     else:
-        comps=hb["build"][node_name]["components"]
-        for c in comps:
-            if c not in completed_atlases: return False 
-        return True
-
-
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(_run,cases))
+    if len(failures)>0:
+        raise Exception("Failed cases : {}".format(", ".join(case_ids[c] for c in sorted(failures.keys()))))
+    return [results[c] for c in cases]
 
 def generate_results_csv_from_deformation_track(deformation_track,project_path): # generate final result file with deformation track file
 
@@ -1,5 +1,8 @@
 import sys
-import gc
+import os
+import weakref
+import itertools
+import threading
 import datetime,time
 import uuid
 from pathlib import Path
@@ -64,10 +67,77 @@ class Color:
 
 ### util functions 
 def object_by_id(id_):
-    for obj in gc.get_objects():
-        if id(obj) == id_:
-            return obj
-    raise Exception("No found")
+    obj=image_registry.get(id_)
+    if obj is None:
+        raise Exception("No found")
+    return obj
+
+def process_map(func,iterable,num_workers=1,max_pending=None): ## ordered map over a process pool, serial if num_workers <= 1
+    ## tasks are taken from the iterable as workers free up, at most max_pending (2 x workers) are pickled and queued at a time
+    num_workers=max(1,min(int(num_workers),os.cpu_count() or 1))
+    if hasattr(iterable,'__len__'):
+        num_workers=max(1,min(num_workers,len(iterable)))
+    if num_workers==1:
+        return [func(x) for x in iterable]
+    max_pending=max(num_workers,int(max_pending or 2*num_workers))
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+    ctx=multiprocessing.get_context('forkserver') ## workers never inherit a lock held by another thread of this process (logger, background writer), fork would
+    ctx.set_forkserver_preload(['dtiplayground.dmri.common']) ## not '__main__', the server would run the command line scripts (arguments parsed at import)
+    results=[]
+    pending=deque()
+    with ProcessPoolExecutor(max_workers=num_workers,mp_context=ctx) as executor:
+        try:
+            for x in iterable:
+                if len(pending)>=max_pending:
+                    results.append(pending.popleft().result())
+                pending.append(executor.submit(func,x))
+            while len(pending)>0:
+                results.append(pending.popleft().result())
+        except BaseException:
+            for f in pending: f.cancel()
+            raise
+    return results
+
+def run_dag(nodes,dependencies,func,num_workers=1): ## {node: func(node)}, a node starts once its dependencies are done, independent nodes run concurrently (threads), serial if num_workers <= 1
+    nodes=list(nodes)
+    waiting={n:set(dependencies.get(n,[])) for n in nodes}
+    results={}
+    def _done(node,result):
+        results[node]=result
+        for deps in waiting.values():
+            deps.discard(node)
+    def _ready():
+        return [n for n in nodes if n in waiting and len(waiting[n])==0]
+    if num_workers<=1:
+        while len(waiting)>0:
+            ready=_ready()
+            if len(ready)==0: break
+            del waiting[ready[0]]
+            _done(ready[0],func(ready[0]))
+    else:
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        running={}
+        error=None
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            while True:
+                if error is None: ## after a failure, the running nodes finish and nothing new starts
+                    for n in _ready():
+                        del waiting[n]
+                        running[executor.submit(func,n)]=n
+                if len(running)==0: break
+                finished,_=wait(list(running.keys()),return_when=FIRST_COMPLETED)
+                for f in finished:
+                    n=running.pop(f)
+                    if f.exception() is not None:
+                        error=error or f.exception()
+                    else:
+                        _done(n,f.result())
+        if error is not None: raise error
+    if len(waiting)>0:
+        raise Exception("Unresolvable dependencies : {}".format(list(waiting.keys())))
+    return results
 
 def get_timestamp():
     return datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
@@ -152,6 +222,107 @@ class AppState(object): ### software status
   def getState(self):
     return self.state 
 
+class ImageRegistry(object): ### in-process handle -> image object mapping
+    def __init__(self):
+        self.lock=threading.RLock()
+        self.objects=weakref.WeakValueDictionary() # handle -> object (weak)
+        self.handles=weakref.WeakKeyDictionary() # object -> handle (weak)
+        self.pinned={} # handle -> object (strong), released explicitly
+        self.counter=itertools.count(1)
+        self.hits=0
+        self.misses=0
+
+    def register(self,obj,pin=False):
+        with self.lock:
+            handle=self.handles.get(obj)
+            if handle is None:
+                handle=next(self.counter)
+                self.handles[obj]=handle
+                self.objects[handle]=obj
+            if pin:
+                self.pinned[handle]=obj
+            return handle
+
+    def get(self,handle):
+        with self.lock:
+            obj=None
+            if handle is not None:
+                obj=self.objects.get(handle)
+            if obj is None:
+                self.misses+=1
+            else:
+                self.hits+=1
+            return obj
+
+    def handleOf(self,obj):
+        with self.lock:
+            return self.handles.get(obj)
+
+    def release(self,handle):
+        with self.lock:
+            self.pinned.pop(handle,None)
+
+    def getStatistics(self):
+        with self.lock:
+            total=self.hits+self.misses
+            return {
+                "hits": int(self.hits),
+                "misses": int(self.misses),
+                "hit_rate": float(self.hits)/total if total>0 else 0.0,
+                "registered": len(self.objects),
+                "pinned": len(self.pinned)
+            }
+
+    def resetStatistics(self):
+        with self.lock:
+            self.hits=0
+            self.misses=0
+
+class BackgroundWriter(object): ### single background thread running file writes in submission order
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.executor=None
+        self.futures=[]
+        self.busy_time=0.0
+
+    def submit(self,func,*args,**kwargs):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor=ThreadPoolExecutor(max_workers=1,thread_name_prefix='image-writer')
+            future=self.executor.submit(self._timed,func,*args,**kwargs)
+            self.futures.append(future)
+            return future
+
+    def _timed(self,func,*args,**kwargs):
+        bt=time.time()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            self.busy_time+=time.time()-bt
+
+    def pending(self):
+        with self.lock:
+            return len([f for f in self.futures if not f.done()])
+
+    def flush(self): ## waits for all the submitted writes, raises the first failure
+        with self.lock:
+            futures,self.futures=self.futures,[]
+        errors=[f.exception() for f in futures]
+        errors=[e for e in errors if e is not None]
+        if len(errors)>0:
+            raise errors[0]
+
+    def shutdown(self):
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=True)
+                    self.executor=None
+
+
 class FileLogger(object):
     def __init__(self,filename,mode='w'):
         self.setLogfile(filename,mode)
@@ -224,4 +395,5 @@ class MultiLogger(object):
 
 
 logger=MultiLogger()
+image_registry=ImageRegistry()
 _debug=True
\ No newline at end of file
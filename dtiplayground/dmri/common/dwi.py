@@ -1,14 +1,24 @@
 
 
 import dtiplayground.dmri.common as common
+from dtiplayground.dmri.common.gradients import GradientTable, SHELL_TOLERANCE
 import numpy as np
 import nrrd
 import nibabel as nib
 
 import yaml
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 import copy
 import cv2
+import os
+import struct
+import time
+import threading
+import zlib
+import itertools
+import io
 #
 #
 # gradients are unit-vectors normalized according to b-value (nrrd), there is also normalized gradient coupled with bvalue
@@ -26,8 +36,25 @@ def normalize(v):
        return v
     return v / norm
 
-def _load_nrrd(filename):
-    org_data,header = nrrd.read(filename)
+def _memmap_nrrd(filename,header): ## memory map of a raw encoded, attached nrrd data (None if not possible)
+    if header.get('encoding','').lower() != 'raw': return None
+    if 'data file' in header or 'datafile' in header: return None
+    if int(header.get('line skip',0)) != 0: return None
+    if int(header.get('byte skip',0)) not in [0,-1]: return None
+    dtype=nrrd.reader._determine_datatype(header)
+    sizes=tuple(map(int,header['sizes']))
+    data_size=int(np.prod(sizes))*dtype.itemsize
+    offset=Path(filename).stat().st_size-data_size
+    if offset<0: return None
+    return np.memmap(filename,dtype=dtype,mode='c',offset=offset,shape=sizes,order='F')
+
+def _load_nrrd(filename,lazy=False):
+    org_data=None
+    if lazy:
+        header=nrrd.read_header(str(filename))
+        org_data=_memmap_nrrd(filename,header)
+    if org_data is None:
+        org_data,header = nrrd.read(filename)
     
     ## dimension checkout
     kinds=[]
@@ -124,6 +151,8 @@ def _load_nrrd(filename):
                               'original_index':idx,
                               'nifti_gradient':nifti_grad.tolist()})
     gradients=sorted(gradients,key=lambda x: x['index'])
+    if lazy:
+        return data,gradients,info , (None,header)
     return data,gradients,info , (org_data,header)
 
 def _load_nifti_bvecs(filename):
@@ -139,7 +168,7 @@ def _load_nifti_bvecs(filename):
     else:
         return list(chunks(content.split(),3))
 
-def _load_nifti(filename,bvecs_file=None,bvals_file=None):
+def _load_nifti(filename,bvecs_file=None,bvals_file=None,lazy=False):
     parent_dir=Path(filename).parent
     if bvals_file is None: bvals_file=parent_dir.joinpath(Path(Path(filename).stem).stem+'.bval')
     if bvecs_file is None: bvecs_file=parent_dir.joinpath(Path(Path(filename).stem).stem+'.bvec')
@@ -151,8 +180,18 @@ def _load_nifti(filename,bvecs_file=None,bvals_file=None):
     
     loaded_image_object= nib.load(filename)
     header=loaded_image_object.header
-    org_data=loaded_image_object.get_fdata().astype(np.dtype(header.get_data_dtype()))
-    image_dim = len(org_data.shape)
+    proxy=None
+    if lazy:
+        proxy=loaded_image_object.dataobj
+        org_data=None
+        if '.gz' not in str(filename).lower(): ## uncompressed, memory mapped (copy-on-write) unless scaled
+            org_data=np.asanyarray(proxy)
+            proxy=None
+        shape=tuple(loaded_image_object.shape)
+    else:
+        org_data=loaded_image_object.get_fdata().astype(np.dtype(header.get_data_dtype()))
+        shape=org_data.shape
+    image_dim = len(shape)
     gradients=None
 
     ## extract gradients with form {'index': , 'gradient': }
@@ -208,11 +247,11 @@ def _load_nifti(filename,bvecs_file=None,bvals_file=None):
 
     info={
         'space': space,
-        'dimension': len(data.shape),
-        'sizes': np.array(data.shape).tolist(),
+        'dimension': len(shape),
+        'sizes': np.array(shape).tolist(),
         "original_kinds": ['space','space','space','list'][:image_dim],
         "original_kinds_space" : [True,True,True,False][:image_dim], ## image space = True, gradient dim = False
-        'image_size' : np.array(data.shape[0:3]).tolist(),
+        'image_size' : np.array(shape[0:3]).tolist(),
         'b_value': float(max_bval),
         'space_directions': space_directions.tolist(),
         'measurement_frame': np.identity(3).tolist(), ## this needs to be clarified for nifti
@@ -226,17 +265,56 @@ def _load_nifti(filename,bvecs_file=None,bvals_file=None):
 
 
 
+    if lazy:
+        return (data if proxy is None else proxy), gradients, info, (None,affine,header)
     return data, gradients, info, (org_data,affine,header)
 
-def _load_dwi(filename, filetype='nrrd'):
+def _load_dwi(filename, filetype='nrrd', lazy=False):
     if filetype.lower()=='nrrd': ## load nrrd dwi image
-        return _load_nrrd(filename)
+        return _load_nrrd(filename,lazy=lazy)
     elif filetype.lower()=='nifti':
-        return _load_nifti(filename)
+        return _load_nifti(filename,lazy=lazy)
     else:
         logger("Not a supported image type",common.Color.ERROR)
         return None
 
+def get_affine_matrix_by_space(information,target_space="right-anterior-superior"): #target_space left/right, posterior/anterior, inferior/superior e.g. lef-posterior-superior
+    space=information['space']
+    space_directions=copy.copy(information['space_directions'])
+    spdir=copy.copy(np.array(space_directions))
+    space_origin=np.array(information['space_origin'])
+    affine=np.zeros((4,4))
+    affine[0:3,0:3] = spdir[0:3,0:3]
+    affine[3,0:4] = np.array([[0,0, 0, 1]])
+    affine[0:3,3] = np.array([space_origin])
+    src_space_elem = space.split('-')
+    target_space_elem = target_space.split('-')
+    diag_elements = [1,1,1,1]
+    for i,v in enumerate(target_space_elem):
+        if v != src_space_elem[i]:
+            diag_elements[i]=-1
+    ijk_to_lps = affine
+    src_to_tgt = np.diag(diag_elements)
+    ijk_to_ras = np.matmul(src_to_tgt, ijk_to_lps)
+    affine=ijk_to_ras
+    return affine
+
+def _histogram_percentiles(hist,edges,percentiles): ## percentiles (linear interpolation within a bin) from a histogram
+    cum=np.cumsum(hist)
+    total=cum[-1]
+    out=[]
+    for q in percentiles:
+        if total==0:
+            out.append(float(edges[0]))
+            continue
+        rank=q/100.0*total
+        b=int(np.searchsorted(cum,rank,side='left'))
+        b=min(b,len(hist)-1)
+        below=cum[b-1] if b>0 else 0
+        frac=(rank-below)/hist[b] if hist[b]>0 else 0.0
+        out.append(float(edges[b]+frac*(edges[b+1]-edges[b])))
+    return out
+
 def get_nrrd_gradient_axis(kinds):
     grad_axis=0
     for idx,k in enumerate(kinds):
@@ -246,15 +324,33 @@ def get_nrrd_gradient_axis(kinds):
 
 
 
-def export_to_nrrd(image): #image : DWI
-    info=copy.copy(image.information)
+### write policies : how the voxel data is encoded on the disk
+##   raw           : no compression (fastest, intermediates, memory-mappable with lazy loading)
+##                   a .nii.gz name still gets a gzip stream (level 0), use .nrrd or .nii for memory-mappable outputs
+##   gzip-fast     : gzip level 1
+##   gzip          : gzip level 9, single thread (default, previous behavior)
+##   gzip-parallel : gzip level 6 compressed by blocks in threads (single gzip member, readable by any reader)
+WRITE_POLICIES={
+    'raw'           : {'encoding': 'raw' , 'level': 0, 'threads': 1},
+    'gzip-fast'     : {'encoding': 'gzip', 'level': 1, 'threads': 1},
+    'gzip'          : {'encoding': 'gzip', 'level': 9, 'threads': 1},
+    'gzip-parallel' : {'encoding': 'gzip', 'level': 6, 'threads': None},
+}
+DEFAULT_WRITE_POLICY='gzip'
+_GZIP_BLOCK_SIZE=2**24
+_EXPORT_CHUNK_BYTES=2**26
+
+def export_to_nrrd(image,dtype=None,chunk_bytes=_EXPORT_CHUNK_BYTES): #image : DWI, returns the header and a generator of the data (bytes-like chunks in the file order), image is left untouched
+    info=image.information
     grad=image.getGradients()
-    new_data=copy.copy(image.images)
+    source=image._volumeSource() ## lazy images and pending exclusions are read by chunks
+    if dtype is None: dtype=info['type']
+    dtype=np.dtype(dtype)
     grad_axis_original=get_nrrd_gradient_axis(info['original_kinds'])
     grad_axis=-1
     
-    space_directions=info['space_directions']
-    if image.information['dimension']>3:
+    space_directions=list(info['space_directions'])
+    if info['dimension']>3:
         space_directions.append([np.NAN,np.NAN,np.NAN])
         space_directions_grad_axis=space_directions[grad_axis]
         space_directions=np.insert(space_directions,
@@ -266,17 +362,18 @@ def export_to_nrrd(image): #image : DWI
         
 
     new_header={
-        "type": info['type'],
+        "type": nrrd.writer._TYPEMAP_NUMPY2NRRD[dtype.str[1:]],
         "dimension": info['dimension'],
         "space":  info['space'],
         "sizes":  info['sizes'],
         "space directions": space_directions,
         "kinds": info['original_kinds'],
-        "endian" : info['endian'],
         "encoding" : 'gzip',
         "space origin" : info['space_origin'],
         "measurement frame": info['measurement_frame']
     }
+    if dtype.itemsize > 1:
+        new_header['endian']=nrrd.writer._NUMPY2NRRD_ENDIAN_MAP[dtype.str[:1]]
     if 'modality' in info:
         new_header['modality']=info['modality']
     else:
@@ -291,26 +388,38 @@ def export_to_nrrd(image): #image : DWI
         new_header['thicknesses']= info['thicknesses']
 
 
-    s=list(new_data.shape)
-    new_header['dimension']=len(new_data.shape)
-    if new_header['dimension'] > 3:
-        g=s[grad_axis]
-        s=s[:grad_axis]+s[grad_axis:-1]
-        s=s[:grad_axis_original]+[g]+s[grad_axis_original:]
-    new_header['sizes']=s
-
-    copy_hdr=copy.copy(new_header)
-    for k,v in copy_hdr.items():    
-        if 'dwmri_gradient' in k.lower():
-            del new_header[k]
+    s=list(source.shape)
+    new_header['dimension']=len(s)
+    move_axis=None
     if new_header['modality']=='DWMRI':
         for idx,g in enumerate(grad):
             k="DWMRI_gradient_{:04d}".format(idx)
             new_header[k]=" ".join([str(x) for x in g['gradient']])
         if new_header['dimension'] > 3:
-            new_data=np.moveaxis(new_data,grad_axis,grad_axis_original)
-    new_data=new_data.astype(new_header['type'])
-    return new_data,new_header 
+            move_axis=grad_axis_original
+    if move_axis is not None:
+        g=s[grad_axis]
+        s=s[:grad_axis]+s[grad_axis:-1]
+        s=s[:grad_axis_original]+[g]+s[grad_axis_original:]
+    new_header['sizes']=s
+    return new_header, _nrrd_data_chunks(source,move_axis,dtype,chunk_bytes)
+
+def _nrrd_data_chunks(source,move_axis,dtype,chunk_bytes): ## casts and reorders slabs along the slowest (last in the file) axis, one slab in memory at a time
+    ndim=len(source.shape)
+    split_axis=ndim-1
+    if move_axis is not None and move_axis!=ndim-1: ## gradient axis moves inside, the last output axis is the last spatial one
+        split_axis=ndim-2
+    n=source.shape[split_axis]
+    slice_bytes=max(1,int(np.prod(source.shape))//max(n,1)*dtype.itemsize)
+    step=max(1,chunk_bytes//slice_bytes)
+    for i in range(0,n,step):
+        idx=[slice(None)]*ndim
+        idx[split_axis]=slice(i,i+step)
+        slab=np.asarray(source[tuple(idx)])
+        if move_axis is not None:
+            slab=np.moveaxis(slab,-1,move_axis)
+        slab=slab.astype(dtype,order='F')
+        yield memoryview(slab.ravel(order='F')).cast('B')
 
 
 def flipY(x):
@@ -327,20 +436,113 @@ def export_to_nifti(image): # image DWI
     bvecs=[" ".join(map(lambda s : "{:.8f}".format(s),x['nifti_gradient']))+"\n" for x in gradients]
     return img,affine, bvals, bvecs
 
-def _write_nrrd(image,filename,dtype): 
-    image.information['type']=dtype
-    data,header = export_to_nrrd(image)
-    return nrrd.write(filename,data,header=header)
-
-def _write_nifti(image,filename,dtype): #image : DWI
-    data,affine,bvals,bvecs=export_to_nifti(image)
+def get_write_policy(policy=None):
+    if policy is None: policy=DEFAULT_WRITE_POLICY
+    if policy not in WRITE_POLICIES:
+        raise Exception("Unknown write policy : {} (available : {})".format(policy,", ".join(WRITE_POLICIES.keys())))
+    return WRITE_POLICIES[policy]
+
+def _deflate_block(block,level):
+    compressor=zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+    return compressor.compress(block)+compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def split_blocks(raw,block_size=_GZIP_BLOCK_SIZE):
+    raw=memoryview(raw).cast('B')
+    for i in range(0,len(raw),block_size):
+        yield raw[i:i+block_size]
+
+def write_gzip(fh,blocks,level=6,num_threads=None): ## blocks : bytes-like iterable, with several threads blocks are deflated independently (zlib releases the GIL) and chained into one gzip member
+    if num_threads is None: num_threads=os.cpu_count() or 1
+    if num_threads==1:
+        compressor=zlib.compressobj(level,zlib.DEFLATED,zlib.MAX_WBITS | 16)
+        for block in blocks:
+            fh.write(compressor.compress(block))
+        fh.write(compressor.flush())
+        return
+    fh.write(b'\x1f\x8b\x08\x00'+struct.pack('<I',int(time.time()))+b'\x00\xff')
+    crc=0
+    size=0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending=deque()
+        for block in blocks:
+            pending.append(executor.submit(_deflate_block,block,level))
+            crc=zlib.crc32(block,crc)
+            size+=len(block)
+            while len(pending)>2*num_threads: ## bounded number of blocks in memory
+                fh.write(pending.popleft().result())
+        while len(pending)>0:
+            fh.write(pending.popleft().result())
+    fh.write(zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS).flush(zlib.Z_FINISH)) ## empty final block
+    fh.write(struct.pack('<II',crc&0xffffffff,size&0xffffffff))
+
+def _write_nrrd_header(fh,header): ## same layout as pynrrd.write
+    fh.write(b'NRRD0005\n')
+    fh.write(b'# This NRRD file was generated by pynrrd\n')
+    fh.write(b'# Complete NRRD file format specification at:\n')
+    fh.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+    fields=[f for f in nrrd.writer._NRRD_FIELD_ORDER if f in header]
+    custom_fields=[f for f in header.keys() if f not in fields]
+    for f in fields+custom_fields:
+        value=nrrd.writer._format_field_value(header[f],nrrd.reader._get_field_type(f,None))
+        delimiter=':=' if f in custom_fields else ': '
+        fh.write('{}{}{}\n'.format(f,delimiter,value).encode('ascii'))
+    fh.write(b'\n')
+
+def _write_nrrd(image,filename,dtype,policy=None): ## streams the data to the file, peak overhead is a few chunks
+    policy=get_write_policy(policy)
+    chunk_bytes=_GZIP_BLOCK_SIZE if policy['threads']!=1 else _EXPORT_CHUNK_BYTES
+    header,chunks = export_to_nrrd(image,dtype=dtype,chunk_bytes=chunk_bytes)
+    header['encoding']=policy['encoding']
+    with open(filename,'wb') as fh:
+        _write_nrrd_header(fh,header)
+        if policy['encoding']=='gzip':
+            write_gzip(fh,chunks,level=policy['level'],num_threads=policy['threads'])
+        else:
+            for chunk in chunks:
+                fh.write(chunk)
+
+def _nifti_header(shape,dtype,affine): ## header of a nifti-1 single file, same fields as nib.save of an array of this shape and dtype
+    stub=nib.Nifti1Image(np.broadcast_to(np.zeros((),dtype=dtype),shape),affine) ## no voxel memory
+    stub.update_header()
+    header=stub.header
+    header.set_slope_inter(1.0,0.0) ## data is written in its dtype, no scaling
+    return header
+
+def _nifti_header_bytes(header): ## header, extensions and padding up to the data offset, as written by nibabel
+    buf=io.BytesIO()
+    header.write_to(buf) ## sets the data offset of a single file
+    return buf.getvalue()+b'\x00'*max(0,int(header.get_data_offset())-buf.tell())
+
+def _write_nifti(image,filename,dtype,policy=None): #image : DWI, compression follows the file extension (.nii.gz)
+    ## with a policy, header and data chunks are streamed to the file (gzip for .nii.gz), peak overhead is a few chunks
+    ## raw policy on a .nii.gz name : the name requires gzip, the data is stored in gzip at level 0 (uncompressed, not memory-mappable)
     out_dir=Path(filename).parent
     filename_stem=Path(filename).name.split('.')[0]
     bvals_filename=out_dir.joinpath(filename_stem+".bval")
     bvecs_filename=out_dir.joinpath(filename_stem+".bvec")
-    data=data.astype(dtype)
-    out_image_object=nib.Nifti1Image(data,affine)
-    nib.save(out_image_object,str(filename))
+    if policy is not None:
+        policy=get_write_policy(policy)
+        affine=image.getAffineMatrixForNifti()
+        gradients=image.getGradients()
+        bvals=["{:d}\n".format(int(round(x['b_value']))) for x in gradients]
+        bvecs=[" ".join(map(lambda s : "{:.8f}".format(s),x['nifti_gradient']))+"\n" for x in gradients]
+        source=image._volumeSource()
+        dtype=np.dtype(dtype)
+        chunk_bytes=_GZIP_BLOCK_SIZE if policy['threads']!=1 else _EXPORT_CHUNK_BYTES
+        header=_nifti_header(tuple(source.shape),dtype,affine)
+        header_bytes=_nifti_header_bytes(header)
+        chunks=itertools.chain([header_bytes],_nrrd_data_chunks(source,None,dtype,chunk_bytes)) ## nifti order : fortran, gradients last
+        with open(str(filename),'wb') as fh:
+            if str(filename).lower().endswith('.gz'):
+                write_gzip(fh,chunks,level=policy['level'],num_threads=policy['threads'])
+            else:
+                for chunk in chunks:
+                    fh.write(chunk)
+    else:
+        data,affine,bvals,bvecs=export_to_nifti(image)
+        data=data.astype(dtype)
+        out_image_object=nib.Nifti1Image(data,affine)
+        nib.save(out_image_object,str(filename))
     ## wrting bvals, bvecs
     with open(bvals_filename.__str__(),'w') as f:
         f.writelines(bvals)
@@ -348,18 +550,175 @@ def _write_nifti(image,filename,dtype): #image : DWI
         f.writelines(bvecs)
 
 
-def _write_dwi(filename,image , dest_type='nrrd',dtype='short'): ## image : image object (common.dwi.DWI)
+def _write_dwi(filename,image , dest_type='nrrd',dtype='short',policy=None): ## image : image object (common.dwi.DWI)
     if dest_type.lower()=='nrrd': ## load nrrd dwi image
-        return _write_nrrd(image,filename,dtype=dtype)
+        return _write_nrrd(image,filename,dtype=dtype,policy=policy)
     elif dest_type.lower()=='nifti':
-        return _write_nifti(image, filename,dtype=dtype)
+        return _write_nifti(image, filename,dtype=dtype,policy=policy)
     else:
         logger("Not a supported image type",common.Color.ERROR)
         raise Exception("Not a supported image type")
         return False
     
+### volume edit statistics : exclusions/insertions recorded on the active-volume index instead of copying the 4D array
+_volume_edit_statistics={'deferred_edits': 0, 'compactions': 0, 'bytes_deferred': 0, 'bytes_compacted': 0}
+_volume_edit_lock=threading.Lock() ## images of concurrent input chains update the counters
+
+def _count_volume_edit(**increments):
+    with _volume_edit_lock:
+        for k,v in increments.items():
+            _volume_edit_statistics[k]+=v
+
+def get_volume_edit_statistics():
+    with _volume_edit_lock:
+        stats=dict(_volume_edit_statistics)
+    stats['copies_avoided']=max(0,stats['deferred_edits']-stats['compactions'])
+    stats['bytes_avoided']=max(0,stats['bytes_deferred']-stats['bytes_compacted'])
+    return stats
+
+def reset_volume_edit_statistics():
+    with _volume_edit_lock:
+        for k in _volume_edit_statistics.keys():
+            _volume_edit_statistics[k]=0
+
+class _ActiveVolumes(object): ## array-like view of the active volumes of a DWI (for slab reads without compaction)
+    def __init__(self,image):
+        self.image=image
+        self.shape=image.getShape()
+        self.dtype=image._physicalSource().dtype
+
+    def __getitem__(self,index): ## index : 3 spatial slices and a slice/indexes of the active volumes
+        spatial=tuple(index[:3])
+        entries=np.asarray(self.image._active[index[3]]).reshape(-1)
+        slab=np.asarray(self.image._physicalSource()[spatial+(slice(None),)])
+        out=np.empty(slab.shape[:3]+(len(entries),),dtype=self.dtype)
+        physical=entries>=0
+        out[...,physical]=np.take(slab,entries[physical],axis=3)
+        for idx in np.flatnonzero(~physical):
+            out[...,idx]=self.image._inserted[-entries[idx]-1][spatial]
+        return out
+
+PYRAMID_LEVELS=3 ## display levels : full resolution, 1/2 and 1/4 in plane
+DISPLAY_MAX_BYTES=512*1024*1024 ## display volumes kept per image, least recently used dropped first (rebuilt on request)
+
+def _downsample_in_plane(vol): ## [slice, rows, columns] -> 2x2 block means of each slice (odd edges are replicated)
+    n,rows,cols=vol.shape
+    if rows%2 or cols%2:
+        vol=np.pad(vol,((0,0),(0,rows%2),(0,cols%2)),mode='edge')
+    out=vol.reshape(n,vol.shape[1]//2,2,vol.shape[2]//2,2).mean(axis=(2,4))
+    return np.ascontiguousarray(np.rint(out).astype(vol.dtype))
+
+class _DisplayVolumes(object): ## display representation of a DWI : per (axis, gradient) volumes reoriented once, a slice is a contiguous 2D array
+    def __init__(self,image,max_bytes=DISPLAY_MAX_BYTES):
+        self.image=image
+        self.lock=threading.Lock() # volumes and byte count
+        self.build_lock=threading.Lock()
+        self.shape=image.getShape()
+        stats=image.getStatistics()
+        self.vmin=stats['min']
+        vrange=stats['max']-stats['min']
+        if np.issubdtype(image._physicalSource().dtype,np.integer) and vrange<2**16: ## exact (offset only)
+            self.scale=1.0
+            self.dtype=np.uint8 if vrange<2**8 else np.uint16
+        else:
+            self.scale=(2**16-1)/vrange if vrange>0 else 1.0
+            self.dtype=np.uint16
+        self.orientations=[image._sliceOrientation(axis_idx) for axis_idx in range(3)] ## (flip rows, flip columns) after the transpose
+        self.dsizes=[self._displaySize(axis_idx) for axis_idx in range(3)] ## cv2 dsize (width, height) of the displayed slices
+        self.volumes=OrderedDict() # (axis, gradient, level) -> [slice, rows, columns], least recently used first
+        self.bytes=0
+        self.max_bytes=int(max_bytes)
+        self.luts={} # display range -> lookup table of the stored values
+
+    def _displaySize(self,axis_idx): ## same aspect correction as getImageSlice4D
+        spacing=np.array(list(map(lambda x : np.max(np.abs(x)), self.image.information['space_directions'])))
+        others=[x for x in range(3) if x!=axis_idx]
+        spacing_crop=np.array([spacing[x] for x in others])
+        factors=spacing_crop/np.max(spacing_crop)
+        rows,cols=self.shape[others[0]],self.shape[others[1]]
+        return (int(rows/factors[1]),int(cols/factors[0]))
+
+    def _buildVolume(self,axis_idx,grad_idx): ## full resolution level
+        vol=np.asarray(self.image.getVolume(grad_idx))
+        vol=np.rint((vol-self.vmin)*self.scale) if self.scale!=1.0 else (vol-self.vmin)
+        vol=np.clip(vol,0,np.iinfo(self.dtype).max).astype(self.dtype)
+        vol=np.transpose(np.moveaxis(vol,axis_idx,0),(0,2,1))
+        flip_rows,flip_cols=self.orientations[axis_idx]
+        if flip_rows: vol=vol[:,::-1,:]
+        if flip_cols: vol=vol[:,:,::-1]
+        return np.ascontiguousarray(vol)
+
+    def getVolume(self,axis_idx,grad_idx,level=0): ## [slice, rows, columns] in the stored dtype, level l is downsampled 2^l in plane, built on the first request
+        key=(int(axis_idx),int(grad_idx),int(level))
+        with self.lock:
+            vol=self.volumes.get(key)
+            if vol is not None:
+                self.volumes.move_to_end(key)
+                return vol
+        finer=self.getVolume(axis_idx,grad_idx,level-1) if level>0 else None
+        with self.build_lock: ## one build at a time, lookups of the built volumes go on meanwhile
+            with self.lock:
+                vol=self.volumes.get(key)
+            if vol is not None: return vol
+            vol=self._buildVolume(axis_idx,grad_idx) if finer is None else _downsample_in_plane(finer)
+            with self.lock:
+                self.volumes[key]=vol
+                self.bytes+=vol.nbytes
+                while self.bytes>self.max_bytes and len(self.volumes)>1: ## the requested volume is always kept
+                    _,old=self.volumes.popitem(last=False)
+                    self.bytes-=old.nbytes
+        return vol
+
+    def getSlice(self,axis_idx,slice_idx,grad_idx,level=0): ## contiguous view, stored values (value-vmin)*scale
+        return self.getVolume(axis_idx,grad_idx,level)[int(slice_idx)]
+
+    def outputSize(self,axis_idx,size=None): ## cv2 dsize of a displayed slice, fitted in size x size if given
+        width,height=self.dsizes[axis_idx]
+        if size is None or max(width,height)<=size:
+            return width,height
+        ratio=float(size)/max(width,height)
+        return max(1,int(round(width*ratio))),max(1,int(round(height*ratio)))
+
+    def levelFor(self,axis_idx,size=None): ## coarsest level still as large as the output slice
+        if size is None: return 0
+        width,height=self.outputSize(axis_idx,size)
+        others=[x for x in range(3) if x!=axis_idx]
+        rows,cols=self.shape[others[1]],self.shape[others[0]] ## displayed (transposed) slice
+        level=0
+        while level+1<PYRAMID_LEVELS:
+            rows,cols=(rows+1)//2,(cols+1)//2
+            if rows<height or cols<width: break
+            level+=1
+        return level
+
+    def getLookupTable(self,display_range): ## stored value -> display value (float32, saturated after the resize), same windowing as getImageSlice4D
+        key=(float(display_range[0]),float(display_range[1]))
+        lut=self.luts.get(key)
+        if lut is None:
+            mn,mx=key
+            values=self.vmin+np.arange(np.iinfo(self.dtype).max+1,dtype=float)/self.scale
+            values=(values>=mn)*values
+            values[values>=mx]=mx
+            lut=((values-mn)/(mx-mn)*255).astype(np.float32)
+            if len(self.luts)>16: self.luts.clear()
+            self.luts[key]=lut
+        return lut
+
+    def render(self,axis_idx,slice_idx,grad_idx,display_range,size=None): ## uint8 displayed slice, size : largest side of the output (None for the full resolution)
+        level=self.levelFor(axis_idx,size)
+        out=self.getLookupTable(display_range)[self.getSlice(axis_idx,slice_idx,grad_idx,level)]
+        width,height=self.outputSize(axis_idx,size)
+        if (height,width)!=out.shape:
+            shrink=size is not None and width*height<out.shape[0]*out.shape[1]
+            out=cv2.resize(out,dsize=[width,height],interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+        return np.clip(np.rint(out),0,255).astype(np.uint8)
+
+    def nbytes(self):
+        with self.lock:
+            return int(self.bytes)
+
 class DWI:
-    def __init__(self,filename=None,b0_threshold=10,filetype=None,**kwargs):
+    def __init__(self,filename=None,b0_threshold=10,filetype=None,lazy=False,**kwargs):
         ## file information
         kwargs.setdefault('logger',common.logger);
         self.logger = kwargs['logger']
@@ -369,8 +728,16 @@ class DWI:
         self.filename=filename
         
         ## Processed data 
+        self._images=None
+        self._image_proxy=None #lazy mode, on-disk array proxy (materialized on the first access of self.images)
+        self._active=None #active-volume index over the physical volumes (None : all), negative entries refer to self._inserted
+        self._inserted=[] #volumes inserted since the last compaction
+        self._statistics=None #cached intensity statistics (display ranges), computed on request
+        self._display=None #display representation (_DisplayVolumes), built on request
+        self._display_lock=threading.Lock() #held while the display representation of this image is created
+        self.lazy=lazy #lazy mode keeps on-disk dtype and memory-maps the file when possible
         self.images=None #image tensors [ size x, size y, size z , gradient index]
-        self.gradients=None #gradient {'index': , 'gradient' : }
+        self._gradient_table=None #GradientTable, exposed as a list of gradient dicts {'index': , 'gradient' : } by self.gradients
         self.information=None #other image information such as b value , origin, ...
         self.b0_threshold=b0_threshold
         
@@ -381,18 +748,126 @@ class DWI:
         ## load image
         if self.filename is not None:
             self.loadImage(self.filename,self.image_type)
-        
+
+    @property
+    def images(self):
+        if self._active is not None:
+            self.compact()
+        if self._images is None and self._image_proxy is not None:
+            logger("Materializing image array from {}".format(self.filename),common.Color.PROCESS)
+            self._images=np.asanyarray(self._image_proxy)
+            self._image_proxy=None
+        return self._images
+
+    @images.setter
+    def images(self,img):
+        self._images=img
+        self._image_proxy=None
+        self._active=None
+        self._inserted=[]
+        self._statistics=None
+        self._display=None
+
+    @property
+    def gradients(self): ## list-of-dicts view of the gradient table (same list until the table or the threshold changes)
+        if self._gradient_table is None:
+            return None
+        return self._gradient_table.toDicts(self.b0_threshold)
+
+    @gradients.setter
+    def gradients(self,gradients): ## list of gradient dicts or GradientTable
+        if gradients is None:
+            self._gradient_table=None
+        else:
+            self._gradient_table=GradientTable.fromDicts(gradients)
+
+    def getGradientTable(self):
+        return self._gradient_table
+
+    def getShellIndex(self,tolerance=SHELL_TOLERANCE): ## b-value shells (gradients.ShellIndex), cached until the gradients change
+        return self._gradient_table.shellIndex(tolerance)
+
+    def isMaterialized(self):
+        return self._image_proxy is None
+
+    def getResidentBytes(self): ## bytes of image data held in memory (memory-mapped and on-disk data are not counted)
+        total=0
+        source=self._physicalSource()
+        if isinstance(source,np.ndarray) and not isinstance(source,np.memmap):
+            total+=source.nbytes
+        for vol in self._inserted:
+            total+=vol.nbytes
+        if self._display is not None:
+            total+=self._display.nbytes()
+        return int(total)
+
+    def _physicalSource(self): ## physical 4D array (or on-disk proxy), including the excluded volumes
+        if self._images is None and self._image_proxy is not None:
+            return self._image_proxy
+        return self._images
+
+    def _volumeSource(self): ## array-like of the active volumes, without compaction
+        if self._active is not None:
+            return _ActiveVolumes(self)
+        return self._physicalSource()
+
+    def _resolveVolume(self,grad_idx): ## (4D physical source, physical index) or (inserted 3D volume, None)
+        if self._active is not None:
+            return self._resolveEntry(self._active[int(grad_idx)])
+        return self._physicalSource(),int(grad_idx)
+
+    def _resolveEntry(self,entry): ## entry of the active-volume index
+        entry=int(entry)
+        if entry<0:
+            return self._inserted[-entry-1],None
+        return self._physicalSource(),entry
+
+    def getShape(self):
+        source=self._physicalSource()
+        if source is None:
+            return None
+        if self._active is not None:
+            return tuple(source.shape[:3])+(len(self._active),)
+        return tuple(source.shape)
+
+    def getVolume(self,grad_idx): ## single gradient volume, read on demand in lazy mode
+        vol,gidx=self._resolveVolume(grad_idx)
+        if gidx is None:
+            return vol
+        return np.asanyarray(vol[:,:,:,gidx])
+
+    def getVolumes(self,grad_indexes:list):
+        if self._active is not None:
+            return np.stack([self.getVolume(gidx) for gidx in grad_indexes],axis=-1)
+        if self._images is None and self._image_proxy is not None:
+            x,y,z,_ = self.getShape()
+            out=np.empty((x,y,z,len(grad_indexes)),dtype=self._image_proxy.dtype)
+            for idx,gidx in enumerate(grad_indexes):
+                out[:,:,:,idx]=self.getVolume(gidx)
+            return out
+        return self._images[:,:,:,grad_indexes]
+
+    def promote(self,dtype=float): ## promote on-disk dtype (lazy mode) to float for the computations
+        if self.images is not None and self.images.dtype != np.dtype(dtype):
+            self.images=np.asarray(self.images,dtype=dtype)
+        return self.images
+
+    def snapshot(self): ## frozen view for deferred writes : voxel arrays and gradient table are shared (never modified in place), information is copied
+        snap=copy.copy(self)
+        snap.information=copy.deepcopy(self.information)
+        return snap
+
     def __getitem__(self,index):
-        return self.images[index,:,:,:], self.gradients[index]
+        return self.getVolume(index), self.gradients[index]
     def __len__(self):
-        return len(self.gradients)
+        return len(self._gradient_table)
     
     def copyFrom(self,dwi,image=False,gradients=False):
         self.filename = dwi.filename
         if image:
             self.images=dwi.images
         if gradients:
-            self.gradients=dwi.gradients
+            self.gradients=dwi.getGradientTable()
         self.information = dwi.information
         self.image_type = dwi.image_type
         self.oritinal_data = dwi.original_data
@@ -406,7 +881,7 @@ class DWI:
                 temp_ngrads = img.images.shape[-1]
                 num_grads = num_grads + temp_ngrads
                 merged.images = np.concatenate((merged.images,img.images),axis=-1)
-                merged.gradients = merged.gradients+img.gradients
+                merged.gradients = GradientTable.concatenate([merged.getGradientTable(),img.getGradientTable()])
         logger('Images merged',common.Color.OK)
         return merged
 
@@ -427,56 +902,148 @@ class DWI:
         self.gradients=[]
 
     @common.measure_time
-    def writeImage(self,filename,dest_type=None,dtype='short'):
+    def writeImage(self,filename,dest_type=None,dtype='short',policy=None): ## policy : write policy name (WRITE_POLICIES), None for DEFAULT_WRITE_POLICY
         if not dest_type:
             if '.nrrd' in filename.lower(): 
                 dest_type='nrrd'
             if '.nii' in filename.lower(): 
                 dest_type='nifti'
         
-        logger("Writing image {} to : {}".format(dest_type,str(filename)),common.Color.PROCESS)
-        _write_dwi(filename,self,dest_type=dest_type,dtype=dtype)
+        logger("Writing image {} to : {} (policy : {})".format(dest_type,str(filename),policy or DEFAULT_WRITE_POLICY),common.Color.PROCESS)
+        _write_dwi(filename,self,dest_type=dest_type,dtype=dtype,policy=policy)
         logger("Image written.",common.Color.OK)
 
     @common.measure_time
-    def loadImage(self,filename,filetype=None):
+    def loadImage(self,filename,filetype=None,lazy=None):
         # print(self.filename)
         if '.nrrd' in filename.lower(): self.image_type='nrrd'
         if '.nii' in filename.lower(): self.image_type='nifti'
         if filetype is not None:
             self.image_type=filetype
-        self.images,self.gradients,self.information ,self.original_data = _load_dwi(filename,self.image_type)
-        self.images = self.images.astype(float)
-        logger("Image - {} loaded".format(self.filename),common.Color.OK,terminal_only=True)
+        if lazy is not None:
+            self.lazy=lazy
+        images,self.gradients,self.information ,self.original_data = _load_dwi(filename,self.image_type,lazy=self.lazy)
+        if self.lazy:
+            if isinstance(images,np.ndarray):
+                self.images=images
+            else:
+                self.images=None
+                self._image_proxy=images
+            logger("Image - {} loaded (lazy, {})".format(self.filename,self.information['type']),common.Color.OK,terminal_only=True)
+        else:
+            self.images = images.astype(float)
+            logger("Image - {} loaded".format(self.filename),common.Color.OK,terminal_only=True)
+        ## display ranges are deferred to the first request (getStatistics/computeDisplayRanges)
+        self.information.pop('display_range',None)
+        self.information.pop('volume_display_ranges',None)
+
+    def getNumberOfVolumes(self):
+        shape=self.getShape()
+        if shape is None: return 0
+        if len(shape)<4: return 1
+        return int(shape[3])
+
+    def _getVolumeForStatistics(self,grad_idx):
+        if len(self.getShape())<4:
+            return self.images
+        return self.getVolume(grad_idx)
 
-        self.information['display_range'] = []
-        self.information['display_range'] = [ float(np.percentile(self.images, 0.1)), float(np.percentile(self.images,99.9)) ]
+    @common.measure_time
+    def getStatistics(self,bins=4096): ## display ranges from per-volume histograms (cached), error is bounded by a bin width
+        if self._statistics is not None and self._statistics['bins']==bins:
+            return self._statistics
+        num_volumes=self.getNumberOfVolumes()
+        stats=None
+        if np.issubdtype(self._getVolumeForStatistics(0).dtype,np.integer):
+            stats=self._integerStatistics(num_volumes)
+        if stats is None:
+            stats=self._binnedStatistics(num_volumes,bins)
+        stats['bins']=bins
+        self._statistics=stats
+        return self._statistics
+
+    def _integerStatistics(self,num_volumes,max_range=2**20): ## single pass, unit bins (exact), None if the range is too wide
+        volume_hists=[]
+        volume_ranges=[]
+        for gidx in range(num_volumes):
+            vol=np.asarray(self._getVolumeForStatistics(gidx)).ravel()
+            mn=int(np.min(vol))
+            mx=int(np.max(vol))
+            if mx-mn+1>max_range: return None
+            hist=np.bincount(vol.astype(np.int64)-mn,minlength=mx-mn+1)
+            volume_hists.append((mn,hist))
+            volume_ranges.append(_histogram_percentiles(hist,mn+np.arange(len(hist)+1,dtype=float),[1,99]))
+        gmin=min([x[0] for x in volume_hists])
+        gmax=max([x[0]+len(x[1])-1 for x in volume_hists])
+        global_hist=np.zeros(gmax-gmin+1,dtype=np.int64)
+        for mn,hist in volume_hists:
+            global_hist[mn-gmin:mn-gmin+len(hist)]+=hist
+        return {
+            'max_error': 1.0,
+            'min': float(gmin),
+            'max': float(gmax),
+            'display_range': _histogram_percentiles(global_hist,gmin+np.arange(len(global_hist)+1,dtype=float),[0.1,99.9]),
+            'volume_display_ranges': volume_ranges
+        }
 
-        self.information['volume_display_ranges'] = []
-        for grad_idx,g in enumerate(self.gradients):
-            rng = [ float(np.percentile(self.images[:,:,:,grad_idx], 1)), float(np.percentile(self.images[:,:,:,grad_idx],99)) ]
-            self.information['volume_display_ranges'].append(rng)
+    def _binnedStatistics(self,num_volumes,bins): ## bounds pass, then histograms on a common grid of the given number of bins
+        bounds=[]
+        for gidx in range(num_volumes):
+            vol=self._getVolumeForStatistics(gidx)
+            bounds.append([float(np.min(vol)),float(np.max(vol))])
+        bounds=np.array(bounds)
+        gmin=float(np.min(bounds[:,0]))
+        gmax=float(np.max(bounds[:,1]))
+        if gmax<=gmin: gmax=gmin+1.0
+        edges=np.linspace(gmin,gmax,bins+1)
+        scale=bins/(gmax-gmin)
+        global_hist=np.zeros(bins,dtype=np.int64)
+        volume_ranges=[]
+        for gidx in range(num_volumes):
+            vol=self._getVolumeForStatistics(gidx)
+            bin_indexes=((np.ravel(vol)-gmin)*scale).astype(np.int64)
+            np.clip(bin_indexes,0,bins-1,out=bin_indexes)
+            hist=np.bincount(bin_indexes,minlength=bins)
+            global_hist+=hist
+            volume_ranges.append(_histogram_percentiles(hist,edges,[1,99]))
+        return {
+            'max_error': float(edges[1]-edges[0]),
+            'min': gmin,
+            'max': gmax,
+            'display_range': _histogram_percentiles(global_hist,edges,[0.1,99.9]),
+            'volume_display_ranges': volume_ranges
+        }
+
+    def resetStatistics(self):
+        self._statistics=None
+        self._display=None
+
+    def computeDisplayRanges(self): ## fills display ranges in the image information (for the API/UI)
+        stats=self.getStatistics()
+        self.information['display_range']=list(stats['display_range'])
+        self.information['volume_display_ranges']=[list(x) for x in stats['volume_display_ranges']] if len(self.getShape())>3 else []
+        return self.information['display_range'], self.information['volume_display_ranges']
+
+    def getVolumeDisplayRange(self,grad_idx):
+        return self.getStatistics()['volume_display_ranges'][int(grad_idx)]
 
     def getImageSlice4D(self,axis_idx,slice_idx,grad_idx, normalized=True, display_range=None):
         if display_range is None:
-            display_range =  self.information['volume_display_ranges'][grad_idx]
+            display_range =  self.getVolumeDisplayRange(grad_idx)
 
-        affine = self.getAffineMatrixForNifti()
-        #affine = self.getAffineMatrixBySpace(target_space=self.information['space'])
-        spd = affine[:3,:3]
         mn, mx = display_range
         spacing = np.array(list(map(lambda x : np.max(np.abs(x)), self.information['space_directions'])))
-        if axis_idx == 0:
-            res = self.images[int(slice_idx),:,:,int(grad_idx)]
-            spacing_crop = [spacing[1], spacing[2]]
-        elif axis_idx == 1:
-            res = self.images[:,int(slice_idx),:,int(grad_idx)]
-            spacing_crop = [spacing[0], spacing[2]]
-        elif axis_idx == 2:
-            res = self.images[:,:,int(slice_idx),int(grad_idx)]
-            spacing_crop = [spacing[0], spacing[1]]
+        volume,gidx = self._resolveVolume(grad_idx) ## lazy, read only the requested slice
+        index = [slice(None)]*3
+        if axis_idx in [0,1,2]:
+            index[axis_idx] = int(slice_idx)
+            spacing_crop = [spacing[x] for x in range(3) if x!=axis_idx]
         else: 
             raise Exception('No such axis')
+        if gidx is not None:
+            index.append(gidx)
+        res = volume[tuple(index)]
+        res = np.asarray(res,dtype=float)
 
         out = (res >= mn) * res
         out[out >= mx] = mx
@@ -526,6 +1093,14 @@ class DWI:
         # rotated = cv2.warpAffine(src=out, M=warp_mat, dsize=dsize)
 
         # return rotated
+        flip_rows, flip_cols = self._sliceOrientation(axis_idx)
+        out = out.transpose()
+        if flip_rows: out = np.flipud(out)
+        if flip_cols: out = np.fliplr(out)
+        return out
+
+    def _sliceOrientation(self,axis_idx): ## (flip rows, flip columns) of a transposed slice for the display
+        spd = self.getAffineMatrixForNifti()[:3,:3]
         axial_is = True
         spd = np.matmul(spd, self.information['measurement_frame'])
         idx = np.matmul(self.information['measurement_frame'],[0,1,2])
@@ -533,53 +1108,32 @@ class DWI:
             axial_is = False
         idx=np.abs(idx)
         new_axis_idx = int(idx[axis_idx])
-        if spd[axis_idx,new_axis_idx] > 0:
-            return out.transpose()
-        else:
-            if axis_idx == 0:
-                if axial_is:
-                    return np.flipud(out.transpose())
-                else:
-                    return np.fliplr(np.flipud(out).transpose())
-            elif axis_idx == 1:
-                if axial_is:
-                    return np.flipud(out.transpose())
-                else:
-                    return np.fliplr(out.transpose())
-            elif axis_idx == 2:
-                return out.transpose()
-            
-
-
+        if spd[axis_idx,new_axis_idx] > 0 or axis_idx == 2:
+            return False, False
+        if axis_idx == 0:
+            return axial_is, False
+        return axial_is, not axial_is
+
+    def getDisplayVolumes(self): ## display representation, built once per image (until the volumes change)
+        if self._display is None:
+            with self._display_lock:
+                if self._display is None:
+                    self._display=_DisplayVolumes(self)
+        return self._display
+
+    def getDisplaySlice(self,axis_idx,slice_idx,grad_idx,display_range=None,size=None): ## uint8 slice as displayed by getImageSlice4D, from the display representation, fitted in size x size if given
+        if axis_idx not in [0,1,2]:
+            raise Exception('No such axis')
+        if display_range is None:
+            display_range = self.getVolumeDisplayRange(grad_idx)
+        return self.getDisplayVolumes().render(axis_idx,slice_idx,grad_idx,display_range,size)
 
     def getAffineMatrixForNifti(self):
         return self.getAffineMatrixBySpace('right-anterior-superior')
 
 
     def getAffineMatrixBySpace(self,target_space="right-anterior-superior"): #target_space left/right, posterior/anterior, inferior/superior e.g. lef-posterior-superior
-        space=self.information['space']
-        space_directions=copy.copy(self.information['space_directions'])
-        spdir=copy.copy(np.array(space_directions))
-        # affine=self.getAffineMatrix()
-        space_origin=np.array(self.information['space_origin'])
-        affine=np.zeros((4,4))
-        affine[0:3,0:3] = spdir[0:3,0:3]
-        affine[3,0:4] = np.array([[0,0, 0, 1]])
-        affine[0:3,3] = np.array([space_origin])
-        # affine=np.append(affine,[space_origin],axis=0)
-        # affine=affine.transpose()
-        # affine=np.append(affine,np.array([[0,0, 0, 1]]),axis=0)
-        src_space_elem = space.split('-')
-        target_space_elem = target_space.split('-')
-        diag_elements = [1,1,1,1]
-        for i,v in enumerate(target_space_elem):
-            if v != src_space_elem[i]:
-                diag_elements[i]=-1
-        ijk_to_lps = affine
-        src_to_tgt = np.diag(diag_elements)
-        ijk_to_ras = np.matmul(src_to_tgt, ijk_to_lps)
-        affine=ijk_to_ras
-        return affine
+        return get_affine_matrix_by_space(self.information,target_space)
 
     def setSpaceDirection(self, target_space=None):
         if not target_space:
@@ -597,16 +1151,11 @@ class DWI:
         return self.b0_threshold
 
     def getB0Index(self):
-        grads=self.getGradients()
         b0threshold=self.getB0Threshold()
-        res=[]
-        for idx,g in enumerate(grads):
-            if g['b_value'] <= b0threshold:
-                res.append(idx)
-        return res 
+        return np.flatnonzero(self._gradient_table.b_values <= b0threshold).tolist()
 
     def setGradients(self,gradients:list):
-        _,_,_,g = self.images.shape 
+        _,_,_,g = self.getShape() 
         if g != len(gradients):
             logger("[ERROR] Gradients in the image doesn't match to the direction number of the gradient file",common.Color.ERROR)
             logger("Number of gradients from image file : {}, Number of gradients from gradient file : {}".format(g,len(gradients)),common.Color.ERROR)
@@ -614,15 +1163,10 @@ class DWI:
         else:
             self.gradients=gradients 
 
-    def getGradients(self,b0_threshold=None):
+    def getGradients(self,b0_threshold=None): ## list of gradient dicts, 'index' and 'baseline' are derived from the table
         if b0_threshold is None:
             b0_threshold=self.b0_threshold
-
-        for idx,e in enumerate(self.gradients):
-            self.gradients[idx]['index']=idx
-            self.gradients[idx]['baseline']=bool(int(round(e['b_value']))<=b0_threshold)
-
-        return self.gradients
+        return self._gradient_table.toDicts(b0_threshold)
 
     def removeGradients(self):
         self.gradients=[]
@@ -654,19 +1198,19 @@ class DWI:
         yaml.safe_dump(out_grad,open(filename,'w'))
 
     def isGradientBaseline(self,gradient_index:int):
-        return self.getGradients()[gradient_index]['baseline']
+        return bool(self._gradient_table.baselineMask(self.b0_threshold)[gradient_index])
 
     def getBValueBounds(self):
-        grad=self.getGradients()
-        min_b= float(np.min([x['b_value'] for x in grad]) )
-        max_b= float(np.max([x['b_value'] for x in grad]) )
-        return [min_b,max_b]
+        b_values=self._gradient_table.b_values
+        return [float(np.min(b_values)),float(np.max(b_values))]
 
     def getBaselines(self,b0_threshold=None):
+        if b0_threshold is None:
+            b0_threshold=self.b0_threshold
         grads=self.getGradients(b0_threshold)
-        baseline_gradients=[x for x in grads if x['baseline']]
-        baseline_indexes=[x['index'] for x in baseline_gradients]
-        baseline_volumes=self.images[:,:,:,baseline_indexes]
+        baseline_indexes=self._gradient_table.baselineIndexes(b0_threshold).tolist()
+        baseline_gradients=[grads[idx] for idx in baseline_indexes]
+        baseline_volumes=self.getVolumes(baseline_indexes)
         return baseline_gradients, baseline_volumes
 
     def extractBaselines(self,b0_threshold=None):
@@ -696,11 +1240,9 @@ class DWI:
             return self.directAverage()
 
     def zerorizeBaselines(self,b0_threshold):
-        grads=self.getGradients(b0_threshold)
-        for idx,g in enumerate(grads):
-            if g['baseline']:
-                grads[idx]['b_value']=0
-        self.setGradients(grads)
+        table=self._gradient_table
+        b_values=np.where(table.baselineMask(b0_threshold),0.0,table.b_values)
+        self.setGradients(GradientTable(b_values,table.original_indexes,table.vectors,table.extras))
 
     def zeroPad(self,pad_list:list): ## [0,2,0,0] means padding 2 at axis 1 
         x,y,z,g=self.images.shape
@@ -712,15 +1254,13 @@ class DWI:
         self.information['image_size']=[x+xa,y+ya,z+za]
         self.information['sizes']=[x+xa,y+ya,z+za,g+ga]
 
-        if ga >0 : #if gradient volume is added
-            for i in range(ga):
-                grad=self.gradients[-1]
-                self.gradients.append(grad)
+        if ga >0 : #if gradient volume is added, the last gradient is repeated
+            table=self._gradient_table
+            self.gradients=GradientTable.concatenate([table,table.take([len(table)-1]*ga)])
 
     def gradientSummary(self):
-        grads=self.getGradients()
-        num_baselines=len([x for x in grads if x['baseline']])
-        num_gradients=len(grads)
+        num_baselines=int(np.sum(self._gradient_table.baselineMask(self.b0_threshold)))
+        num_gradients=len(self._gradient_table)
         res={
             "number_of_baselines": num_baselines,
             "number_of_gradients": num_gradients
@@ -729,40 +1269,64 @@ class DWI:
         
 
     def convertToOriginalGradientIndex(self,grad_indexes:list): # from actual index to original gradient index list
-        out=[]
-        grad=self.getGradients()
-        for idx in grad_indexes:
-            out.append(grad[idx]['original_index'])
-        return out 
+        original_indexes=self._gradient_table.original_indexes
+        return [int(original_indexes[idx]) for idx in grad_indexes]
 
     def deleteGradientsByOriginalIndex(self, original_indexes: list): #remove gradiensts and delete images corresponding to those gradients, list of gradient indexes
         ## remove gradient slices
-        remove_list=[]
-        grad=self.getGradients()
-        for idx,g in enumerate(grad):
-            if g['original_index'] in original_indexes:
-                remove_list.append(idx)
+        remove_list=np.flatnonzero(np.isin(self._gradient_table.original_indexes,list(original_indexes))).tolist()
         self.deleteGradients(remove_list)
 
-    def deleteGradients(self,remove_list: list): #remove gradiensts and delete images corresponding to those gradients, list of gradient indexes
-        ## remove gradient slices
-        self.images=np.delete(self.images,remove_list,3)
-        self.gradients=list(filter(lambda x: x['index'] not in remove_list, self.gradients))
-        for idx,g in enumerate(self.gradients):
-            g['index']=idx 
+    def _activeIndex(self):
+        if self._active is None:
+            return np.arange(self.getShape()[3])
+        return self._active
+
+    def _recordDeferredEdit(self):
+        source=self._physicalSource()
+        _count_volume_edit(deferred_edits=1,bytes_deferred=int(np.prod(self.getShape()))*source.dtype.itemsize)
+        self._statistics=None
+        self._display=None
+
+    def deleteGradients(self,remove_list: list): #remove gradiensts and exclude the corresponding volumes from the active-volume index, list of gradient indexes
+        if len(remove_list)==0:
+            return
+        self._active=np.delete(self._activeIndex(),remove_list)
+        self.gradients=self._gradient_table.delete(remove_list)
+        self._recordDeferredEdit()
         self.update_information()
 
-    def insertGradient(self,gradient,image_volume,pos=-1):
-        self.images=np.insert(self.images,pos,image_volume,axis=3)
-        self.gradients.insert(pos,gradient)
+    def insertGradient(self,gradient,image_volume,pos=-1): ## the volume is kept aside until the compaction
+        active=self._activeIndex()
+        self._inserted=self._inserted+[np.asarray(image_volume)]
+        self._active=np.insert(active,pos,-len(self._inserted))
+        self.gradients=self._gradient_table.insert(pos,gradient)
+        self._recordDeferredEdit()
         self.update_information()
 
+    def compact(self): ## applies the pending exclusions/insertions to the 4D array in a single copy
+        if self._active is None:
+            return
+        source=self._physicalSource()
+        if len(self._inserted)==0 and isinstance(source,np.ndarray):
+            compacted=np.take(source,self._active,axis=3)
+        else: ## by slabs along the first axis, a slab of the physical array in memory at a time
+            shape=self.getShape()
+            compacted=np.empty(shape,dtype=source.dtype)
+            volumes=_ActiveVolumes(self)
+            step=max(1,_EXPORT_CHUNK_BYTES//max(1,int(np.prod(source.shape[1:]))*source.dtype.itemsize))
+            for i in range(0,shape[0],step):
+                compacted[i:i+step]=volumes[(slice(i,i+step),slice(None),slice(None),slice(None))]
+        _count_volume_edit(compactions=1,bytes_compacted=compacted.nbytes)
+        self._images=compacted
+        self._image_proxy=None
+        self._active=None
+        self._inserted=[]
+
     def update_information(self):
         ## here goes anything to update when there is any changes on self.images
-        self.information['sizes']=list(self.images.shape )
-        self.information['image_size']=list(self.images.shape[:3])
-        self.getGradients()
-        ## reindexing
+        self.information['sizes']=list(self.getShape())
+        self.information['image_size']=list(self.getShape()[:3])
 
 
 
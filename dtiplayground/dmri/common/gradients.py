@@ -0,0 +1,153 @@
+import numpy as np
+import copy
+
+#
+# Gradient table backed by numpy arrays
+#   b-values, original indexes and the gradient vectors (gradient, unit_gradient, nifti_gradient) are stored as arrays.
+#   Tables are not modified in place : edits (take, delete, insert, concatenate) return a new table, so images sharing
+#   a table (shallow copies, snapshots) never see each other's edits, and derived views are cached per table.
+#   The list-of-dicts form ({'index','original_index','b_value','gradient','unit_gradient','nifti_gradient','baseline'})
+#   is kept as a view for the modules and for the YAML dump.
+#
+
+VECTOR_FIELDS=['gradient','unit_gradient','nifti_gradient']
+DERIVED_FIELDS=['index','baseline']
+SHELL_TOLERANCE=50.0 ## b-values closer than this (s/mm^2) belong to the same shell
+
+class ShellIndex(object): ## b-value shells : sorted b-values are split where the gap exceeds the tolerance
+    def __init__(self,b_values,tolerance=SHELL_TOLERANCE):
+        b_values=np.asarray(b_values,dtype=np.float64)
+        self.tolerance=tolerance
+        self.labels=np.zeros(len(b_values),dtype=np.int64) ## shell id of each volume
+        self.volumes=[] ## volume indexes of each shell
+        if len(b_values)>0:
+            order=np.argsort(b_values,kind='stable')
+            breaks=np.flatnonzero(np.diff(b_values[order])>tolerance)+1
+            self.volumes=[np.sort(g) for g in np.split(order,breaks)]
+        for sid,vols in enumerate(self.volumes):
+            self.labels[vols]=sid
+        self.b_values=np.array([float(np.round(np.median(b_values[v]))) for v in self.volumes]) ## representative b-value of each shell (ascending)
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def getVolumes(self,shell_id):
+        return self.volumes[shell_id]
+
+    def shellOf(self,volume_index):
+        return int(self.labels[volume_index])
+
+    def findShells(self,lower=None,upper=None): ## shell ids with lower <= b-value <= upper (bounds included, None for no bound)
+        mask=np.ones(len(self),dtype=bool)
+        if lower is not None: mask&=self.b_values>=lower
+        if upper is not None: mask&=self.b_values<=upper
+        return np.flatnonzero(mask).tolist()
+
+    def volumesOf(self,shell_ids): ## sorted volume indexes of the given shells
+        if len(shell_ids)==0:
+            return np.zeros(0,dtype=np.int64)
+        return np.sort(np.concatenate([self.volumes[sid] for sid in shell_ids]))
+
+    def summary(self):
+        return [{'b_value': float(b),'number_of_volumes': int(len(v))} for b,v in zip(self.b_values,self.volumes)]
+
+class GradientTable(object):
+    def __init__(self,b_values=None,original_indexes=None,vectors=None,extras=None):
+        self.b_values=np.zeros(0,dtype=np.float64) if b_values is None else np.asarray(b_values,dtype=np.float64)
+        n=len(self.b_values)
+        self.original_indexes=np.arange(n) if original_indexes is None else np.asarray(original_indexes,dtype=np.int64)
+        self.vectors={} if vectors is None else vectors ## name -> (array [n,3], presence mask [n])
+        self.extras=[{} for _ in range(n)] if extras is None else extras ## per row, any other key
+        self._cache={}
+
+    @staticmethod
+    def fromDicts(gradients): ## list of gradient dicts -> table
+        if isinstance(gradients,GradientTable):
+            return gradients
+        gradients=list(gradients)
+        n=len(gradients)
+        b_values=[float(g['b_value']) for g in gradients]
+        original_indexes=[int(g.get('original_index',idx)) for idx,g in enumerate(gradients)]
+        vectors={}
+        for name in VECTOR_FIELDS:
+            present=np.array([name in g and g[name] is not None for g in gradients],dtype=bool)
+            if not np.any(present): continue
+            arr=np.zeros((n,3),dtype=np.float64)
+            for idx in np.flatnonzero(present):
+                arr[idx]=gradients[idx][name]
+            vectors[name]=(arr,present)
+        known=set(['b_value','original_index']+VECTOR_FIELDS+DERIVED_FIELDS)
+        extras=[{k:v for k,v in g.items() if k not in known} for g in gradients]
+        return GradientTable(b_values,original_indexes,vectors,extras)
+
+    def __len__(self):
+        return len(self.b_values)
+
+    def _cached(self,key,func):
+        if key not in self._cache:
+            self._cache[key]=func()
+        return self._cache[key]
+
+    def vector(self,name): ## [n,3] array of the vector field (rows without the field are zeros)
+        if name not in self.vectors:
+            return np.zeros((len(self),3))
+        return self.vectors[name][0]
+
+    def baselineMask(self,b0_threshold):
+        return self._cached(('baseline',b0_threshold),lambda: np.round(self.b_values).astype(np.int64)<=b0_threshold)
+
+    def baselineIndexes(self,b0_threshold):
+        return self._cached(('baseline_indexes',b0_threshold),lambda: np.flatnonzero(self.baselineMask(b0_threshold)))
+
+    def shellIndex(self,tolerance=SHELL_TOLERANCE):
+        return self._cached(('shells',tolerance),lambda: ShellIndex(self.b_values,tolerance))
+
+    def toDicts(self,b0_threshold): ## list-of-dicts view, shared between the calls until the table changes. Edits on the dicts are applied by setting them back (DWI.setGradients)
+        return self._cached(('dicts',b0_threshold),lambda: self._makeDicts(b0_threshold))
+
+    def _makeDicts(self,b0_threshold):
+        mask=self.baselineMask(b0_threshold)
+        out=[]
+        for idx in range(len(self)):
+            g={'index': idx,
+               'original_index': int(self.original_indexes[idx]),
+               'b_value': float(self.b_values[idx])}
+            for name,(arr,present) in self.vectors.items():
+                if present[idx]: g[name]=arr[idx].tolist()
+            g['baseline']=bool(mask[idx])
+            g.update(copy.deepcopy(self.extras[idx]))
+            out.append(g)
+        return out
+
+    def take(self,indexes): ## new table with the rows at indexes (in that order)
+        indexes=np.asarray(indexes,dtype=np.int64).reshape(-1)
+        vectors={name:(arr[indexes],present[indexes]) for name,(arr,present) in self.vectors.items()}
+        return GradientTable(self.b_values[indexes],self.original_indexes[indexes],vectors,[self.extras[i] for i in indexes])
+
+    def delete(self,indexes):
+        keep=np.ones(len(self),dtype=bool)
+        keep[np.asarray(indexes,dtype=np.int64).reshape(-1)]=False
+        return self.take(np.flatnonzero(keep))
+
+    @staticmethod
+    def concatenate(tables):
+        tables=[GradientTable.fromDicts(t) for t in tables]
+        names=[]
+        for t in tables:
+            names+=[name for name in t.vectors.keys() if name not in names]
+        vectors={}
+        for name in names:
+            arr=np.concatenate([t.vector(name) for t in tables],axis=0)
+            present=np.concatenate([t.vectors[name][1] if name in t.vectors else np.zeros(len(t),dtype=bool) for t in tables])
+            vectors[name]=(arr,present)
+        return GradientTable(np.concatenate([t.b_values for t in tables]),
+                             np.concatenate([t.original_indexes for t in tables]),
+                             vectors,
+                             sum([t.extras for t in tables],[]))
+
+    def insert(self,pos,gradient): ## pos follows list.insert (negative positions count from the end)
+        n=len(self)
+        if pos<0: pos=max(0,n+pos)
+        pos=min(pos,n)
+        row=GradientTable.fromDicts([gradient])
+        return GradientTable.concatenate([self.take(np.arange(pos)),row,self.take(np.arange(pos,n))])
@@ -134,6 +134,8 @@ class DTIPlaygroundModule: #base class
         self.software_info = {}
         self.softwares = {}
         self.global_variables={}
+        self.image_writer=None ## common.BackgroundWriter, output images are written in background if set
+        self.write_policy=None ## write policy of the images written by the module (dwi.WRITE_POLICIES), default policy if None
         if 'software_info' in kwargs:
             self.software_info= kwargs['software_info']
             self.softwares = self.software_info['softwares']
@@ -159,10 +161,11 @@ class DTIPlaygroundModule: #base class
                     previous_outputs.append(v[-1])
             
             for idx,previous_result in enumerate(previous_outputs):
-                if previous_result["output"]["image_object"] is not None:
-                    self.source_image=common.object_by_id(previous_result["output"]["image_object"])
+                cached_image=self.getRegisteredImage(previous_result)
+                if cached_image is not None:
+                    self.source_image=cached_image
                     self.images.append(self.source_image)
-                    logger("Source Image (Previous output) loaded from memory (object id): {}".format(id(self.source_image)),common.Color.OK)
+                    logger("Source Image (Previous output) loaded from memory (handle): {}".format(previous_result["output"]["image_object"]),common.Color.OK)
                 else:
                     logger("Loading image from the file : {}".format(previous_result['output']['image_path']),common.Color.PROCESS)
                     src_image_filename=Path(self.output_root).joinpath(previous_result['output']['image_path']).__str__()
@@ -187,7 +190,7 @@ class DTIPlaygroundModule: #base class
             self.image=copy.copy(self.images[0])
             self.result["module_name"]=self.name 
             self.result["input"]=previous_outputs
-            self.result["output"]["image_object"]= id(self.image)
+            self.result["output"]["image_object"]= common.image_registry.register(self.image)
             self.result["output"]["success"]=False 
             self.result["output"]["output_directory"]=str(Path(self.output_dir).relative_to(self.output_root))
 
@@ -195,10 +198,11 @@ class DTIPlaygroundModule: #base class
             #inputpath=Path(self.result_history[0]["output"]["image_path"]).absolute()
             previous_result=self.getPreviousResult()
             logger(yaml.safe_dump(previous_result))
-            if previous_result["output"]["image_object"] is not None:
-                self.source_image=common.object_by_id(previous_result["output"]["image_object"])
+            cached_image=self.getRegisteredImage(previous_result)
+            if cached_image is not None:
+                self.source_image=cached_image
                 self.image=self.source_image
-                logger("Source Image (Previous output) loaded from memory (object id): {}".format(id(self.source_image)),common.Color.OK)
+                logger("Source Image (Previous output) loaded from memory (handle): {}".format(previous_result["output"]["image_object"]),common.Color.OK)
             else:
                 logger("Loading image from the file : {}".format(previous_result['output']['image_path']),common.Color.PROCESS)
                 src_image_filename=Path(self.output_root).joinpath(previous_result['output']['image_path']).__str__()
@@ -221,11 +225,24 @@ class DTIPlaygroundModule: #base class
 
             self.result["module_name"]=self.name 
             self.result["input"]=previous_result["output"]
-            self.result["output"]["image_object"]= id(self.image)
+            self.result["output"]["image_object"]= common.image_registry.register(self.image)
             self.result["output"]["success"]=False 
             self.result["output"]["output_directory"]=str(Path(self.output_dir).relative_to(self.output_root))
 
 
+    def getRegisteredImage(self,previous_result):
+        handle=previous_result["output"]["image_object"]
+        if handle is None:
+            return None
+        image=common.image_registry.get(handle)
+        if image is None:
+            if previous_result["output"]["image_path"] is None:
+                raise Exception("Image (handle: {}) is neither in the registry nor on the disk".format(handle))
+            logger("[WARNING] Image (handle: {}) is released from the registry, falling back to the file".format(handle),common.Color.WARNING)
+            if self.image_writer is not None:
+                self.image_writer.flush() ## the file may still be being written
+        return image
+
     def install(self,install_dir=None,*args,**kwargs):
         pass 
 
@@ -247,17 +264,27 @@ class DTIPlaygroundModule: #base class
     def getOutputFiles(self):
         return self.output_files
 
+    def setImageWriter(self,writer):
+        self.image_writer=writer
+
+    def setWritePolicy(self,policy):
+        self.write_policy=policy
+
     @common.measure_time
-    def writeImage(self,filename,dest_type='nrrd',dtype='short'):
-        self.image.writeImage(filename,dest_type=dest_type,dtype=dtype)
+    def writeImage(self,filename,dest_type='nrrd',dtype='short',background=False): ## background : output image only consumed by the pipeline, not by an external tool
+        if background and self.image_writer is not None:
+            logger("Writing image in background : {}".format(str(filename)),common.Color.PROCESS)
+            self.image_writer.submit(self.image.snapshot().writeImage,filename,dest_type=dest_type,dtype=dtype,policy=self.write_policy)
+        else:
+            self.image.writeImage(filename,dest_type=dest_type,dtype=dtype,policy=self.write_policy)
         #self.result['output']['image_path']=str(Path(filename).absolute().relative_to(self.output_root))
         self.result['output']['image_path']=str(Path(filename).absolute())
 
     @common.measure_time
-    def writeImageWithOriginalSpace(self,filename,dest_type='nrrd',dtype='short'):
+    def writeImageWithOriginalSpace(self,filename,dest_type='nrrd',dtype='short',background=False):
         target_space = self.getSourceImageInformation()['space']
         self.image.setSpaceDirection(target_space=target_space)
-        self.writeImage(filename,dest_type,dtype)
+        self.writeImage(filename,dest_type,dtype,background=background)
 
     @common.measure_time 
     def loadImage(self, image_path, gradient_path=None):
@@ -336,7 +363,7 @@ class DTIPlaygroundModule: #base class
         self.result=result_obj
         if "multi_input" in self.template['process_attributes']:
             self.image=self.loadImage(self.result['output']['image_path'])
-            self.result['output']['image_object']=id(self.image)
+            self.result['output']['image_object']=common.image_registry.register(self.image)
         self.result['input']=self.getPreviousResult()['output']
         self.image.deleteGradientsByOriginalIndex(self.result['output']['excluded_gradients_original_indexes'])
         logger("Excluded gradient indexes (original index) : {}"
@@ -344,7 +371,7 @@ class DTIPlaygroundModule: #base class
 
         gradient_filename=str(Path(self.output_dir).joinpath('output_gradients.yml'))
         image_information_filename=str(Path(self.output_dir).joinpath('output_image_information.yml'))
-        self.result['output']['image_object']=id(self.image)
+        self.result['output']['image_object']=common.image_registry.register(self.image)
         ### if deform_image process type, then forced file loading should be done from the second run in the subsequent process.
         if "deform_image" in self.template['process_attributes']:        
             if  Path(self.output_dir).joinpath('result.yml').exists() and not self.options['overwrite']: ## second run
@@ -354,7 +381,7 @@ class DTIPlaygroundModule: #base class
                 self.image.loadImageInformation(image_information_filename)
                 #self.image.information=yaml.safe_load(open(image_information_filename,'r'))
             else: ## first run
-                self.result['output']['image_object']=id(self.image)
+                self.result['output']['image_object']=common.image_registry.register(self.image)
         ### deform_image ends
 
         
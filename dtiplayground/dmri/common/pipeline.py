@@ -3,9 +3,12 @@
 import dtiplayground.dmri.common.dwi as dwi
 import dtiplayground.dmri.common.module as module
 import dtiplayground.dmri.common as common
+import dtiplayground.dmri.common.stepcache as stepcache
 
 import shutil
 import yaml,sys,traceback,time
+import copy
+import threading
 from pathlib import Path
 
 
@@ -68,6 +71,19 @@ def _generate_exec_sequence(pipeline,image_paths:list,output_dir,modules, io_opt
     return seq 
 
 
+def _generate_exec_graph(exec_sequence,image_paths:list): ## execution id -> ids it depends on : previous step of the same image, every input chain for the first multi_input step
+    dependencies={}
+    latest={} ## image path -> id of its latest step
+    for execution in exec_sequence:
+        deps=[]
+        if execution['image_path'] in latest:
+            deps.append(latest[execution['image_path']])
+        elif execution['multi_input']:
+            deps+=[latest[ip] for ip in image_paths if ip in latest]
+        dependencies[execution['id']]=deps
+        latest[execution['image_path']]=execution['id']
+    return dependencies
+
 def _generate_output_directories_mapping(output_dir,exec_sequence): ## map exec sequence uuid to output directory
     # Path(output_dir).mkdir(parents=True,exist_ok=True)
     module_output_dirs={}
@@ -114,6 +130,10 @@ class Pipeline:
         self.original_image_format='nrrd'
         self.images=[]
         self.image_cache={} # cache for the previous results
+        self.step_keys={} # content-addressed key of the latest step of each input chain
+        self.step_cache=None # shared step cache (StepCache), disabled if None
+        self.image_writer=common.BackgroundWriter() # background writes of the output images (in-memory handoff)
+        self.state_lock=threading.RLock() # global variables and histories shared by the concurrent input chains
 
         #Execution variables
         self.template_filename=Path(__file__).resolve().parent.joinpath("templates/protocol_template.yml")
@@ -122,6 +142,7 @@ class Pipeline:
         self.software_info=None # binary path of softwares (such as fsl)
         self.num_threads=4 # number of threads to use 
         self.global_variables={} # global variables to track from each module (arbitrary key-value dict)
+        self.input_global_variables={} # user given global variables at the beginning of the run (part of the step keys)
 
         #Module related
         self.config,self.environment=load_configurations(self.config_dir)
@@ -134,21 +155,89 @@ class Pipeline:
         global logger
         logger = self.logger.write
 
-    def loadImages(self, image_paths,b0_threshold=10):
+    def loadImages(self, image_paths,b0_threshold=10,lazy=False): # lazy : keep on-disk dtype and memory-map the inputs when possible
         self.image_paths=list(map(lambda x:str(Path(x).absolute()),image_paths))
         #print(self.image_paths)
         for ip in self.image_paths:
             logger("Loading original image : {}".format(str(ip)),common.Color.PROCESS)
-            img=dwi.DWI(str(ip))
+            img=dwi.DWI(str(ip),lazy=lazy)
             self.result_history[ip]=[{"output":{"image_path": str(Path(ip).absolute()),
                                              "image_information": img.information,
-                                             "image_object" : id(img)}}]
+                                             "image_object" : common.image_registry.register(img)}}]
             img.setB0Threshold(b0_threshold)
             img.getGradients()
+            self.step_keys[ip]=stepcache.file_digest(ip)
             self.images.append(img)
+            self.cacheImage(ip,img)
         self.original_image_information = self.images[0].information
         self.original_image_format = self.images[0].image_type
 
+    def cacheImage(self,image_path,image): ## keeps the latest image of each input chain alive in the registry
+        handle=common.image_registry.register(image,pin=True)
+        if image_path in self.image_cache:
+            previous_handle=common.image_registry.handleOf(self.image_cache[image_path])
+            if previous_handle is not None and previous_handle!=handle:
+                common.image_registry.release(previous_handle)
+        self.image_cache[image_path]=image
+        return handle
+
+    def releaseImages(self,image_paths=None):
+        if image_paths is None:
+            image_paths=list(self.image_cache.keys())
+        for ip in image_paths:
+            if ip not in self.image_cache: continue
+            handle=common.image_registry.handleOf(self.image_cache[ip])
+            if handle is not None:
+                common.image_registry.release(handle)
+            del self.image_cache[ip]
+
+    def setStepCacheDirectory(self, cache_dir=None): ## shared directory of step outputs reused across runs and subjects
+        if cache_dir is None:
+            self.step_cache=None
+        else:
+            self.step_cache=stepcache.StepCache(cache_dir)
+            self.io['step_cache_directory']=str(self.step_cache.cache_dir)
+
+    def getStepKey(self,execution,opts): ## chains the keys of the input images with the module, its version and its protocol
+        module_name=execution['module_name']
+        if execution['multi_input']:
+            input_keys=[self.step_keys[ip] for ip in self.image_paths]
+            if execution['image_path'] in self.step_keys:
+                input_keys=[self.step_keys[execution['image_path']]]
+        else:
+            input_keys=[self.step_keys[execution['image_path']]]
+        return stepcache.step_key(input_keys,
+                                  module_name,
+                                  self.modules[module_name]['template'].get('version'),
+                                  execution['options']['protocol'],
+                                  baseline_threshold=opts['baseline_threshold'],
+                                  global_variables=self.input_global_variables)
+
+    def setInMemoryHandoff(self, enabled=True): ## if disabled, every image is written before the next module starts (debugging)
+        self.io['in_memory_handoff']=enabled
+
+    def isInMemoryHandoff(self):
+        return self.io.get('in_memory_handoff',True)
+
+    def setParallelInputs(self, enabled=True): ## if enabled, the chains of the input images run concurrently until a multi_input module joins them
+        self.io['parallel_inputs']=enabled
+
+    def isParallelInputs(self):
+        return self.io.get('parallel_inputs',True)
+
+    def setWritePolicy(self, intermediate=None, final=None): ## write policies (dwi.WRITE_POLICIES) of the module outputs and of the final output
+        if intermediate is not None:
+            dwi.get_write_policy(intermediate)
+            self.io['write_policy_intermediate']=intermediate
+        if final is not None:
+            dwi.get_write_policy(final)
+            self.io['write_policy_final']=final
+
+    def writeOutputImage(self,image,filename,gradients_filename,information_filename):
+        image.writeImage(filename,dest_type=self.io['output_format'],policy=self.io.get('write_policy_final'))
+        image.dumpGradients(gradients_filename)
+        image.dumpInformation(information_filename)
+
     def setOutputDirectory(self, output_dir=None):
         if output_dir is None:
             self.output_dir=Path(self.getImagePath()).parent
@@ -253,6 +342,11 @@ class Pipeline:
         self.io['no_output_image']= False
         if 'no_output_image' in options:
             self.io['no_output_image']=options['no_output_image']
+        if 'in_memory_handoff' in options:
+            self.io['in_memory_handoff']=options['in_memory_handoff']
+        if 'parallel_inputs' in options:
+            self.io['parallel_inputs']=options['parallel_inputs']
+        self.setWritePolicy(options.get('write_policy_intermediate'),options.get('write_policy_final'))
         if pipeline is not None:
             self.pipeline=self.furnishPipeline(pipeline)
         else:
@@ -353,6 +447,8 @@ class Pipeline:
         try:
             if 'execution_id' in options: logger("Execution ID : {}".format(options['execution_id']))
             self.checkRunnable()
+            dwi.reset_volume_edit_statistics()
+            common.image_registry.resetStatistics()
             self.processes_history=[]
             self.io_options['output_filename_base']=self.getBaseFilename(self.images[0].filename)
             if 'output_file_base' in options:
@@ -373,9 +469,27 @@ class Pipeline:
                     "baseline_threshold" : self.io['baseline_threshold'],
                     "global_variables" : self.global_variables
                  }
-            forced_overwrite=False
+            forced_overwrite={} ## image path -> a module of the chain forced the overwrite, following steps are recomputed
+            self.input_global_variables=dict(self.global_variables)
             self.global_variables.update(self.loadGlobalVariables())
-            for idx,execution in enumerate(execution_sequence):
+            if self.step_cache is None and self.io.get('step_cache_directory') is not None:
+                self.setStepCacheDirectory(self.io['step_cache_directory'])
+            writer=None
+            if self.isInMemoryHandoff():
+                writer=self.image_writer
+                logger("In-memory handoff : output images are written in background",common.Color.INFO)
+            dependencies=_generate_exec_graph(execution_sequence,self.image_paths)
+            num_chains=1
+            if self.isParallelInputs() and len(self.image_paths)>1:
+                num_chains=len(self.image_paths)
+                logger("Parallel inputs : {} input chains run concurrently until they are merged".format(num_chains),common.Color.INFO)
+            for execution in execution_sequence:
+                self.result_history.setdefault(execution['image_path'],[])
+            step_index={execution['id']:idx for idx,execution in enumerate(execution_sequence)}
+
+            def run_step(uid):
+                idx=step_index[uid]
+                execution=execution_sequence[idx]
                 # uid, p, options=parr 
                 uid=execution['id']
                 p=execution['module_name']
@@ -384,8 +498,13 @@ class Pipeline:
                 output_base=execution['output_base']
                 save=execution['save']
 
-                if image_path not in self.result_history:
-                    self.result_history[image_path]=[]
+                step_opts=dict(opts)
+                if num_chains>1 and not execution['multi_input']: ## thread budget is shared by the concurrent chains
+                    step_opts['software_info']=copy.deepcopy(opts['software_info'])
+                    step_opts['software_info']['parameters']['num_max_threads']=max(1,self.num_threads//num_chains)
+                with self.state_lock:
+                    step_opts['global_variables']=dict(self.global_variables)
+                chain_paths=[image_path]+(self.image_paths if execution['multi_input'] else [])
                 bt=time.time()
                 logger("-----------------------------------------------",common.Color.BOLD)
                 logger("Processing [{0}/{1}] : {2}".format(idx+1,len(execution_sequence),p),common.Color.BOLD)
@@ -393,15 +512,18 @@ class Pipeline:
                 logger("-----------------------------------------------",common.Color.BOLD)
                 Path(output_dir_map[uid]).mkdir(parents=True,exist_ok=True)
                 logger("Output directory : {}\n".format(str(output_dir_map[uid])),common.Color.DEV)
-                m=getattr(self.modules[p]['module'], p)(self.config_dir, **opts)
+                m=getattr(self.modules[p]['module'], p)(self.config_dir, **step_opts)
                 m.setOptionsAndProtocol(options)
+                m.setImageWriter(writer)
+                m.setWritePolicy(self.io.get('write_policy_intermediate'))
                 logger(yaml.safe_dump(m.getTemplate()['process_attributes']),common.Color.DEV)
                 logger(yaml.safe_dump(m.getOptions()),common.Color.DEV)
                 logger(yaml.safe_dump(m.getProtocol()),common.Color.DEV)
-                if m.getOptions()['skip']:
-                    forced_overwrite=True 
+                if m.getOptions()['skip']: ## image passes through, the chain key is unchanged
                     logger("SKIPPING THIS",common.Color.INFO)
-                    continue
+                    return
+                key=self.getStepKey(execution,step_opts)
+                logger("Step key : {}".format(key),common.Color.DEV)
 
                 m.initialize(self.result_history,image_path,output_dir=output_dir_map[uid])
                 success=False
@@ -410,24 +532,50 @@ class Pipeline:
                 ### if result file is exist, just run post process and continue with previous information
 
                 if m.getOptions()['overwrite']:
-                    forced_overwrite=True 
-
-                if resultfile_path.exists() and not m.getOptions()['overwrite'] and not forced_overwrite:
+                    forced_overwrite[image_path]=True 
+
+                reusable=not m.getOptions()['overwrite'] and not any(forced_overwrite.get(ip,False) for ip in chain_paths)
+                cached=False
+                if reusable and resultfile_path.exists():
+                    cached=stepcache.read_step_key(output_dir_map[uid])==key
+                    if not cached:
+                        logger("Result file exists but the input or the protocol has changed, recomputing ...",common.Color.WARNING)
+                if reusable and not cached and self.step_cache is not None and self.step_cache.contains(key):
+                    cached=self.step_cache.restore(key,output_dir_map[uid],self.output_dir)
+                    logger("Result restored from the step cache",common.Color.INFO+common.Color.BOLD)
+
+                if cached:
                     result_temp=yaml.safe_load(open(resultfile_path,'r'))
                     logger("Result file exists, just post-processing ...",common.Color.INFO+common.Color.BOLD)
-                    m.postProcess(result_temp,opts)
+                    m.postProcess(result_temp,step_opts)
                     success=True
-                else: # in case overwriting or there is no result.yml file
-                    outres=m.run(opts,global_vars=self.global_variables)
+                else: # in case overwriting or there is no valid result.yml file
+                    if resultfile_path.exists(): ## stale results, module must not reuse its previous files
+                        m.options=dict(m.getOptions(),overwrite=True)
+                    stepcache.clear_step(output_dir_map[uid])
+                    outres=m.run(step_opts,global_vars=step_opts['global_variables'])
                     success=outres['success']
                 if not success:
                     logger("[ERROR] Process failed in {}".format(p),common.Color.ERROR) 
                     raise Exception("Process failed in {}".format(p))
-                self.global_variables.update(m.getGlobalVariables())
-                self.writeGlobalVariables()
-                self.previous_process=m  #this is for the image id reference
-                self.result_history[image_path] =m.getResultHistory()
-                self.image_cache[image_path]=m.image 
+                step_info={'module_name': p, 'module_version': self.modules[p]['template'].get('version')}
+                step_tasks=[(stepcache.write_step,(output_dir_map[uid],key))] ## the step is valid only once its image is on the disk
+                if not cached and self.step_cache is not None:
+                    step_tasks.append((self.step_cache.store,(key,output_dir_map[uid],self.output_dir)))
+                for func,args in step_tasks:
+                    if writer is not None:
+                        writer.submit(func,*args,**step_info)
+                    else:
+                        func(*args,**step_info)
+                if any(forced_overwrite.get(ip,False) for ip in chain_paths):
+                    forced_overwrite[image_path]=True
+                self.step_keys[image_path]=key
+                with self.state_lock:
+                    self.global_variables.update(m.getGlobalVariables())
+                    self.writeGlobalVariables()
+                    self.previous_process=m  #this is for the image id reference
+                    self.result_history[image_path] =m.getResultHistory()
+                    self.cacheImage(image_path,m.image) ## previous image of this chain is released from the registry
                 for intermediary_file in m.getOutputFiles():
                     srcfilepath = intermediary_file['source']
                     postfix = intermediary_file['postfix']
@@ -446,7 +594,8 @@ class Pipeline:
                     shutil.copy(srcfilepath, output_path)
 
                 et=time.time()-bt
-                self.result_history[image_path][-1]['processing_time']=et                   
+                with self.state_lock:
+                    self.result_history[image_path][-1]['processing_time']=et
                 logger("[{}] Processed time : {:.2f}s".format(p,et),common.Color.DEV)
                 if save and not self.io['no_output_image']: ### for the last, dump image and informations
                     ## Save final Qced image
@@ -460,10 +609,18 @@ class Pipeline:
                     final_information_filename=Path(self.output_dir).joinpath(Path(output_base).stem.split('.')[0]).joinpath('output_image_information.yml').__str__()
                     
                     if not Path(final_filename).exists() or idx+1==len(execution_sequence):
-                        m.image.writeImage(final_filename,dest_type=self.io['output_format'])
-                        m.image.dumpGradients(final_gradients_filename)
-                        m.image.dumpInformation(final_information_filename)
-
+                        if writer is not None:
+                            writer.submit(self.writeOutputImage,m.image.snapshot(),final_filename,final_gradients_filename,final_information_filename)
+                        else:
+                            self.writeOutputImage(m.image,final_filename,final_gradients_filename,final_information_filename)
+
+            common.run_dag([x['id'] for x in execution_sequence],dependencies,run_step,num_workers=num_chains)
+            if writer is not None:
+                logger("Waiting for {} pending background writes ...".format(writer.pending()),common.Color.PROCESS)
+                writer.flush()
+                logger("Background writes done, writer busy time : {:.2f}s".format(writer.busy_time),common.Color.DEV)
+            edits=dwi.get_volume_edit_statistics()
+            logger("Volume edits : {} deferred, {} compactions, {} full copies avoided ({:.1f} MB)".format(edits['deferred_edits'],edits['compactions'],edits['copies_avoided'],edits['bytes_avoided']/2**20),common.Color.INFO)
             logger(yaml.safe_dump(execution_sequence),common.Color.INFO)
             return self.result_history
 
@@ -475,4 +632,11 @@ class Pipeline:
         finally:
             with open(Path(self.output_dir).joinpath('result_history.yml'),'w') as f:
                 yaml.safe_dump(self.result_history,f)
+            statistics={
+                'image_registry': common.image_registry.getStatistics(),
+                'volume_edits': dwi.get_volume_edit_statistics()
+            }
+            with open(Path(self.output_dir).joinpath('run_statistics.yml'),'w') as f:
+                yaml.safe_dump(statistics,f)
+            self.releaseImages() ## images of this run are no longer pinned in the process-wide registry
 
@@ -0,0 +1,136 @@
+#
+# Rigid registration engine shared by the modules (INTERLACE_Check, BASELINE_Average)
+#   Multi-resolution mutual information registration (center of mass -> translation -> rigid) as in dipy's AffineRegistration,
+#   with the scale space of the static image built once and kept across the stages and across the calls on the same static image.
+#   Optionally (param_tolerance), a registration stops refining when a resolution level moves the parameters less than the tolerance.
+#
+
+import dtiplayground.dmri.common as common
+
+import hashlib
+import threading
+import numpy as np
+from dipy.align.imaffine import (transform_centers_of_mass,
+                                 AffineMap,
+                                 MutualInformationMetric)
+from dipy.align.imwarp import get_direction_and_spacings
+from dipy.align.scalespace import IsotropicScaleSpace
+from dipy.align.transforms import (TranslationTransform3D,
+                                   RigidTransform3D)
+from dipy.core.optimize import Optimizer
+
+logger=common.logger.write
+
+PARAM_TOLERANCE=None ## rad / mm, a level moving the parameters less than this skips the finer levels, None runs every level (same result as dipy)
+OPTIMIZER_OPTIONS={'gtol': 1e-4, 'disp': False} ## same as dipy's AffineRegistration
+
+def _normalize(image):
+    image=image.astype(np.float64)
+    vmin,vmax=image.min(),image.max()
+    return (image-vmin)/(vmax-vmin)
+
+def _digest(image,grid2world):
+    h=hashlib.blake2b(digest_size=16)
+    h.update(str((image.shape,image.dtype.str)).encode('utf-8'))
+    h.update(np.ascontiguousarray(image))
+    h.update(np.ascontiguousarray(grid2world,dtype=np.float64))
+    return h.hexdigest()
+
+class RigidRegistration(object):
+    def __init__(self,nbins=32,
+                      level_iters=[10000,1000,100],
+                      sigmas=[3.0,1.0,0.0],
+                      factors=[4,2,1],
+                      sampling_prop=None,
+                      param_tolerance=PARAM_TOLERANCE):
+        self.level_iters=list(level_iters)
+        self.sigmas=list(sigmas)
+        self.factors=list(factors)
+        self.levels=len(self.factors)
+        self.param_tolerance=param_tolerance
+        self.metric=MutualInformationMetric(nbins,sampling_prop)
+        self.static=None
+        self.static_grid2world=None
+        self.static_levels=None ## level -> (static resampled on the level grid, level grid2world)
+        self._static_key=None
+
+    def setStatic(self,static,static_grid2world): ## builds the static pyramid, unless it is the same image as the previous call
+        key=_digest(static,static_grid2world)
+        if key==self._static_key: return
+        static_grid2world=np.asarray(static_grid2world,dtype=np.float64)
+        _,spacing=get_direction_and_spacings(static_grid2world,static.ndim)
+        ss=IsotropicScaleSpace(_normalize(static),self.factors,self.sigmas,static_grid2world,spacing,False)
+        original_shape=ss.get_image(0).shape
+        original_grid2world=ss.get_affine(0)
+        self.static_levels=[]
+        for level in range(self.levels):
+            shape=ss.get_domain_shape(level)
+            grid2world=ss.get_affine(level)
+            level_map=AffineMap(None,shape,grid2world,original_shape,original_grid2world)
+            self.static_levels.append((level_map.transform(ss.get_image(level)),grid2world))
+        self.static=static
+        self.static_grid2world=static_grid2world
+        self._static_key=key
+
+    def _optimize(self,moving_ss,moving_grid2world,transform,starting_affine): ## multi-resolution loop of a stage, returns the updated affine
+        params0=transform.get_identity_parameters()
+        for level in range(self.levels-1,-1,-1):
+            current_static,current_static_grid2world=self.static_levels[level]
+            self.metric.setup(transform,current_static,moving_ss.get_image(level),
+                              current_static_grid2world,moving_grid2world,starting_affine)
+            options=dict(OPTIMIZER_OPTIONS)
+            options['maxfun']=self.level_iters[-1-level]
+            opt=Optimizer(self.metric.distance_and_gradient,params0,method='L-BFGS-B',jac=True,options=options)
+            params=opt.xopt
+            starting_affine=transform.param_to_matrix(params).dot(starting_affine)
+            if self.param_tolerance is not None and 0<level<self.levels-1:
+                update=np.max(np.abs(np.asarray(params)-params0))
+                if update<self.param_tolerance: ## converged, the finer levels would not move it either
+                    logger("Registration converged at level {} (update {:.2e})".format(level,update),common.Color.DEV)
+                    break
+        return starting_affine
+
+    def register(self,moving,moving_grid2world,starting_affine=None,resample=True): ## returns (resampled moving or None, rigid affine)
+        if self.static_levels is None:
+            raise Exception("Static image is not set")
+        moving_grid2world=np.asarray(moving_grid2world,dtype=np.float64)
+        _,spacing=get_direction_and_spacings(moving_grid2world,moving.ndim)
+        moving_ss=IsotropicScaleSpace(_normalize(moving),self.factors,self.sigmas,moving_grid2world,spacing,False)
+        if starting_affine is None: ## center of mass and translation stages
+            c_of_mass=transform_centers_of_mass(self.static,self.static_grid2world,moving,moving_grid2world)
+            starting_affine=self._optimize(moving_ss,moving_grid2world,TranslationTransform3D(),c_of_mass.affine)
+        rigid_affine=self._optimize(moving_ss,moving_grid2world,RigidTransform3D(),np.array(starting_affine,dtype=np.float64))
+        transformed=None
+        if resample:
+            rigid=AffineMap(rigid_affine,self.static.shape,self.static_grid2world,moving.shape,moving_grid2world)
+            transformed=rigid.transform(moving)
+        return transformed, rigid_affine
+
+_engines=threading.local() ## per thread, a single engine (the last parameters), concurrent input chains never share a static pyramid
+
+def get_rigid_registration(**params): ## engine of the calling thread, kept between the calls with the same parameters so the static pyramid is reused
+    key=tuple(sorted((k,tuple(v) if isinstance(v,list) else v) for k,v in params.items()))
+    if getattr(_engines,'key',None)!=key:
+        _engines.engine=RigidRegistration(**params)
+        _engines.key=key
+    return _engines.engine
+
+def release_rigid_registration(): ## drops the engine (and its static pyramid) of the calling thread
+    _engines.engine=None
+    _engines.key=None
+
+@common.measure_time
+def rigid_3d(static,moving,
+             affine_static,affine_moving,
+             nbins=32,
+             level_iters=[10000,1000,100],
+             sigmas=[3.0,1.0,0.0],
+             factors=[4,2,1],
+             sampling_prop=None,
+             starting_affine=None, ## warm start from a previous rigid affine (skips the center of mass and translation stages)
+             param_tolerance=PARAM_TOLERANCE,
+             resample=True):
+    engine=get_rigid_registration(nbins=nbins,level_iters=level_iters,sigmas=sigmas,factors=factors,
+                                  sampling_prop=sampling_prop,param_tolerance=param_tolerance)
+    engine.setStatic(static,affine_static)
+    return engine.register(moving,affine_moving,starting_affine=starting_affine,resample=resample)
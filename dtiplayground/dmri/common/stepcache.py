@@ -0,0 +1,118 @@
+import dtiplayground.dmri.common as common
+
+import hashlib, json, shutil, os
+import yaml
+from pathlib import Path
+
+logger=common.logger.write
+
+STEP_FILENAME='step.yml'
+
+#
+# Content-addressed keys
+#
+
+def file_digest(filename,block_size=1<<23): ## sha256 of file content
+    h=hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            h.update(block)
+    return h.hexdigest()
+
+def step_key(input_keys,module_name,module_version,protocol,**extra): ## key of a step = hash(input keys, module, version, protocol, extra parameters)
+    content={
+        'inputs': list(input_keys),
+        'module_name': module_name,
+        'module_version': module_version,
+        'protocol': protocol,
+        'extra': extra
+    }
+    serialized=json.dumps(content,sort_keys=True,default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def read_step_key(output_dir): ## key of the step that produced the results in output_dir (None if unknown)
+    fn=Path(output_dir).joinpath(STEP_FILENAME)
+    if not fn.exists(): return None
+    step=yaml.safe_load(open(fn,'r'))
+    if step is None: return None
+    return step.get('key')
+
+def clear_step(output_dir): ## invalidates the results in output_dir before recomputing
+    fn=Path(output_dir).joinpath(STEP_FILENAME)
+    if fn.exists(): fn.unlink()
+
+def write_step(output_dir,key,**info):
+    step={'key': key}
+    step.update(info)
+    with open(Path(output_dir).joinpath(STEP_FILENAME),'w') as f:
+        yaml.safe_dump(step,f)
+
+def rebase_path(value,old_root,new_root): ## absolute path under old_root -> same path under new_root, anything else unchanged
+    if not isinstance(value,str) or not os.path.isabs(value): return value ## relative paths are relative to the output root already
+    try:
+        relative=Path(os.path.normpath(value)).relative_to(Path(os.path.normpath(str(old_root))))
+    except ValueError:
+        return value
+    return str(Path(new_root).joinpath(relative))
+
+def rebase_paths(doc,old_root,new_root): ## rebases the path values of a result document (dicts and lists are walked)
+    if isinstance(doc,dict):
+        return {k:rebase_paths(v,old_root,new_root) for k,v in doc.items()}
+    if isinstance(doc,list):
+        return [rebase_paths(v,old_root,new_root) for v in doc]
+    return rebase_path(doc,old_root,new_root)
+
+#
+# Shared step cache
+#
+
+class StepCache(object): ### cache_dir/<key[:2]>/<key>/{step.yml, output/}
+    def __init__(self,cache_dir):
+        self.cache_dir=Path(cache_dir).absolute()
+        self.cache_dir.mkdir(parents=True,exist_ok=True)
+
+    def entryPath(self,key):
+        return self.cache_dir.joinpath(key[:2]).joinpath(key)
+
+    def contains(self,key):
+        entry=self.entryPath(key)
+        return entry.joinpath(STEP_FILENAME).exists() and entry.joinpath('output').joinpath('result.yml').exists()
+
+    def getEntry(self,key):
+        if not self.contains(key): return None
+        return yaml.safe_load(open(self.entryPath(key).joinpath(STEP_FILENAME),'r'))
+
+    @common.measure_time
+    def store(self,key,output_dir,output_root,**info): ## copies the step output directory into the cache
+        entry=self.entryPath(key)
+        if self.contains(key): return entry
+        tmp_entry=entry.parent.joinpath("{}.{}.tmp".format(key,common.get_uuid()))
+        try:
+            shutil.copytree(str(output_dir),str(tmp_entry.joinpath('output')))
+            step={'key': key, 'output_root': str(Path(output_root).absolute())}
+            step.update(info)
+            with open(tmp_entry.joinpath(STEP_FILENAME),'w') as f:
+                yaml.safe_dump(step,f)
+            os.rename(str(tmp_entry),str(entry)) ## atomic publish, another run may have stored the same key meanwhile
+        except OSError:
+            if not self.contains(key): raise
+        finally:
+            if tmp_entry.exists(): shutil.rmtree(str(tmp_entry),ignore_errors=True)
+        logger("Step stored in the cache : {}".format(key),common.Color.DEV)
+        return entry
+
+    @common.measure_time
+    def restore(self,key,output_dir,output_root): ## copies the cached output into output_dir, rebasing absolute paths to the new output root
+        entry=self.entryPath(key)
+        step=self.getEntry(key)
+        if step is None: return False
+        shutil.copytree(str(entry.joinpath('output')),str(output_dir),dirs_exist_ok=True)
+        old_root=Path(step['output_root'])
+        new_root=Path(output_root).absolute()
+        if old_root!=new_root:
+            result_filename=Path(output_dir).joinpath('result.yml')
+            result=yaml.safe_load(open(result_filename,'r'))
+            with open(result_filename,'w') as f:
+                yaml.safe_dump(rebase_paths(result,old_root,new_root),f)
+        logger("Step restored from the cache : {}".format(key),common.Color.DEV)
+        return True
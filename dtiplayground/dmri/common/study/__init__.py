@@ -1,7 +1,7 @@
 
 import yaml
 from pathlib import Path
-from dmri.common.study import loaders 
+from dtiplayground.dmri.common.study import loaders
 
 class Study(object):
   def __init__(self, studies: list, **kwargs):
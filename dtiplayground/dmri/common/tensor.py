@@ -0,0 +1,92 @@
+import dtiplayground.dmri.common as common
+from dtiplayground.dmri.common.dwi import get_affine_matrix_by_space
+import numpy as np
+import nrrd
+
+#
+# Tensor export utilities (3x3 symmetric tensors to 6-component 3D-symmetric-matrix NRRD)
+# component order : xx, xy, xz, yy, yz, zz (ref: http://teem.sourceforge.net/nrrd/format.html)
+#
+
+UPPER_TRIANGLE_INDEX=(np.array([0,0,0,1,1,2]),np.array([0,1,2,1,2,2]))
+
+def quadratic_form_to_tensor6(quad_form,dtype=np.float32): ## [...,3,3] -> [...,6]
+    rows,cols=UPPER_TRIANGLE_INDEX
+    return np.asarray(quad_form[...,rows,cols],dtype=dtype)
+
+def tensor_nrrd_header(information,sizes,target_space=None,encoding='gzip'): ## information : DWI.information of the source image
+    space=information['space']
+    space_directions=np.array(information['space_directions'])[:3,:3]
+    space_origin=np.array(information['space_origin'])
+    if target_space:
+        affine=get_affine_matrix_by_space(information,target_space)
+        space_directions=affine[:3,:3]
+        space_origin=affine[:3,3]
+        space=target_space
+    header={
+        "type": "float",
+        "dimension": 4,
+        "space": space,
+        "sizes": list(map(int,sizes)),
+        "space directions": space_directions.tolist()+[[np.NAN,np.NAN,np.NAN]],
+        "kinds": ['space','space','space','3D-symmetric-matrix'],
+        "endian": information['endian'],
+        "encoding": encoding,
+        "space origin": space_origin.tolist(),
+        "measurement frame": information['measurement_frame'],
+        "modality": 'DTI'
+    }
+    if information.get('original_centerings') is not None:
+        header["centerings"]=information['original_centerings']
+    if information.get('thicknesses') is not None:
+        header['thicknesses']=information['thicknesses']
+    return header
+
+@common.measure_time
+def write_tensor_nrrd(filename,tensor,information,target_space=None,encoding='gzip'): ## tensor : [x,y,z,6] or [x,y,z,3,3]
+    if tensor.ndim==5:
+        tensor=quadratic_form_to_tensor6(tensor)
+    tensor=np.asarray(tensor,dtype=np.float32)
+    header=tensor_nrrd_header(information,tensor.shape,target_space=target_space,encoding=encoding)
+    nrrd.write(str(filename),tensor,header=header)
+    return header
+
+#
+# Chunked tensor fitting over masked voxels
+#
+
+def _fit_chunk(task): ## worker : fits a [n,gradients] chunk of voxels, returns model params [n,12]
+    bvals,bvecs,b0_threshold,fit_method,fit_kwargs,voxels = task
+    import dipy.reconst.dti as dti
+    from dipy.core.gradients import gradient_table
+    gtab=gradient_table(bvals,bvecs,b0_threshold=b0_threshold)
+    model=dti.TensorModel(gtab,fit_method=fit_method,**fit_kwargs)
+    return model.fit(voxels).model_params
+
+def baseline_mask(data,gtab,median_radius=4,numpass=4): ## quick automatic brain mask from the mean baseline (median otsu)
+    from dipy.segment.mask import median_otsu
+    b0s=np.nonzero(gtab.b0s_mask)[0]
+    if len(b0s)==0: b0s=np.arange(data.shape[-1])
+    mean_b0=np.mean(np.asarray(data[...,b0s],dtype=float),axis=-1)
+    _,mask=median_otsu(mean_b0,median_radius=median_radius,numpass=numpass)
+    return mask
+
+@common.measure_time
+def fit_tensors(gtab,data,mask=None,fit_method='WLS',num_workers=1,chunk_size=20000,**fit_kwargs): ## returns dipy TensorFit over the whole grid
+    import dipy.reconst.dti as dti
+    if mask is None:
+        mask=np.ones(data.shape[:-1],dtype=bool)
+    mask=np.asarray(mask)>0
+    voxels=np.asarray(data[mask],dtype=float) ## masked voxels only [n,gradients]
+    num_voxels=voxels.shape[0]
+    logger=common.logger.write
+    logger("Fitting {} voxels ({:.1f}% of the grid) with {} workers, chunk size {}"
+        .format(num_voxels,100.0*num_voxels/max(1,mask.size),num_workers,chunk_size),common.Color.PROCESS)
+    tasks=((gtab.bvals,gtab.bvecs,gtab.b0_threshold,fit_method,fit_kwargs,voxels[b:b+chunk_size])
+                for b in range(0,num_voxels,chunk_size))
+    params=common.process_map(_fit_chunk,tasks,num_workers=num_workers)
+    model_params=np.zeros(mask.shape+(12,),dtype=float)
+    if len(params)>0:
+        model_params[mask]=np.concatenate(params,axis=0)
+    model=dti.TensorModel(gtab,fit_method=fit_method,**fit_kwargs)
+    return dti.TensorFit(model,model_params)
@@ -7,6 +7,7 @@
 #   External tool wrapper base class
 #
 
+import os
 import sys
 import time
 from pathlib import Path 
@@ -36,6 +37,12 @@ class ExternalToolWrapper(object):
         self.binary_path=binary_path
         self.arguments=[]
         self.dev_mode=True
+        self.environment=None ## None : inherits the environment of the process
+
+    def setEnvironment(self,variables:dict): ## extra environment variables of the executions (e.g. thread limits)
+        env=dict(os.environ)
+        env.update({k:str(v) for k,v in variables.items()})
+        self.environment=env
 
     def setDevMode(self,tf:bool):
         self.dev_mode=tf 
@@ -63,7 +70,7 @@ class ExternalToolWrapper(object):
     def executeWithArgumentString(self,arguments:str):
         args_list=arguments.split()
         command=[self.getPath()]+self.arguments 
-        output=sp.run(command,capture_output=True,text=True)
+        output=sp.run(command,capture_output=True,text=True,env=self.environment)
         #output.check_returncode()
         return output ## output.returncode, output.stdout output.stderr, output.args, output.check_returncode()
 
@@ -73,7 +80,7 @@ class ExternalToolWrapper(object):
         logger = self.logger.write
         command=self.getCommand()
         if arguments is not None: command=[self.binary_path]+arguments
-        output=sp.run(command,capture_output=True,text=True,stdin=stdin)
+        output=sp.run(command,capture_output=True,text=True,stdin=stdin,env=self.environment)
         if self.dev_mode:
             logger("{}\n{} {}".format(output.args,output.stdout,output.stderr))
             output.check_returncode()
@@ -84,7 +91,7 @@ class ExternalToolWrapper(object):
         command=self.getCommand()
         if arguments is not None: command=[self.binary_path]+arguments
         if stdin is None:
-            pipe_output=sp.Popen(command,stdout=sp.PIPE)
+            pipe_output=sp.Popen(command,stdout=sp.PIPE,env=self.environment)
         else:
-            pipe_output=sp.Popen(command,stdin=stdin,stdout=sp.PIPE)
+            pipe_output=sp.Popen(command,stdin=stdin,stdout=sp.PIPE,env=self.environment)
         return pipe_output 
\ No newline at end of file
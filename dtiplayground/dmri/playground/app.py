@@ -55,13 +55,17 @@ class DMRIPlaygroundApp(AppBase):
             options.setdefault('browser', False)
             options.setdefault('static_page_dir', spa_dir)
             options.setdefault('debug', False)
+            options.setdefault('max_jobs', 1)
+            options.setdefault('job_threads', None)
             config = {
                 "config_dir": Path(self.app['application_dir']).parent.__str__(),
                 "host" : options['host'],
                 "port" : options['port'],
                 "static_page_dir" : options['static_page_dir'],
                 "browser" : options['browser'],
-                "debug" : options['debug']
+                "debug" : options['debug'],
+                "max_jobs" : options['max_jobs'],
+                "job_threads" : options['job_threads']
             }
             config_dir = Path(config['config_dir'])
 
@@ -8,6 +8,8 @@ measure_time=common.measure_time
 Color=common.Color
 get_uuid=common.get_uuid
 object_by_id=common.object_by_id
+process_map=common.process_map
+run_dag=common.run_dag
 get_timestamp=common.get_timestamp
 dwi = dwi
 protocols = pipeline
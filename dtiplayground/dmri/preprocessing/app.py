@@ -14,6 +14,7 @@ import dtiplayground.dmri.common.module as module
 from dtiplayground.dmri.common.appbase import AppBase
 
 import dtiplayground.dmri.preprocessing as preprocessing
+import dtiplayground.dmri.preprocessing.batch as batch
 logger=common.logger.write 
 color= common.Color
 
@@ -78,6 +79,11 @@ class DMRIPrepApp(AppBase):
             _options.setdefault('output_format', None)
             _options.setdefault('global_variables',{})
             _options.setdefault('no_output_image', False)
+            _options.setdefault('step_cache_dir', None)
+            _options.setdefault('in_memory_handoff', True)
+            _options.setdefault('parallel_inputs', True)
+            _options.setdefault('write_policy_intermediate', None)
+            _options.setdefault('write_policy_final', None)
 
             options={
                 "config_dir" : self.app['application_dir'],
@@ -91,6 +97,11 @@ class DMRIPrepApp(AppBase):
                 "output_format" : _options['output_format'],
                 "output_file_base" : _options['output_file_base'],
                 "no_output_image" : _options['no_output_image'],
+                "step_cache_dir" : _options['step_cache_dir'],
+                "in_memory_handoff" : _options['in_memory_handoff'],
+                "parallel_inputs" : _options['parallel_inputs'],
+                "write_policy_intermediate" : _options['write_policy_intermediate'],
+                "write_policy_final" : _options['write_policy_final'],
                 "global_variables" : _options['global_variables']
             }
 
@@ -116,6 +127,13 @@ class DMRIPrepApp(AppBase):
                 proto.makeDefaultProtocols(options['default_protocols'],template=template,options=options)
             if options['num_threads'] is not None:
                 proto.setNumThreads(options['num_threads'])
+            if options['step_cache_dir'] is not None:
+                proto.setStepCacheDirectory(options['step_cache_dir'])
+            if not options['in_memory_handoff']:
+                proto.setInMemoryHandoff(False)
+            if not options['parallel_inputs']:
+                proto.setParallelInputs(False)
+            proto.setWritePolicy(options['write_policy_intermediate'],options['write_policy_final'])
             Path(options['output_dir']).mkdir(parents=True,exist_ok=True)
             logfilename=str(Path(options['output_dir']).joinpath('log.txt').absolute())
             common.logger.setLogfile(logfilename)  
@@ -126,6 +144,53 @@ class DMRIPrepApp(AppBase):
 
         return _run(_options)
 
+    def runBatch(self,_options):
+
+        @self.after_initialized
+        def _run_batch(_options):
+            _options.setdefault('modality', 'dwi')
+            _options.setdefault('num_threads', 1)
+            _options.setdefault('num_jobs', None)
+            _options.setdefault('max_cores', None)
+            _options.setdefault('baseline_threshold', 10)
+            _options.setdefault('output_format', None)
+            _options.setdefault('output_file_base', None)
+            _options.setdefault('global_variables',{})
+            _options.setdefault('no_output_image', False)
+            _options.setdefault('step_cache_dir', None)
+            _options.setdefault('in_memory_handoff', True)
+            _options.setdefault('parallel_inputs', True)
+            _options.setdefault('write_policy_intermediate', None)
+            _options.setdefault('write_policy_final', None)
+
+            run_options={ ## options of runQC for every job, input and output are set per job
+                "config_dir" : str(self.config_dir),
+                "protocol_path" : _options['protocol_path'],
+                "default_protocols":_options['default_protocols'],
+                "baseline_threshold" : _options['baseline_threshold'],
+                "output_format" : _options['output_format'],
+                "output_file_base" : _options['output_file_base'],
+                "no_output_image" : _options['no_output_image'],
+                "step_cache_dir" : _options['step_cache_dir'],
+                "in_memory_handoff" : _options['in_memory_handoff'],
+                "parallel_inputs" : _options['parallel_inputs'],
+                "write_policy_intermediate" : _options['write_policy_intermediate'],
+                "write_policy_final" : _options['write_policy_final'],
+                "global_variables" : _options['global_variables']
+            }
+            if _options['output_dir'] is None:
+                raise Exception("Output directory is missing")
+            logger("\r----------------------------------- Batch Begins ----------------------------------------\n")
+            res=batch.run_batch(_options['study_dirs'],_options['output_dir'],run_options,
+                                modality=_options['modality'],
+                                num_threads=_options['num_threads'],
+                                num_jobs=_options['num_jobs'],
+                                max_cores=_options['max_cores'])
+            logger("\r----------------------------------- Batch Done ----------------------------------------\n")
+            return res
+
+        return _run_batch(_options)
+
     def makeProtocols(self, _options):
 
         @self.after_initialized
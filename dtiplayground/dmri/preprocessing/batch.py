@@ -0,0 +1,217 @@
+#
+# Cohort batch runner
+#   Every run of a modality (dwi) in BIDS studies (common.study.loaders.load_bids) is processed by its own dmriprep pipeline
+#   in its own process, with at most num_jobs processes at a time. Each job gets a thread budget so that (concurrent jobs x threads per job) <= cores.
+#   Job states are kept in a manifest in the output directory, an interrupted batch resumes with the jobs that are not done
+#   (all jobs are processed again if the protocol file or the run options changed).
+#
+
+import dtiplayground
+import dtiplayground.dmri.common as common
+from dtiplayground.dmri.common.study import loaders
+
+import os
+import sys
+import time
+import hashlib
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import yaml
+
+logger=common.logger.write
+color=common.Color
+
+MANIFEST_FILENAME='batch_manifest.yml'
+SUMMARY_FILENAME='batch_summary.yml'
+IMAGE_EXTENSIONS=['.nrrd','.nhdr','.nii','.nii.gz']
+THREAD_VARIABLES=['OMP_NUM_THREADS','ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+EXECUTION_OPTIONS=['num_threads','step_cache_dir','in_memory_handoff','parallel_inputs'] ## run options that do not change the outputs of a job
+
+### Jobs
+
+def _image_filename(run): ## image file of a run (files also have the json/bval/bvec sidecars)
+    for fn in run['files']:
+        if fn.split('.')[0]==run['run_id'] and any(fn.endswith(ext) for ext in IMAGE_EXTENSIONS):
+            return fn
+    return None
+
+def enumerate_jobs(study_dirs,output_dir,modality='dwi'): ## one job per run of the modality, output in output_dir/<subject>/<session>/<run>
+    jobs=[]
+    for study in loaders.load_bids(study_dirs):
+        root=Path(study['root_dir'])
+        for subject in study['subjects']:
+            for session in subject['sessions']:
+                for mod in session['modalities']:
+                    if mod['modality_type']!=modality: continue
+                    for run in mod['runs']:
+                        fn=_image_filename(run)
+                        if fn is None: continue
+                        job_id='/'.join([subject['subject_id'],session['session_id'],run['run_id']])
+                        jobs.append({'job_id': job_id,
+                                     'input_image': str(root.joinpath(subject['subject_id'],session['session_id'],mod['modality_type'],fn).absolute()),
+                                     'output_dir': str(Path(output_dir).joinpath(job_id).absolute()),
+                                     'status': 'pending',
+                                     'started': None,
+                                     'finished': None,
+                                     'wall_time': None,
+                                     'error': None})
+    jobs.sort(key=lambda x: x['job_id'])
+    return jobs
+
+def thread_budget(num_threads=1,num_jobs=None,max_cores=None): ## returns (concurrent jobs, threads per job) with jobs x threads <= cores
+    cores=max_cores or os.cpu_count() or 1
+    num_threads=max(1,min(int(num_threads),cores))
+    if num_jobs is None:
+        num_jobs=cores//num_threads
+    num_jobs=max(1,min(int(num_jobs),cores))
+    if num_jobs*num_threads>cores:
+        num_threads=max(1,cores//num_jobs)
+    return num_jobs,num_threads
+
+### Manifest
+
+def load_manifest(output_dir):
+    fn=Path(output_dir).joinpath(MANIFEST_FILENAME)
+    if not fn.exists(): return None
+    return yaml.safe_load(open(fn,'r'))
+
+def write_manifest(output_dir,manifest): ## atomic, the manifest is rewritten after every job
+    fn=Path(output_dir).joinpath(MANIFEST_FILENAME)
+    tmp_fn=fn.parent.joinpath(fn.name+'.tmp')
+    with open(tmp_fn,'w') as f:
+        yaml.safe_dump(manifest,f,sort_keys=False)
+    os.replace(str(tmp_fn),str(fn))
+
+def batch_settings(run_options): ## what the outputs of a job depend on besides its input : protocol (path and content) and run options
+    protocol_path=run_options.get('protocol_path')
+    protocol_hash=None
+    if protocol_path is not None and Path(protocol_path).exists():
+        with open(protocol_path,'rb') as f:
+            protocol_hash=hashlib.sha256(f.read()).hexdigest()
+    options={k:v for k,v in run_options.items() if k not in EXECUTION_OPTIONS+['protocol_path']}
+    return yaml.safe_load(yaml.safe_dump({'protocol_path': protocol_path,
+                                          'protocol_hash': protocol_hash,
+                                          'run_options': options}))
+
+def merge_manifest(jobs,previous,settings): ## keeps the state of the jobs already in the manifest if the settings are unchanged, other jobs are pending
+    if previous is None: return jobs
+    if any(previous.get(k)!=v for k,v in settings.items()):
+        logger("Protocol or run options changed since the previous batch, every job is processed again",color.WARNING)
+        return jobs
+    states={j['job_id']:j for j in previous['jobs']}
+    merged=[]
+    for job in jobs:
+        old=states.get(job['job_id'])
+        if old is not None and old['input_image']==job['input_image'] and old['status']=='done':
+            job=old
+        merged.append(job)
+    return merged
+
+def summarize(jobs):
+    summary={'number_of_jobs': len(jobs)}
+    for status in ['done','failed','pending']:
+        summary[status]=len([j for j in jobs if j['status']==status])
+    times=[j['wall_time'] for j in jobs if j['status']=='done' and j['wall_time'] is not None]
+    summary['wall_time']={'total': float(sum(times)),
+                          'mean': float(sum(times)/len(times)) if len(times)>0 else None,
+                          'min': float(min(times)) if len(times)>0 else None,
+                          'max': float(max(times)) if len(times)>0 else None}
+    summary['failed_jobs']=[j['job_id'] for j in jobs if j['status']=='failed']
+    summary['jobs']=[{k:j[k] for k in ['job_id','status','wall_time','output_dir']} for j in jobs]
+    return summary
+
+### Execution
+
+JOB_FILENAME='batch_job.yml'
+PACKAGE_ROOT=str(Path(dtiplayground.__file__).resolve().parent.parent)
+JOB_COMMAND='import sys; from dtiplayground.dmri.preprocessing.batch import run_job; sys.exit(run_job(sys.argv[1]))'
+
+def run_job(job_filename): ## entry point of a job process : runs the pipeline of the job file and writes the state back into it
+    with open(job_filename,'r') as f:
+        task=yaml.safe_load(f)
+    job,options=task['job'],task['options']
+    try:
+        common.logger.setVerbosity(False) ## the job log is in <output_dir>/log.txt
+        from dtiplayground.dmri.preprocessing.app import DMRIPrepApp
+        import dtiplayground.dmri.preprocessing.modules
+        import dtiplayground.dmri.preprocessing.protocols
+        run_options=dict(options)
+        run_options.update({'input_image_paths': [job['input_image']],
+                            'output_dir': job['output_dir'],
+                            'execution_id': common.get_uuid()})
+        app=DMRIPrepApp(options['config_dir'])
+        app.app['no_verbosity']=True
+        app.run(run_options)
+        job['status']='done'
+        job['error']=None
+    except Exception:
+        job['status']='failed'
+        job['error']=traceback.format_exc()
+    with open(job_filename,'w') as f:
+        yaml.safe_dump({'job': job,'options': options},f,sort_keys=False)
+    return 0 if job['status']=='done' else 1
+
+def _execute(job,options,num_threads): ## runs a job in its own interpreter with its thread budget, returns the job with its state
+    job=dict(job)
+    job.update({'status': 'pending','error': None}) ## a failed job of a previous batch must not look finished if the process dies
+    job['started']=common.get_timestamp()
+    bt=time.time()
+    job_filename=Path(job['output_dir']).joinpath(JOB_FILENAME)
+    job_filename.parent.mkdir(parents=True,exist_ok=True)
+    with open(job_filename,'w') as f:
+        yaml.safe_dump({'job': job,'options': options},f,sort_keys=False)
+    env=dict(os.environ)
+    env.update({k:str(num_threads) for k in THREAD_VARIABLES}) ## read by the libraries when they are loaded in the job process
+    env['PYTHONPATH']=os.pathsep.join([PACKAGE_ROOT]+([env['PYTHONPATH']] if env.get('PYTHONPATH') else [])) ## same package as the batch (development checkout)
+    proc=subprocess.run([sys.executable,'-c',JOB_COMMAND,str(job_filename)],env=env,
+                        stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True)
+    with open(job_filename,'r') as f:
+        result=yaml.safe_load(f)['job']
+    if result['status']=='pending': ## the process died before writing its state
+        result['status']='failed'
+        result['error']="Job process exited with code {}\n{}".format(proc.returncode,proc.stderr[-4096:])
+    job.update({'status': result['status'],'error': result['error']})
+    job['wall_time']=float(time.time()-bt)
+    job['finished']=common.get_timestamp()
+    return job
+
+def run_batch(study_dirs,output_dir,run_options,modality='dwi',num_threads=1,num_jobs=None,max_cores=None):
+    output_dir=Path(output_dir).absolute()
+    output_dir.mkdir(parents=True,exist_ok=True)
+    settings=batch_settings(run_options)
+    jobs=merge_manifest(enumerate_jobs(study_dirs,output_dir,modality),load_manifest(output_dir),settings)
+    num_jobs,num_threads=thread_budget(num_threads,num_jobs,max_cores)
+    manifest={'study_dirs': [str(Path(x).absolute()) for x in study_dirs],
+              'modality': modality}
+    manifest.update(settings)
+    manifest['jobs']=jobs
+    write_manifest(output_dir,manifest)
+    todo=[idx for idx,j in enumerate(jobs) if j['status']!='done']
+    logger("Batch : {} runs found, {} already done, {} to process with {} concurrent jobs x {} threads".format(
+        len(jobs),len(jobs)-len(todo),len(todo),num_jobs,num_threads),color.INFO)
+
+    run_options=dict(run_options)
+    run_options['num_threads']=num_threads
+    bt=time.time()
+    with ThreadPoolExecutor(max_workers=num_jobs) as executor: ## each worker drives one job process at a time
+        futures={executor.submit(_execute,jobs[idx],run_options,num_threads):idx for idx in todo}
+        for count,future in enumerate(as_completed(futures)):
+            job=future.result()
+            jobs[futures[future]]=job
+            write_manifest(output_dir,manifest)
+            logger("[{}/{}] {} : {} ({:.1f}s)".format(count+1,len(todo),job['job_id'],job['status'],job['wall_time']),
+                   color.OK if job['status']=='done' else color.ERROR)
+
+    summary=summarize(jobs)
+    summary['batch_wall_time']=float(time.time()-bt)
+    summary['concurrent_jobs']=num_jobs
+    summary['threads_per_job']=num_threads
+    with open(output_dir.joinpath(SUMMARY_FILENAME),'w') as f:
+        yaml.safe_dump(summary,f,sort_keys=False)
+    logger("Batch done : {} done, {} failed, {} pending , wall time {:.1f}s".format(summary['done'],summary['failed'],summary['pending'],summary['batch_wall_time']),
+           color.OK if summary['failed']==0 else color.WARNING)
+    for job_id in summary['failed_jobs']:
+        logger("Failed : {} (see {})".format(job_id,MANIFEST_FILENAME),color.ERROR)
+    return summary
@@ -13,15 +13,10 @@ from pathlib import Path
 import os
 import markdown
 
-from dipy.align.imaffine import (transform_centers_of_mass,
-                                 AffineMap,
-                                 MutualInformationMetric,
-                                 AffineRegistration)
+from dipy.align.imaffine import AffineMap
 import dipy.align 
-from dipy.align.transforms import (TranslationTransform3D,
-                                   RigidTransform3D,
-                                   AffineTransform3D)
 import dtiplayground.dmri.preprocessing as prep
+import dtiplayground.dmri.common.registration as registration
 import copy
 
 
@@ -30,7 +25,10 @@ def baseline_average(image_obj, opt,
                       averageMethod='BaselineOptimized',
                       b0Threshold=10,
                       stopThreshold=0.02,
-                      maxIterations=2):
+                      maxIterations=2,
+                      num_threads=1,
+                      param_tolerance=None,
+                      computations=None):
     
     image=copy.copy(image_obj)
     averaged_baseline_image=None #2d image
@@ -51,30 +49,33 @@ def baseline_average(image_obj, opt,
         else: only_one_baseline=True
 
     ### computation
-    if no_baseline:
+    if computations is not None:
+        output=reuse_computations(image, computations, b0Threshold)
+    elif no_baseline:
         logger("[WARNING] There was no baseline found",prep.Color.WARNING)
-        b0Threshold = min(list(map(lambda x: x['b_value'], image.getGradients())))
+        b0Threshold = float(np.min(image.getGradientTable().b_values))
         #return None,[]
         output=direct_average(image, averageInterpolationMethod, b0Threshold,stopThreshold)
     elif averageMethod=='DirectAverage' or only_one_baseline:
         if only_one_baseline: logger("Only one baseline was found, averaging method will be changed to DirectAverage",prep.Color.WARNING)
         output=direct_average(image, averageInterpolationMethod, b0Threshold,stopThreshold)
     elif averageMethod=='BaselineOptimized':    
-        output=baseline_optimized_average(image, averageInterpolationMethod, b0Threshold,stopThreshold,maxIterations)
+        output=baseline_optimized_average(image, averageInterpolationMethod, b0Threshold,stopThreshold,maxIterations,num_threads,param_tolerance)
     elif averageMethod=='BSplineOptimized':
         logger("[WARNING] BSplineOptimized method is NOT implemented, averaging method will be changed to baseline optimized averaging",prep.Color.WARNING)
-        output=baseline_optimized_average(image, averageInterpolationMethod, b0Threshold,stopThreshold,maxIterations)
+        output=baseline_optimized_average(image, averageInterpolationMethod, b0Threshold,stopThreshold,maxIterations,num_threads,param_tolerance)
 
     averaged_baseline_volume = output['averaged_baseline']
     output_gradient= output['output_baseline_gradient'] ## single gradient
     baseline_gradients= output['baseline_gradients']
 
     #post processing. To remove baselines from the original image and insert the averaged basline image. Re-indexing of gradients
+    image.promote(float) ## averaged baseline is not to be truncated to the on-disk dtype (lazy loaded images)
     image.deleteGradientsByOriginalIndex([x['original_index'] for x in baseline_gradients])
     image.insertGradient(output_gradient,averaged_baseline_volume,pos=0)
     excluded_gradients_original_indexes=[x['original_index'] for x in baseline_gradients]
 
-    return image , excluded_gradients_original_indexes
+    return image , excluded_gradients_original_indexes, output['computations']
 
 def default_output_gradient():
     return {
@@ -92,11 +93,21 @@ def direct_average(image_obj, averageInterpolationMethod , b0Threshold, stopThre
     out_gradient=default_output_gradient()
     output={"averaged_baseline" : np.mean(baseline_images,axis=3) ,
             "output_baseline_gradient" : out_gradient, 
-            "baseline_gradients" : baseline_grads}
+            "baseline_gradients" : baseline_grads,
+            "computations" : {"method": "DirectAverage",
+                              "b0_threshold": float(b0Threshold),
+                              "baseline_original_indexes": [int(x['original_index']) for x in baseline_grads],
+                              "affines": None,
+                              "iterations": [],
+                              "converged": True}}
     logger("Direct averaging DONE ",prep.Color.OK)
     return output
 
-def baseline_optimized_average(image_obj, averageInterpolationMethod , b0Threshold, stopThreshold, maxIterations=2):
+def _register_baseline(task): ## worker : (static, moving, affine, starting_affine, param_tolerance) -> (transformed, affine)
+    static, moving, affine, starting_affine, param_tolerance = task
+    return registration.rigid_3d(static,moving,affine,affine,sampling_prop=0.1,starting_affine=starting_affine,param_tolerance=param_tolerance)
+
+def baseline_optimized_average(image_obj, averageInterpolationMethod , b0Threshold, stopThreshold, maxIterations=2, num_threads=1, param_tolerance=None):
     logger("Baseline Optimized averaging on baselines ... ",prep.Color.PROCESS)
     baseline_grads, baseline_images=image_obj.getBaselines(b0_threshold=b0Threshold)
     out_gradient=default_output_gradient()
@@ -104,26 +115,30 @@ def baseline_optimized_average(image_obj, averageInterpolationMethod , b0Thresho
     static=np.mean(baseline_images,axis=3) #initial direct averaging 
     previous_static=copy.copy(static)
     averaged_image=copy.copy(static)
-    moving_images=copy.copy(baseline_images)
+    moving_images=baseline_images ## original baselines, every iteration resamples them once from the warm-started affine
     x,y,z,g = moving_images.shape
+    affines=[None]*g ## None : center of mass initialization
 
     succeeded=False
+    iterations=[]
     for i in range(maxIterations):
-        temp_images=[]
-        logger("Iteration {}/{}".format(i+1,maxIterations),prep.Color.PROCESS)
-        for gidx in range(g):
-
-            ## rigid 3d registration to the averaged image
-            logger("Rigid registration {}/{}".format(gidx+1,g),prep.Color.PROCESS)
-            moving=moving_images[:,:,:,gidx]
-            transformed, out_affine = rigid_3d(static,moving,affine,affine,sampling_prop=0.1)
-            temp_images.append(transformed)
+        bt=time.time()
+        logger("Iteration {}/{}, rigid registration of {} baselines".format(i+1,maxIterations,g),prep.Color.PROCESS)
+        tasks=((static,moving_images[:,:,:,gidx],affine,affines[gidx],param_tolerance) for gidx in range(g))
+        registrations=prep.process_map(_register_baseline,tasks,num_workers=num_threads)
+        registration.release_rigid_registration() ## serial runs registered in this thread, the static pyramid is not needed anymore
+        affines=[out_affine for _,out_affine in registrations]
   
-        moving_images=np.moveaxis(np.array(temp_images),0,-1) ## replace existing moving images with registered images
-        static=np.mean(moving_images,axis=3) ## re average transformed moving images
+        registered_images=np.moveaxis(np.array([transformed for transformed,_ in registrations]),0,-1)
+        static=np.mean(registered_images,axis=3) ## re average transformed moving images
         error=computeErrorRatio(static,previous_static)
+        converged=bool(error < stopThreshold)
+        iterations.append({"iteration": i+1,
+                           "wall_time": float(time.time()-bt),
+                           "error_ratio": float(error),
+                           "converged": converged})
                
-        if error < stopThreshold:
+        if converged:
             succeeded=True
             averaged_image=static 
             logger("Error ratio : {:.4f} < tolerance level {:.4f}".format(error,stopThreshold),prep.Color.OK)
@@ -134,14 +149,45 @@ def baseline_optimized_average(image_obj, averageInterpolationMethod , b0Thresho
 
     if not succeeded:
         logger("[WARNING] BaselineOptimized averaging failed, so direct averaging will be performed",prep.Color.WARNING)
-        return direct_average(image_obj, averageInterpolationMethod, b0Threshold,stopThreshold)
+        output=direct_average(image_obj, averageInterpolationMethod, b0Threshold,stopThreshold)
+        output['computations']['iterations']=iterations
+        output['computations']['converged']=False
+        return output
 
     output={"averaged_baseline" : averaged_image,
             "output_baseline_gradient" : out_gradient, 
-            "baseline_gradients" : baseline_grads}
+            "baseline_gradients" : baseline_grads,
+            "computations" : {"method": "BaselineOptimized",
+                              "b0_threshold": float(b0Threshold),
+                              "baseline_original_indexes": [int(x['original_index']) for x in baseline_grads],
+                              "affines": [x.tolist() for x in affines],
+                              "iterations": iterations,
+                              "converged": True}}
     logger("Baseline Optimized averaging DONE",prep.Color.OK)
     return output
 
+def reuse_computations(image_obj, computations, b0Threshold): ## rebuild the averaged baseline from computations.yml without registration
+    logger("Averaging baselines from the computed parameters ... ",prep.Color.PROCESS)
+    grads=image_obj.getGradients(b0Threshold)
+    baseline_grads=[x for x in grads if x['original_index'] in computations['baseline_original_indexes']]
+    baseline_images=image_obj.images[:,:,:,[x['index'] for x in baseline_grads]]
+    if computations['affines'] is None:
+        averaged_image=np.mean(baseline_images,axis=3)
+    else:
+        affine=image_obj.getAffineMatrixForNifti()
+        volumes=[]
+        for gidx,mat in enumerate(computations['affines']):
+            moving=baseline_images[:,:,:,gidx]
+            affine_map=AffineMap(np.array(mat),domain_grid_shape=moving.shape,domain_grid2world=affine,
+                                 codomain_grid_shape=moving.shape,codomain_grid2world=affine)
+            volumes.append(affine_map.transform(moving))
+        averaged_image=np.mean(np.moveaxis(np.array(volumes),0,-1),axis=3)
+    output={"averaged_baseline" : averaged_image,
+            "output_baseline_gradient" : default_output_gradient(), 
+            "baseline_gradients" : baseline_grads,
+            "computations" : computations}
+    return output
+
 def computeErrorRatio(static,moving):
 
     sq_diff=np.mean((static-moving)**2)
@@ -170,56 +216,6 @@ def decompose_affine_matrix(mat4d): ## in case
          "perspective":persp.tolist()}
     return res
 
-@prep.measure_time
-def rigid_3d(static,moving,
-             affine_static,affine_moving,
-             nbins=32,
-             level_iters=[10000,1000,100],
-             sigmas=[3.0,1.0,0.0],
-             factors=[4,2,1],
-             sampling_prop=None):
-    ## Make affine map
-    identity=np.eye(4)
-    affine_map=AffineMap(identity,static.shape, affine_static,
-                                  moving.shape, affine_static)
-
-    ## Resample moving image from affine (but same in a volume)
-    resampled=affine_map.transform(moving)
-
-    ## center of mass transform
-    c_of_mass = transform_centers_of_mass(static, affine_static, moving, affine_moving)
-    transformed=c_of_mass.transform(moving)
-
-    ## registration preparation
-    metric= MutualInformationMetric(nbins,sampling_prop)
-    affreg= AffineRegistration(metric=metric, 
-                               level_iters=level_iters, 
-                               sigmas=sigmas, 
-                               factors=factors,
-                               verbosity=0)
-
-    ## Translation transform registration
-    transform=TranslationTransform3D()
-    params0=None
-    starting_affine= c_of_mass.affine
-    translation=affreg.optimize(static, 
-                                moving, 
-                                transform, 
-                                params0, 
-                                affine_static,affine_moving, 
-                                starting_affine=starting_affine)
-    transformed = translation.transform(moving)
-
-    ## Ridid registration
-    transform=RigidTransform3D()
-    params0=None
-    starting_affine=translation.affine
-    rigid=affreg.optimize(static,moving,transform,params0,affine_static,affine_moving,starting_affine=starting_affine)
-    transformed = rigid.transform(moving)
-
-    return transformed, rigid.affine 
-
-
 class BASELINE_Average(prep.modules.DTIPrepModule):
     def __init__(self,config_dir,*args,**kwargs):
         super().__init__(config_dir,*args,**kwargs)
@@ -237,6 +233,7 @@ class BASELINE_Average(prep.modules.DTIPrepModule):
         inputParams=self.getPreviousResult()['output']
         opts=args[0]
         self.baseline_threshold=opts['baseline_threshold']
+        self.num_threads=opts['software_info']['parameters']['num_max_threads']
 
         output=None
         output_image_path=Path(self.output_dir)
@@ -246,26 +243,31 @@ class BASELINE_Average(prep.modules.DTIPrepModule):
             output_image_path=str(output_image_path.joinpath('output.nii.gz'))
         
         output_filename=Path(self.computation_dir).joinpath('computations.yml')
-        if output_filename.exists() and not self.options['recompute']: 
+        computations=None
+        if output_filename.exists() and not self.options.get('recompute',False): 
             ## pass recomputation
-            logger("Computing ommited",prep.Color.INFO)
-            pass
+            logger("Computing ommited, computed parameters are loaded : {}".format(str(output_filename)),prep.Color.INFO)
+            computations=yaml.safe_load(open(output_filename,'r'))
         else: ##computed parameters doesn't exist or recompute is true
             ## compute or recompute
             logger("Computing ... ",prep.Color.PROCESS)
-            #self.image.deleteGradientsByOriginalIndex([49, 65, 97, 129, 145])#([0, 17, 49, 65, 97, 129, 145]) For test
-            new_image, excluded_original_indexes=baseline_average(self.image, opt=None ,
-                                                      averageInterpolationMethod=self.protocol['averageInterpolationMethod'],
-                                                      averageMethod=self.protocol['averageMethod'],
-                                                      b0Threshold=self.baseline_threshold,
-                                                      stopThreshold=self.protocol['stopThreshold'],
-                                                      maxIterations=self.protocol['maxIterations'])
+        #self.image.deleteGradientsByOriginalIndex([49, 65, 97, 129, 145])#([0, 17, 49, 65, 97, 129, 145]) For test
+        new_image, excluded_original_indexes, computations=baseline_average(self.image, opt=None ,
+                                                  averageInterpolationMethod=self.protocol['averageInterpolationMethod'],
+                                                  averageMethod=self.protocol['averageMethod'],
+                                                  b0Threshold=self.baseline_threshold,
+                                                  stopThreshold=self.protocol['stopThreshold'],
+                                                  maxIterations=self.protocol['maxIterations'],
+                                                  num_threads=self.num_threads,
+                                                  param_tolerance=self.protocol.get('registrationTolerance',0.0) or None, ## 0 : every resolution level
+                                                  computations=computations)
+        yaml.safe_dump(computations,open(output_filename,'w'))
 
         if new_image is not None:
             self.image=new_image
             ### if image is changed, next module should load the file. So set image_object to None and write the file instead
         self.image.setSpaceDirection(target_space=self.getSourceImageInformation()['space'])
-        self.writeImage(output_image_path,dest_type=self.image.image_type)
+        self.writeImage(output_image_path,dest_type=self.image.image_type,background=True)
 
         ### output preparation
         self.result['output']['excluded_gradients_original_indexes']=excluded_original_indexes
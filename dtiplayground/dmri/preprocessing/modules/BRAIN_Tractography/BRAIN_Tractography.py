@@ -27,6 +27,7 @@ import dtiplayground.dmri.preprocessing as prep
 import dtiplayground.dmri.common as common
 import dtiplayground.dmri.common.tools as tools 
 from dtiplayground.dmri.common.dwi import DWI
+from dtiplayground.dmri.common.tensor import write_tensor_nrrd
 
 color = common.Color
 
@@ -64,8 +65,8 @@ class BRAIN_Tractography(prep.modules.DTIPrepModule):
         data = self.image.images
         affine = self.image.getAffineMatrixForNifti()
         # affine=img.affine
-        bvecs = [x['nifti_gradient'] for x in self.image.getGradients()]
-        bvals = [x['b_value'] for x in self.image.getGradients()]
+        bvecs = self.image.getGradientTable().vector('nifti_gradient')
+        bvals = self.image.getGradientTable().b_values
         gradient_tab = gradient_table(bvals,bvecs)
 
 ## new code ends
@@ -146,31 +147,11 @@ class BRAIN_Tractography(prep.modules.DTIPrepModule):
 
     @common.measure_time
     def saveTensor(self, fitted):
-        ## convert 3x3 symmetric matrices to xx,xy,xz,yy,yz,zz vectors
-        np=numpy
+        ## convert 3x3 symmetric matrices to xx,xy,xz,yy,yz,zz vectors and write 3D-symmetric-matrix nrrd
         logger("Reducing 3x3 symmetric matrix to vector")
-        def uppertriangle(matrix):
-            outvec=[]
-            for i in range(3):
-                for j in range(i,3):
-                    outvec.append(matrix[i,j])
-            return np.array(outvec)
-        quad_form = fitted.quadratic_form
-        new_quadform = np.ndarray(shape=(quad_form.shape[0],quad_form.shape[1],quad_form.shape[2],6),dtype=float)
-        for d1 in range(quad_form.shape[0]):
-            for d2 in range(quad_form.shape[1]):
-                for d3 in range(quad_form.shape[2]):
-                    mat = quad_form[d1,d2,d3]
-                    new_quadform[d1,d2,d3]=uppertriangle(mat)
-
-        # TODO : make nrrd file for new_quadform image volume (kind will be "3D-symmetric-matrix") , ref: http://teem.sourceforge.net/nrrd/format.html
-        temp_dti_image = DWI()
-        temp_dti_image.copyFrom(self.image, image=False, gradients=False)
-        temp_dti_image.setImage(new_quadform,modality='DTI', kinds=['space','space','space','3D-symmetric-matrix'])
         dti_filename=Path(self.output_dir).joinpath('tensor.nrrd').__str__()
         sp_dir=self.getSourceImageInformation()['space']
-        temp_dti_image.setSpaceDirection(target_space=sp_dir)
-        temp_dti_image.writeImage(dti_filename,dest_type='nrrd',dtype="float32")
+        write_tensor_nrrd(dti_filename,fitted.quadratic_form,self.image.information,target_space=sp_dir)
         self.addOutputFile(dti_filename, 'DTI')
         self.addGlobalVariable('dti_path',dti_filename)
 
@@ -3,6 +3,7 @@ import dtiplayground.dmri.preprocessing as prep
 from dtiplayground.dmri.common import measure_time
 import dtiplayground.dmri.common.tools as tools 
 from dtiplayground.dmri.common.dwi import DWI
+from dtiplayground.dmri.common.tensor import write_tensor_nrrd, fit_tensors, baseline_mask
 import yaml
 from pathlib import Path
 import copy
@@ -60,9 +61,10 @@ class DTI_Estimate(prep.modules.DTIPrepModule):
         # data prep for dipy
         data = self.image.images
         affine = self.image.getAffineMatrixForNifti()
-        bvals= np.array(list(map(lambda x: x['b_value'], self.image.getGradients())))
+        grads=self.image.getGradientTable()
+        bvals= grads.b_values
         b0=min(bvals)
-        bvecs= np.array(list(map(lambda x: x['unit_gradient'], self.image.getGradients())))
+        bvecs= grads.vector('unit_gradient')
         gtab = gradient_table(bvals,bvecs,b0_threshold=min(max(b0,50),199))
         logger("Affine Matrix (RAS) : \n{}".format(affine),prep.Color.INFO)
         # option parse
@@ -91,39 +93,25 @@ class DTI_Estimate(prep.modules.DTIPrepModule):
                 # print(mask)
                 # print(mask.shape)
             else:
-                logger('Mask not found, estimating whole image...',prep.Color.WARNING)
+                logger('Mask not found',prep.Color.WARNING)
         else:
-            logger('Mask not found, estimating whole image...',prep.Color.WARNING)
+            logger('Mask not found',prep.Color.WARNING)
+        if mask is None:
+            if self.protocol.get('autoMask',True):
+                logger('Computing automatic mask from the mean baseline ...',prep.Color.PROCESS)
+                mask=baseline_mask(data,gtab)
+            else:
+                logger('Estimating whole image...',prep.Color.WARNING)
         # fitting and estimation of scalars
-        dti_fit = dti.TensorModel(gtab,fit_method=fitMethod,**kwargs)
         logger("Running with {}, {}".format(fitMethod, kwargs),prep.Color.PROCESS)
-        #fitted = dti_fit.fit(data) ## dti_fit.fit(data, mask) mask array (boolean)
-        fitted = dti_fit.fit(data,mask)
+        fitted = fit_tensors(gtab,data,mask,fit_method=fitMethod,num_workers=self.num_threads,**kwargs)
         logger("Fitting completed",prep.Color.OK)
 
-        ## convert 3x3 symmetric matrices to xx,xy,xz,yy,yz,zz vectors
+        ## convert 3x3 symmetric matrices to xx,xy,xz,yy,yz,zz vectors and write 3D-symmetric-matrix nrrd
         logger("Reducing 3x3 symmetric matrix to vector")
-        def uppertriangle(matrix):
-            outvec=[]
-            for i in range(3):
-                for j in range(i,3):
-                    outvec.append(matrix[i,j])
-            return np.array(outvec)
-        quad_form = fitted.quadratic_form
-        new_quadform = np.ndarray(shape=(quad_form.shape[0],quad_form.shape[1],quad_form.shape[2],6),dtype=float)
-        for d1 in range(quad_form.shape[0]):
-            for d2 in range(quad_form.shape[1]):
-                for d3 in range(quad_form.shape[2]):
-                    mat = quad_form[d1,d2,d3]
-                    new_quadform[d1,d2,d3]=uppertriangle(mat)
-
-        # TODO : make nrrd file for new_quadform image volume (kind will be "3D-symmetric-matrix") , ref: http://teem.sourceforge.net/nrrd/format.html
-        temp_dti_image = copy.copy(self.image)
-        temp_dti_image.setImage(new_quadform,modality='DTI', kinds=['space','space','space','3D-symmetric-matrix'])
         dti_filename=Path(self.output_dir).joinpath('tensor.nrrd').__str__()
         sp_dir=self.getSourceImageInformation()['space']
-        temp_dti_image.setSpaceDirection(target_space=sp_dir)
-        temp_dti_image.writeImage(dti_filename,dest_type='nrrd',dtype="float32")
+        write_tensor_nrrd(dti_filename,fitted.quadratic_form,self.image.information,target_space=sp_dir)
         self.addOutputFile(dti_filename, 'DTI')
         self.addGlobalVariable('dti_path',dti_filename)
         # retrieve outputs
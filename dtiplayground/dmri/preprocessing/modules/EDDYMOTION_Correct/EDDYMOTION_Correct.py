@@ -278,6 +278,6 @@ class EDDYMOTION_Correct(prep.modules.DTIPrepModule):
 
         self.image=self.loadImage(processed_nifti_nonneg)
         self.image.image_type='nrrd'
-        self.writeImageWithOriginalSpace(output_nrrd,'nrrd')
+        self.writeImageWithOriginalSpace(output_nrrd,'nrrd',background=True)
         return None
 
@@ -9,161 +9,28 @@ import sys
 
 ### Functions of Filter ###
 
-
-### Function with two parameters : exclude gradients which are not in the range ###
-
-def filter_bmin_bmax (b_min, b_max, image):
-    liste=[]
-    for i in range (len(image.gradients)):
-        liste.append(image.gradients[i].get('b_value'))
-        #print("index : ",image.gradients[i].get('index'))
-        #print("b_value : ",image.gradients[i].get('b_value'))
-    #image.gradients
-
-    new_list=[]
-    list2=liste
-    list_to_exclude=[]
-
-    logger("Filtering",prep.Color.INFO)
-    for j in range (len(image.gradients)):
-        if image.gradients[j].get('b_value')<=b_min or image.gradients[j].get('b_value')>=b_max:
-            #image.gradients.pop(j)
-            #print("to exlcude : ", j)
-            list2[j]=0
-            new_list.append(j)
-        #else :
-        
-            #list_to_exclude.append(j)
-            #print("inside : ", j)
-    logger("Creating new gradient table",prep.Color.INFO)
-    for i in range(0,len(list2)):
-        if list2[i]==0:
-            #print("i : ",i)
-            #print(image.gradients[i])
-            image.gradients[i]={}
-            #print(len(image.gradients))
-            #image.gradients
-    logger("Image with new gradient table",prep.Color.INFO)
-    image.gradients= [i for i in image.gradients if i!={}]
-    for i in range(0, len(image.gradients)):
-        #print(i)
-        image.gradients[i][('index')]=i
-    #image.gradients
-
-    image.information['sizes'][3]=len(image.gradients)
-    logger("New len of gradient table : {}".format(len(image.gradients)),prep.Color.INFO)
-    #return image
-
-### Function with two parameters : exclude gradients which are between bmin and bmax ###
-
-def exclude_between_bmin_bmax (b_min, b_max, image):
-    liste=[]
-    for i in range (len(image.gradients)):
-        liste.append(image.gradients[i].get('b_value'))
-        #print("index : ",image.gradients[i].get('index'))
-        #print("b_value : ",image.gradients[i].get('b_value'))
-    
-    #image.gradients
-    
-    new_list=[]
-    list2=liste
-    list_to_exclude=[]
-    
-
-    logger("Filtering",prep.Color.INFO)
-    for j in range (len(image.gradients)):
-        if image.gradients[j].get('b_value')>=b_min and image.gradients[j].get('b_value')<=b_max:
-            #print("to exlcude : ", j)
-            list2[j]=0
-            new_list.append(j)
-        #else :
-        
-            #list_to_exclude.append(j)
-            #print("inside : ", j)
-
-    logger("Creating new gradient table",prep.Color.INFO)
-    for i in range(0,len(list2)):
-        if list2[i]==0:
-            #print("i : ",i)
-            #print(image.gradients[i])
-            image.gradients[i]={}
-            #print(len(image.gradients))
-            #image.gradients
-    logger("Image with new gradient table",prep.Color.INFO)
-    image.gradients= [i for i in image.gradients if i!={}]
-    for i in range(0, len(image.gradients)):
-        #print(i)
-        image.gradients[i][('index')]=i
-    #image.gradients
-
-    image.information['sizes'][3]=len(image.gradients)
-    logger("New len of gradient table : {}".format(len(image.gradients)),prep.Color.INFO)
-    #return image
-
-### Function with one parameter : exclude gradients which have b_values below this parameter b_min ###
-
-def filter_bmin(b_min, image):
-    liste=[]
-    for i in range (len(image.gradients)):
-        liste.append(image.gradients[i].get('b_value'))
-    #image.gradients
-    
-    new_list=[]
-    list2=liste
-    list_to_exclude=[]
-    logger("Filtering",prep.Color.INFO)
-    for j in range (len(image.gradients)):
-        if image.gradients[j].get('b_value')<=b_min:
-            #print("to exlcude : ", j)
-            list2[j]=0
-            new_list.append(j)
-        #else :
-        #    print("inside : ", j)
-    logger("Creating new gradient table",prep.Color.INFO)      
-    for i in range(0,len(list2)):
-        if list2[i]==0:
-            image.gradients[i]={}
-    logger("Image with new gradient table",prep.Color.INFO)
-    image.gradients= [i for i in image.gradients if i!={}]
-    for i in range(0, len(image.gradients)):
-        image.gradients[i][('index')]=i
-
-    image.information['sizes'][3]=len(image.gradients)
-    logger("New len of gradient table : {}".format(len(image.gradients)),prep.Color.INFO)
-    #return image
-
-
-### Function with one parameter : exclude gradients which have b_values above this parameter b_max ###
-
-def filter_bmax(b_max, image):
-    liste=[]
-    for i in range (len(image.gradients)):
-        liste.append(image.gradients[i].get('b_value'))
-    #image.gradients
-    
-    new_list=[]
-    list2=liste
-    list_to_exclude=[]
-    logger("Filtering",prep.Color.INFO)
-    for j in range (len(image.gradients)):
-        if image.gradients[j].get('b_value')>=b_max:
-            #print("to exlcude : ", j)
-            list2[j]=0
-            new_list.append(j)
-        #else :
-        #    print("inside : ", j)
-    logger("Creating new gradient table",prep.Color.INFO)   
-    for i in range(0,len(list2)):
-        if list2[i]==0:
-            image.gradients[i]={}
-    logger("Image with new gradient table",prep.Color.INFO)
-    image.gradients= [i for i in image.gradients if i!={}]
-    for i in range(0, len(image.gradients)):
-        image.gradients[i][('index')]=i
-
-    image.information['sizes'][3]=len(image.gradients)
-    logger("New len of gradient table : {}".format(len(image.gradients)),prep.Color.INFO)
-    #return image
+### Shells are selected by their b-value (see DWI.getShellIndex), so a shell is kept or excluded as a whole ###
+
+def select_shells(shells, mode, b_tresh, b_lower, b_upper): ## returns the ids of the shells to exclude
+    if mode=='one_treshold_below': ## include b <= b_tresh
+        kept=shells.findShells(upper=b_tresh)
+    elif mode=='one_treshold_above': ## include b >= b_tresh
+        kept=shells.findShells(lower=b_tresh)
+    elif mode=='two_tresholds_within': ## include b_lower <= b <= b_upper
+        kept=shells.findShells(lower=b_lower,upper=b_upper)
+    elif mode=='two_tresholds_outside': ## exclude b_lower <= b <= b_upper
+        excluded=shells.findShells(lower=b_lower,upper=b_upper)
+        kept=[sid for sid in range(len(shells)) if sid not in excluded]
+    else:
+        raise Exception("Unknown thresholding mode : {}".format(mode))
+    return [sid for sid in range(len(shells)) if sid not in kept]
+
+def filter_shells(image, mode, b_tresh, b_lower, b_upper): ## returns the gradient indexes to exclude
+    shells=image.getShellIndex()
+    excluded=select_shells(shells, mode, b_tresh, b_lower, b_upper)
+    for sid,shell in enumerate(shells.summary()):
+        logger("Shell b={:.0f} ({} volumes) : {}".format(shell['b_value'],shell['number_of_volumes'],'excluded' if sid in excluded else 'kept'),prep.Color.INFO)
+    return shells.volumesOf(excluded).tolist()
 
 
 class IMAGE_Filter(prep.modules.DTIPrepModule):
@@ -184,15 +51,9 @@ class IMAGE_Filter(prep.modules.DTIPrepModule):
         # << TODOS>>
 
         logger("Choosing the b-value thresholding mode : ", prep.Color.INFO)
+        excluded_indexes=[]
         if self.protocol['b_lower']<self.protocol['b_upper']:
-            if self.protocol['tresholding_mode']=='one_treshold_below':
-                filter_bmax(b_max=self.protocol['b_tresh'], image=self.image)
-            elif self.protocol['tresholding_mode']=='one_treshold_above':
-                filter_bmin(b_min=self.protocol['b_tresh'], image=self.image)
-            elif self.protocol['tresholding_mode']=='two_tresholds_within':
-                filter_bmin_bmax(b_min=self.protocol['b_lower'], b_max=self.protocol['b_upper'], image=self.image)
-            elif self.protocol['tresholding_mode']=='two_tresholds_outside':
-                exclude_between_bmin_bmax(b_min=self.protocol['b_lower'], b_max=self.protocol['b_upper'], image=self.image)
+            excluded_indexes=filter_shells(self.image, self.protocol['tresholding_mode'], b_tresh=self.protocol['b_tresh'], b_lower=self.protocol['b_lower'], b_upper=self.protocol['b_upper'])
         elif self.protocol['b_lower']>self.protocol['b_upper']:
             logger("Error : b_lower must be lower than b_upper or b_upper must be higher than b_lower", prep.Color.ERROR)
             sys.exit()
@@ -206,6 +67,8 @@ class IMAGE_Filter(prep.modules.DTIPrepModule):
             logger("Error : b_tresh must be positive", prep.Color.ERROR)
             sys.exit()
         logger("Treatment done", prep.Color.INFO)
+        logger("Number of excluded gradients : {}".format(len(excluded_indexes)), prep.Color.INFO)
 
+        self.result['output']['excluded_gradients_original_indexes']=self.image.convertToOriginalGradientIndex(excluded_indexes) ## image volumes and gradients are removed together in postProcess
         self.result['output']['success']=True
         return self.result
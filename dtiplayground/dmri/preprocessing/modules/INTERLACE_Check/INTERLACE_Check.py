@@ -27,11 +27,24 @@ from dipy.align.transforms import (TranslationTransform2D,
                                    RigidTransform3D,
                                    AffineTransform3D)
 import dtiplayground.dmri.preprocessing as prep
+import dtiplayground.dmri.common.registration as registration
 import os 
 
 
+def _interlace_register(task): ## worker : (gidx, static, moving, affine, param_tolerance) -> computation of a gradient volume
+    gidx,static,moving,affine,param_tolerance = task
+    corr=ncc(moving,static)
+    _, out_affine=registration.rigid_3d(static,moving,affine,affine ,
+                                                  nbins=32,
+                                                  level_iters=[10000,1000,100],
+                                                  sigmas=[3.0,1.0,0.0],
+                                                  factors=[4,2,1],sampling_prop=0.1,
+                                                  param_tolerance=param_tolerance,
+                                                  resample=False) ## only the affine is used
+    return gidx, float(corr), out_affine
+
 @prep.measure_time
-def interlace_compute(image_obj):
+def interlace_compute(image_obj,num_threads=1,param_tolerance=None):
     image_obj.images=image_obj.images.astype(float)
     # affine=np.transpose(np.append(image_obj.information['space_directions'],np.expand_dims(image_obj.information['space_origin'],0),axis=0))
     # affine=np.append(affine,np.array([[0,0,0,1]]),axis=0)
@@ -42,27 +55,23 @@ def interlace_compute(image_obj):
     if z % 2 == 1:
         evens.pop()
 
-    output=[]
-    for gidx in range(0,g):
-
-        #### interlaing a volume
-        static=image_obj.images[:,:,evens,gidx]
-        moving=image_obj.images[:,:,odds,gidx]
+    #### interlacing volumes, only even/odd sub-volumes are shipped to the workers
+    tasks=((gidx,image_obj.images[:,:,evens,gidx],image_obj.images[:,:,odds,gidx],affine,param_tolerance) for gidx in range(0,g))
+    if num_threads>1:
+        logger("Registering {} gradient volumes with {} processes ...".format(g,min(num_threads,g)),prep.Color.PROCESS)
+    registrations=prep.process_map(_interlace_register,tasks,num_workers=num_threads)
+    registration.release_rigid_registration() ## serial runs registered in this thread, the static pyramid is not needed anymore
 
+    output=[]
+    gradients=image_obj.getGradients()
+    for gidx,corr,out_affine in registrations:
         #### Correlation and Motion detection
-        corr=ncc(moving,static)
-        #logger("\rGradient {}/{}, Corr: {:.4f} , registering for motion detection ...".format(gidx,g,corr))
-        transformed, out_affine=rigid_3d(static,moving,affine,affine ,
-                                                      nbins=32,
-                                                      level_iters=[10000,1000,100],
-                                                      sigmas=[3.0,1.0,0.0],
-                                                      factors=[4,2,1],sampling_prop=0.1)
         affine_info=decompose_affine_matrix(out_affine)
         max_norm=np.max(np.abs(affine_info["translations"]))
         max_angle_in_deg=np.max(np.rad2deg(np.abs(affine_info["angles"])))
         logger("Gradient {}/{}, Corr: {:.4f}, Max translation : {:.4f} , Max angle : {:.4f} degree".format(gidx,g-1,corr,max_norm,max_angle_in_deg))
         output.append({"gradient_index": gidx, 
-                       "original_gradient_index": image_obj.getGradients()[gidx]['original_index'], 
+                       "original_gradient_index": gradients[gidx]['original_index'], 
                        "affine_matrix":out_affine.tolist(),
                        "correlation": float(corr),
                        "motions": affine_info})
@@ -196,58 +205,6 @@ def measure_max_translation_from_affine_matrix(mat):
     norm=np.abs(np.max(translation))
     return norm 
 
-@prep.measure_time
-def rigid_3d(static,moving,
-             affine_static,affine_moving,
-             nbins=32,
-             level_iters=[10000,1000,100],
-             sigmas=[3.0,1.0,0.0],
-             factors=[4,2,1],
-             sampling_prop=None):
-    ## Make affine map
-    
-    identity=np.eye(4)
-    affine_map=AffineMap(identity,static.shape, affine_static,
-                                  moving.shape, affine_static)
-
-    ## Resample moving image from affine (but same in a volume)
-    resampled=affine_map.transform(moving)
-
-    ## center of mass transform
-    c_of_mass = transform_centers_of_mass(static, affine_static, moving, affine_moving)
-    transformed=c_of_mass.transform(moving)
-
-    ## registration preparation
-    metric= MutualInformationMetric(nbins,sampling_prop)
-    affreg= AffineRegistration(metric=metric, 
-                               level_iters=level_iters, 
-                               sigmas=sigmas, 
-                               factors=factors,
-                               verbosity=0)
-
-    ## Translation transform registration
-    transform=TranslationTransform3D()
-    params0=None
-    starting_affine= c_of_mass.affine
-    translation=affreg.optimize(static, 
-                                moving, 
-                                transform, 
-                                params0, 
-                                affine_static,affine_moving, 
-                                starting_affine=starting_affine)
-    transformed = translation.transform(moving)
-
-    ## Ridid registration
-    transform=RigidTransform3D()
-    params0=None
-    starting_affine=translation.affine
-    rigid=affreg.optimize(static,moving,transform,params0,affine_static,affine_moving,starting_affine=starting_affine)
-    transformed = rigid.transform(moving)
-
-    return transformed, rigid.affine 
-
-
-
 def rigid_2d(static,moving,
              affine_static,affine_moving,
              nbins=32,
@@ -312,6 +269,8 @@ class INTERLACE_Check(prep.modules.DTIPrepModule):
     def process(self,*args,**kwargs): ## variables : self.source_image, self.image (output) , self.result_history , self.result (output) , self.protocol, self.template
         super().process()
         inputParams=self.getPreviousResult()['output']
+        protocol_options=args[0]
+        self.num_threads=protocol_options['software_info']['parameters']['num_max_threads']
         #logger(yaml.dump(inputParams))
         ### Computation 
         output=None
@@ -324,7 +283,8 @@ class INTERLACE_Check(prep.modules.DTIPrepModule):
         else: 
             ### actual computation for interlacing correlation and motions
             logger("Computing interlace correlations and motions ...",prep.Color.PROCESS)
-            output=interlace_compute(self.image)
+            output=interlace_compute(self.image,num_threads=self.num_threads,
+                                     param_tolerance=self.protocol.get('registrationTolerance',0.0) or None) ## 0 : every resolution level
             yaml.dump(output,open(output_filename,'w'))
         ### Check for QC
         logger("Checking bad gradients ...",prep.Color.PROCESS)
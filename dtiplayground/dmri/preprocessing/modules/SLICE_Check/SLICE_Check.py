@@ -21,6 +21,68 @@ import os
 
 # import SLICE_Check.computations as computations
 
+def _ncc(x,y): #normalized cross correlation in image (ref: https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3864968/ )
+    ab=np.sum(x*y)
+    a2=np.sum(x**2)
+    b2=np.sum(y**2)
+    if a2*b2==0.0: 
+        return 1.0
+    else:
+        return ab/np.sqrt(a2*b2)
+
+def correlation_table_loop(image_tensor,begin_slice,last_slice): ## reference implementation (gradient x slice python loop)
+    gsum=[]
+    for k in range(image_tensor.shape[3]):
+        csum=[]
+        for i in range(image_tensor.shape[2]):
+            if i<=begin_slice or i>=last_slice: continue
+            af=image_tensor[:,:,i,k].reshape([1,-1])
+            bf=image_tensor[:,:,i-1,k].reshape([1,-1])
+            corr=_ncc(af,bf)
+            if not np.isnan(corr): csum.append(float(corr))
+            else: csum.append(0.0)
+        gsum.append(csum)
+    return np.array(gsum)
+
+def correlation_table(image_tensor,begin_slice,last_slice,max_chunk_bytes=256*1024**2): ## returns (gradients x slices) table, identical to correlation_table_loop
+    x,y,z,g = image_tensor.shape
+    slice_indexes=[i for i in range(z) if i>begin_slice and i<last_slice]
+    if len(slice_indexes)==0:
+        return np.zeros((g,0))
+    ## slices x gradients x voxels, every in-plane slice is contiguous (same summation order as the reference)
+    first=slice_indexes[0]-1
+    planes=np.ascontiguousarray(np.moveaxis(image_tensor[:,:,first:slice_indexes[-1]+1,:],(2,3),(0,1))).reshape(len(slice_indexes)+1,g,x*y)
+    squares=np.sum(planes**2,axis=-1)
+    products=np.empty((len(slice_indexes),g))
+    step=max(1,int(max_chunk_bytes//max(1,planes[0].nbytes)))
+    for b in range(0,len(slice_indexes),step):
+        e=min(b+step,len(slice_indexes))
+        products[b:e]=np.sum(planes[b+1:e+1]*planes[b:e],axis=-1)
+    norms=squares[1:]*squares[:-1]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        corr=products/np.sqrt(norms)
+    corr[norms==0.0]=1.0
+    corr[np.isnan(corr)]=0.0
+    return np.ascontiguousarray(corr.transpose())
+
+def detect_artifacts(gsum,z_thresholds,begin_slice,b_values): ## z-score test over the whole table, z_thresholds per gradient
+    columns=np.ascontiguousarray(gsum.transpose()) # slices x gradients
+    avg=np.mean(columns,axis=-1)
+    std=np.std(columns,axis=-1)
+    lower_bounds=avg[:,np.newaxis]-z_thresholds[np.newaxis,:]*std[:,np.newaxis]
+    slice_indexes,grad_indexes=np.nonzero(columns<lower_bounds)
+    artifacts={}
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for slice_index,idx in zip(slice_indexes.tolist(),grad_indexes.tolist()):
+            g=columns[slice_index,idx]
+            if idx not in artifacts: artifacts[idx]=[]
+            artifacts[idx].append({"slice":slice_index+begin_slice,
+                                    "correlation":float(g),
+                                    'z_threshold':float(z_thresholds[idx]),
+                                    'z_value':float((g-avg[slice_index])/std[slice_index]),
+                                    'b_value':float(b_values[idx])})
+    return artifacts, avg, std
+
 class SLICE_Check(prep.modules.DTIPrepModule):
     def __init__(self,config_dir,*args,**kwargs):
         super().__init__(config_dir,*args,**kwargs)
@@ -88,44 +150,24 @@ class SLICE_Check(prep.modules.DTIPrepModule):
         image_tensor=image.images.astype(float) 
         gradients=image.getGradients()
         ## Generate slice correlation informations over gradients
-        gsum=[]
         begin_slice=int(np.floor(image_tensor.shape[2]*headskip))
         last_slice=int(np.floor(image_tensor.shape[2]*(1-tailskip)))
-        for k in range(image_tensor.shape[3]):
-            csum=[]
-            for i in range(image_tensor.shape[2]):
-                if i<=begin_slice or i>=last_slice: continue
-                af=image_tensor[:,:,i,k].reshape([1,-1])
-                bf=image_tensor[:,:,i-1,k].reshape([1,-1])
-                corr=self.ncc(af,bf)
-                if not np.isnan(corr): csum.append(float(corr))
-                else: csum.append(0.0)
-            gsum.append(csum)
-        gsum=np.array(gsum) 
+        gsum=correlation_table(image_tensor,begin_slice,last_slice)
 
         ## lookup artifacts from the z-threshold criteria over gradients for each slices.
-        min_bval=min(list(map(lambda x: x['b_value'],gradients)))
-        max_bval=max(list(map(lambda x: x['b_value'],gradients)))
+        b_values=np.array([x['b_value'] for x in gradients])
+        min_bval=float(np.min(b_values))
+        max_bval=float(np.max(b_values))
         quadfit= self.quadratic_fit_generator([min_bval,max_bval],[baseline_z_Threshold,gradient_z_Threshold])
-        artifacts={}
+        z_thresholds=np.full(len(gradients),float(baseline_z_Threshold))
+        for idx,g in enumerate(gradients):
+            if quad_fit:
+                z_thresholds[idx]=quadfit(g['b_value'])
+            elif not g['baseline']:
+                z_thresholds[idx]=gradient_z_Threshold
+        artifacts,avgs,stds=detect_artifacts(gsum,z_thresholds,begin_slice,b_values)
         for slice_index in range(gsum.shape[1]):
-            gradwise_vec=gsum[:,slice_index]
-            avg=np.mean(gradwise_vec)
-            std=np.std(gradwise_vec)
-            logger("Slice {}, Mean {:.4f}, Std {:.4f}".format(slice_index+begin_slice,avg,std))
-            for idx,g in enumerate(gradwise_vec):
-                z_threshold=baseline_z_Threshold
-                if quad_fit:
-                    z_threshold=quadfit(gradients[idx]['b_value'])
-                elif not gradients[idx]['baseline']:
-                    z_threshold=gradient_z_Threshold
-                if g < avg- z_threshold*std:
-                    if idx not in artifacts: artifacts[idx]=[]
-                    artifacts[idx].append({"slice":slice_index+begin_slice,
-                                            "correlation":float(g),
-                                            'z_threshold':float(z_threshold),
-                                            'z_value':float((g-avg)/std),
-                                            'b_value':float(gradients[idx]['b_value'])})
+            logger("Slice {}, Mean {:.4f}, Std {:.4f}".format(slice_index+begin_slice,avgs[slice_index],stds[slice_index]))
 
         gsum_file=Path(computation_dir).joinpath('correlation_table.yml') # row=gradient index, col = slice index
         yaml.dump(gsum.tolist(),open(gsum_file,'w'))
@@ -144,13 +186,7 @@ class SLICE_Check(prep.modules.DTIPrepModule):
         return np.sum(x*y)
 
     def ncc(self,x,y): #normalized cross correlation in image (ref: https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3864968/ )
-        ab=np.sum(x*y)
-        a2=np.sum(x**2)
-        b2=np.sum(y**2)
-        if a2*b2==0.0: 
-            return 1.0
-        else:
-            return ab/np.sqrt(a2*b2)
+        return _ncc(x,y)
 
     def _quad_fit(self,bval, domain=[0,1000], fimage=[3.0,3.5]): #returns std multiple between fimage
         if bval > domain[1] : 
@@ -5,8 +5,8 @@ from PyQt5.QtCore import *
 from PIL import Image, ImageEnhance
 from PIL.ImageQt import ImageQt
 from functools import partial
-import SimpleITK as sitk
 import numpy
+from dtiplayground.dmri.common.dwi import DWI
 import os
 
 from PyQt5.QtCore import QObject
@@ -57,10 +57,7 @@ class QuickView(QMainWindow):
 
     self.LoadImage()
     self.Menu()
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
     
     scroll = QScrollArea()
     scroll.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
@@ -123,10 +120,7 @@ class QuickView(QMainWindow):
     self.options_layout.addWidget(QLabel("Number of columns:"))
     self.images_per_row = QSpinBox()
     self.images_per_row.setMinimum(1)
-    if ".nrrd" in self.image_name:
-      self.images_per_row.setMaximum(self.number_gradients)
-    else:
-      self.images_per_row.setMaximum(self.size[3])
+    self.images_per_row.setMaximum(self.number_gradients)
     self.images_per_row.setAlignment(Qt.AlignRight)
     self.images_per_row.setValue(self.columns)
     self.images_per_row.valueChanged.connect(self.ChangeColumns)
@@ -163,149 +157,39 @@ class QuickView(QMainWindow):
 
   def LoadImage(self):
     print("image", self.image_name)
-    self.input_image = sitk.ReadImage(self.image_name)
-    self.size = list(self.input_image.GetSize())
-    self.spacing = list(self.input_image.GetSpacing())
-    self.number_gradients = self.input_image.GetNumberOfComponentsPerPixel()
-
-  def AxialViewNRRD(self):
-    self.number_slices = self.size[2]
-    index = [0, 0, self.zslice]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[0], self.spacing[1])
-    slice_extractor = sitk.ExtractImageFilter()
-    slice_extractor.SetSize([self.size[0], self.size[1], 0])
-    slice_extractor.SetIndex(index)
-    extracted_slice = slice_extractor.Execute(self.input_image)
-    return extracted_slice, spacing_matrix
-
-  def SagittalViewNRRD(self):
-    self.number_slices = self.size[0]
-    index = [self.zslice, 0, 0, ]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[1], self.spacing[2])
-    slice_extractor = sitk.ExtractImageFilter()
-    slice_extractor.SetSize([0, self.size[1], self.size[2]])
-    slice_extractor.SetIndex(index)
-    extracted_slice = slice_extractor.Execute(self.input_image)
-    return extracted_slice, spacing_matrix
-
-  def CoronalViewNRRD(self):
-    self.number_slices = self.size[1]
-    index = [0, self.zslice, 0]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[0], self.spacing[2])
-    slice_extractor = sitk.ExtractImageFilter()    
-    slice_extractor.SetSize([self.size[0], 0, self.size[2]])
-    slice_extractor.SetIndex(index)
-    extracted_slice = slice_extractor.Execute(self.input_image)
-    return extracted_slice, spacing_matrix
-    
-  def CreateButtonsNRRD(self):
+    self.input_image = DWI(self.image_name, lazy=True)
+    self.display = self.input_image.getDisplayVolumes() # slices reoriented once (same orientation as the web viewer)
+    shape = self.input_image.getShape()
+    self.size = list(shape)
+    self.number_gradients = shape[3]
 
-    self.dic = {}
-    
-    if self.axial.isChecked():
-      extracted_slice, spacing_matrix = self.AxialViewNRRD()
+  def ViewAxis(self):
     if self.sagittal.isChecked():
-      extracted_slice, spacing_matrix = self.SagittalViewNRRD()
+      return 0
     if self.coronal.isChecked():
-      extracted_slice, spacing_matrix = self.CoronalViewNRRD()
-
-    for iter_gradients in range(self.number_gradients):
-      self.button = QPushButton()
-      self.dic[str(iter_gradients)] = self.button
-      
-      gradient_extractor = sitk.VectorIndexSelectionCastImageFilter()
-      gradient_extractor.SetIndex(iter_gradients)
-      gradient = gradient_extractor.Execute(extracted_slice)
-
-      gradient_array = sitk.GetArrayFromImage(gradient)
+      return 1
+    return 2
 
-      # min max scaling for brightness
-      gradient_array_normalized = (gradient_array - numpy.min(gradient_array)) * round(255 / numpy.max(gradient_array), 3)
-      if self.sagittal.isChecked() or self.coronal.isChecked():
-        gradient_array_normalized = numpy.flipud(gradient_array_normalized) #if SAGITTAL or CORONAL
-      gradient_image = Image.fromarray(gradient_array_normalized)
-      gradient_image = gradient_image.convert("L")
-      gradient_image2 = gradient_image.resize((int(self.zoom_factor*gradient_image.width), int(self.zoom_factor*gradient_image.height)))
-      # brightness and contrast
-      brightness_enhancer = ImageEnhance.Brightness(gradient_image2)
-      gradient_image3 = brightness_enhancer.enhance(self.brightness_factor)
-      contrast_enhancer = ImageEnhance.Contrast(gradient_image3)
-      gradient_image4 = contrast_enhancer.enhance(self.contrast_factor)
-
-      gradient_qimage = ImageQt(gradient_image4)
-      gradient_qimage.transformed(spacing_matrix)
-      gradient_qpixmap = QtGui.QPixmap.fromImage(gradient_qimage)  
+  def CreateButtons(self):
 
-      self.button.setIcon(QIcon(gradient_qpixmap))
-      self.button.setIconSize(gradient_qpixmap.size())
-      self.images_layout.addWidget(QLabel("DWI " + str(iter_gradients)), 2*(iter_gradients//self.columns), iter_gradients%self.columns, QtCore.Qt.AlignCenter)
-      self.images_layout.addWidget(self.button, 2*(iter_gradients//self.columns)+1, iter_gradients%self.columns)
-      self.button.clicked.connect(partial(self.ButtonClicked, dwi=iter_gradients)) 
-      if iter_gradients in self.gradientsToExclude_list:
-        self.button.setStyleSheet("background-color : red")
-      else:
-        self.button.setStyleSheet("background-color : black") 
-    
-  def SagittalViewNIFTI(self, iter_gradients):
-    self.number_slices = self.size[0]
-    index = [self.zslice, 0, 0, iter_gradients]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[1], self.spacing[2])
-    slice_extractor = sitk.ExtractImageFilter()
-    slice_extractor.SetSize([0, self.size[1], self.size[2], 0])
-    slice_extractor.SetIndex(index)
-    gradient = slice_extractor.Execute(self.input_image)
-    return gradient, spacing_matrix
-
-  def CoronalViewNIFTI(self, iter_gradients):
-    self.number_slices = self.size[1]
-    index = [0, self.zslice, 0, iter_gradients]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[0], self.spacing[2])
-    slice_extractor = sitk.ExtractImageFilter()    
-    slice_extractor.SetSize([self.size[0], 0, self.size[2], 0])
-    slice_extractor.SetIndex(index)
-    gradient = slice_extractor.Execute(self.input_image)
-    return gradient, spacing_matrix
-
-  def AxialViewNIFTI(self, iter_gradients):
-    self.number_slices = self.size[2]
-    index = [0, 0, self.zslice, iter_gradients]
-    spacing_matrix = QTransform()
-    spacing_matrix.scale(self.spacing[0], self.spacing[1])
-    slice_extractor = sitk.ExtractImageFilter()
-    slice_extractor.SetSize([self.size[0], self.size[1], 0, 0])
-    slice_extractor.SetIndex(index)
-    gradient = slice_extractor.Execute(self.input_image)
-    return gradient, spacing_matrix
-
-  def CreateButtonsNIFTI(self):
-    
     self.dic = {}
-    for iter_gradients in range(self.size[3]):
+    axis_idx = self.ViewAxis()
+    self.number_slices = self.size[axis_idx]
+    slice_idx = min(self.zslice, self.number_slices-1)
+    width, height = self.display.dsizes[axis_idx] # spacing corrected size
+    level = self.display.levelFor(axis_idx, int(self.zoom_factor*max(width, height))) # downsampled level when zoomed out
+
+    for iter_gradients in range(self.number_gradients):
       self.button = QPushButton()
       self.dic[str(iter_gradients)] = self.button
-      
-      if self.sagittal.isChecked():
-        gradient, spacing_matrix = self.SagittalViewNIFTI(iter_gradients)
-      if self.coronal.isChecked():
-        gradient, spacing_matrix = self.CoronalViewNIFTI(iter_gradients)
-      if self.axial.isChecked():
-        gradient, spacing_matrix = self.AxialViewNIFTI(iter_gradients)
 
-      gradient_array = sitk.GetArrayFromImage(gradient)
+      gradient_array = self.display.getSlice(axis_idx, slice_idx, iter_gradients, level)
 
       # min max scaling for brightness
-      gradient_array_normalized = (gradient_array - numpy.min(gradient_array)) * round(255 / numpy.max(gradient_array), 3)
-      if self.sagittal.isChecked() or self.coronal.isChecked():
-        gradient_array_normalized = numpy.flipud(gradient_array_normalized) #if SAGITTAL or CORONAL
+      mn, mx = float(gradient_array.min()), float(gradient_array.max())
+      gradient_array_normalized = ((gradient_array - mn) * (255 / max(mx - mn, 1))).astype(numpy.uint8)
       gradient_image = Image.fromarray(gradient_array_normalized)
-      gradient_image = gradient_image.convert("L")
-      gradient_image2 = gradient_image.resize((int(self.zoom_factor*gradient_image.width), int(self.zoom_factor*gradient_image.height)))
-      
+      gradient_image2 = gradient_image.resize((int(self.zoom_factor*width), int(self.zoom_factor*height)))
       # brightness and contrast
       brightness_enhancer = ImageEnhance.Brightness(gradient_image2)
       gradient_image3 = brightness_enhancer.enhance(self.brightness_factor)
@@ -313,7 +197,6 @@ class QuickView(QMainWindow):
       gradient_image4 = contrast_enhancer.enhance(self.contrast_factor)
 
       gradient_qimage = ImageQt(gradient_image4)
-      gradient_qimage.transformed(spacing_matrix)
       gradient_qpixmap = QtGui.QPixmap.fromImage(gradient_qimage)  
 
       self.button.setIcon(QIcon(gradient_qpixmap))
@@ -356,50 +239,32 @@ class QuickView(QMainWindow):
       if self.zslice >= self.size[1]:
         self.zslice = self.size[1]-1
         self.slice_selector_spinbox.setValue(self.zslice)
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def ChangeSlice(self):
     self.RemoveImages()
     self.zslice = self.slice_selector_spinbox.value()
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
   
   def ChangeColumns(self):
     self.RemoveImages()
     self.columns = self.images_per_row.value()
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def ChangeZoom(self):
     self.RemoveImages()
     self.zoom_factor = self.zoom.value()
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def ChangeBrightness(self):
     self.RemoveImages()
     self.brightness_factor = round(self.brightness_slidebar.value()/50, 2)
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def ChangeContrast(self):
     self.RemoveImages()
     self.contrast_factor = round(self.contrast_slidebar.value()/50, 2)
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def RemoveImages(self):
 
@@ -434,10 +299,7 @@ class QuickView(QMainWindow):
 
     self.zoom_factor = self.zoom.value()
     
-    if ".nrrd" in self.image_name:
-      self.CreateButtonsNRRD()
-    else:
-      self.CreateButtonsNIFTI()
+    self.CreateButtons()
 
   def ComputeExcludeGradients(self):
     self.signal_quickview.Execution(self.gradientsToExclude_list)